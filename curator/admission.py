@@ -0,0 +1,250 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import os
+import heapq
+import itertools
+import logging
+import threading
+from queue import Full
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:admission', log_level=logging.DEBUG, log_json=True)
+
+
+def parse_limits(value):
+    """
+    Parses per platform type limits, e.g. 'sonata=10,osm=4'
+    :param value:
+    :return: {platform_type: limit}
+    """
+    limits = {}
+    if not value:
+        return limits
+    for item in value.split(','):
+        if '=' in item:
+            sp_type, limit = item.split('=', 1)
+            limits[sp_type.strip().lower()] = int(limit)
+    return limits
+
+
+def platform_type_hint(payload):
+    """
+    Best effort guess of the service platform type of a test plan before its
+    descriptors are resolved, returns None if it cannot be known yet
+    :param payload: test plan as received from the planner
+    :return: 'sonata', 'osm' or None
+    """
+    if payload.get('sp_type'):
+        return payload['sp_type'].lower()
+    nsd = payload.get('nsd')
+    if nsd and nsd.get('platform'):
+        return 'sonata' if nsd['platform'].lower() in ('5gtango', 'sonata') else nsd['platform'].lower()
+    testd = payload.get('testd')
+    if testd and type(testd.get('service_platforms')) is list and len(testd['service_platforms']) == 1:
+        return testd['service_platforms'][0].lower()
+    return None
+
+
+class AdmissionController:
+    """
+    Caps the number of test plans being processed at the same time, globally
+    and per service platform type. Plans over the cap wait in a bounded
+    priority queue (higher priority first, FIFO among equals) that a dispatcher
+    thread drains as capacity frees up.
+    Configuration:
+        CURATOR_MAX_PLANS: global cap on plans in flight (0 = unlimited)
+        CURATOR_MAX_PLANS_PER_TYPE: e.g. 'sonata=10,osm=4'
+        CURATOR_MAX_QUEUED_PLANS: queue size, beyond it plans are rejected
+        CURATOR_RETRY_AFTER: seconds suggested to the planner when rejected
+    """
+    def __init__(self, dispatch, max_in_flight=None, type_limits=None, max_queued=None, retry_after=None):
+        self.dispatch = dispatch
+        self.max_in_flight = max_in_flight if max_in_flight is not None else int(os.getenv('CURATOR_MAX_PLANS', 20))
+        self.type_limits = type_limits if type_limits is not None else \
+            parse_limits(os.getenv('CURATOR_MAX_PLANS_PER_TYPE', ''))
+        self.max_queued = max_queued if max_queued is not None else int(os.getenv('CURATOR_MAX_QUEUED_PLANS', 200))
+        self.retry_after = retry_after if retry_after is not None else int(os.getenv('CURATOR_RETRY_AFTER', 30))
+        self._queue = []
+        self._queued = {}
+        self._in_flight = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self.admitted = 0
+        self.rejected = 0
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name='curator-admission-dispatcher',
+                                            daemon=True)
+        self._dispatcher.start()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(in_flight={len(self._in_flight)}, queued={len(self._queued)})'
+
+    def submit(self, test_plan_uuid, platform_type=None, priority=0):
+        """
+        Queue a test plan for processing
+        :param test_plan_uuid:
+        :param platform_type: service platform type if already known
+        :param priority: higher values are dispatched first
+        :return: position in queue (0 if it was dispatched right away)
+        :raises queue.Full: if the queue is full, caller should retry later
+        """
+        with self._cond:
+            if len(self._queued) >= self.max_queued:
+                self.rejected += 1
+                raise Full(f'Admission queue is full ({len(self._queued)} test plans waiting)')
+            entry = [-priority, next(self._counter), test_plan_uuid, platform_type]
+            heapq.heappush(self._queue, entry)
+            self._queued[test_plan_uuid] = entry
+            self._cond.notify()
+            position = sum(1 for other in self._queue if other[:2] < entry[:2]) + 1
+            if position == 1 and self._has_capacity(platform_type):
+                # Dispatcher picks it up right away
+                return 0
+        _LOG.debug(f'Test plan {test_plan_uuid} queued for admission, position {position}')
+        return position
+
+    def adopt(self, test_plan_uuid, platform_type=None):
+        """
+        Accounts a plan that is already being processed, e.g. recovered after
+        a restart with tests still running, without dispatching it again
+        """
+        with self._cond:
+            self._in_flight[test_plan_uuid] = platform_type.lower() if platform_type else None
+
+    def classify(self, test_plan_uuid, platform_type):
+        """
+        Accounts an in-flight plan against its platform type once known
+        """
+        with self._cond:
+            if test_plan_uuid in self._in_flight:
+                self._in_flight[test_plan_uuid] = platform_type.lower() if platform_type else None
+
+    def release(self, test_plan_uuid):
+        """
+        Frees the capacity held by a plan, safe to call more than once
+        """
+        with self._cond:
+            if self._in_flight.pop(test_plan_uuid, False) is not False:
+                _LOG.debug(f'Test plan {test_plan_uuid} released its admission slot')
+                self._cond.notify()
+
+    def remove(self, test_plan_uuid):
+        """
+        Removes a plan from the queue before it has been dispatched
+        :return: True if the plan was queued
+        """
+        with self._cond:
+            entry = self._queued.pop(test_plan_uuid, None)
+            if entry is None:
+                return False
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            return True
+
+    def position(self, test_plan_uuid):
+        """
+        :return: 1-based position in the queue or None if not queued
+        """
+        with self._cond:
+            entry = self._queued.get(test_plan_uuid)
+            if entry is None:
+                return None
+            return sum(1 for other in self._queue if other[:2] < entry[:2]) + 1
+
+    def is_queued(self, test_plan_uuid):
+        return test_plan_uuid in self._queued
+
+    def stats(self):
+        with self._cond:
+            by_type = {}
+            for sp_type in self._in_flight.values():
+                by_type[sp_type or 'unknown'] = by_type.get(sp_type or 'unknown', 0) + 1
+            return {
+                'max_in_flight': self.max_in_flight,
+                'type_limits': self.type_limits,
+                'max_queued': self.max_queued,
+                'in_flight': len(self._in_flight),
+                'in_flight_by_type': by_type,
+                'queued': len(self._queued),
+                'admitted': self.admitted,
+                'rejected': self.rejected
+            }
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def _has_capacity(self, platform_type):
+        if self.max_in_flight and len(self._in_flight) >= self.max_in_flight:
+            return False
+        if platform_type and platform_type in self.type_limits:
+            in_flight_type = sum(1 for t in self._in_flight.values() if t == platform_type)
+            return in_flight_type < self.type_limits[platform_type]
+        return True
+
+    def _next_admissible(self):
+        # Entries whose platform type is saturated are skipped, not dropped
+        for entry in sorted(self._queue):
+            if self._has_capacity(entry[3]):
+                return entry
+        return None
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                entry = None
+                while self._running:
+                    entry = self._next_admissible() if self._queue else None
+                    if entry:
+                        break
+                    self._cond.wait()
+                if not self._running:
+                    return
+                test_plan_uuid, platform_type = entry[2], entry[3]
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                del self._queued[test_plan_uuid]
+                self._in_flight[test_plan_uuid] = platform_type
+                self.admitted += 1
+            try:
+                _LOG.debug(f'Dispatching test plan {test_plan_uuid}')
+                self.dispatch(test_plan_uuid)
+            except Full:
+                # Worker pool is saturated, put it back and wait for a release
+                _LOG.warning(f'Worker pool full, re-queueing test plan {test_plan_uuid}')
+                with self._cond:
+                    del self._in_flight[test_plan_uuid]
+                    self.admitted -= 1
+                    heapq.heappush(self._queue, entry)
+                    self._queued[test_plan_uuid] = entry
+                    self._cond.wait(timeout=1)
+            except Exception as e:
+                _LOG.exception(f'Error dispatching test plan {test_plan_uuid}: {e}')
+                self.release(test_plan_uuid)
@@ -0,0 +1,279 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import os
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from curator.admission import parse_limits
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:balancer', log_level=logging.DEBUG, log_json=True)
+
+
+class LoadBalancer:
+    """
+    Chooses the service platform of a new instance and accounts the
+    instances in flight on each platform: acquire() when an instance is
+    requested, release() when it is terminated or fails, observe() with the
+    instantiation time and failed() when an instantiation fails. Platforms
+    that failed recently are left out while others are available, for a
+    cooldown doubling with each consecutive failure. The base policy takes
+    the first available platform.
+    Configuration:
+        CURATOR_LB_FAILURE_COOLDOWN: seconds a platform is avoided after a failure
+    """
+    name = 'first'
+
+    def __init__(self, cooldown=None):
+        self._lock = threading.Lock()
+        self.in_flight = {}
+        self.latency = {}
+        self.selected = {}
+        self.failures = {}
+        self.cooldown = cooldown if cooldown is not None else float(os.getenv('CURATOR_LB_FAILURE_COOLDOWN', 120))
+        self._failing = {}
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+    def select(self, platform_type, sp_list):
+        """
+        :param platform_type: e.g. 'sonata', platforms are balanced within their type
+        :param sp_list: available platforms of that type, not empty
+        :return: the chosen platform
+        """
+        with self._lock:
+            now = time.monotonic()
+            healthy = [sp for sp in sp_list if self._failing.get(sp['name'], (0, 0))[1] <= now]
+            platform = self._select(platform_type, healthy or sp_list)
+            self.selected[platform['name']] = self.selected.get(platform['name'], 0) + 1
+            return platform
+
+    def acquire(self, sp_name):
+        with self._lock:
+            self.in_flight[sp_name] = self.in_flight.get(sp_name, 0) + 1
+            self._changed(sp_name)
+
+    def release(self, sp_name):
+        with self._lock:
+            if self.in_flight.get(sp_name):
+                self.in_flight[sp_name] -= 1
+                self._changed(sp_name)
+
+    def observe(self, sp_name, latency, alpha=0.3):
+        """
+        Feeds the instantiation time of a platform into its moving average
+        """
+        with self._lock:
+            previous = self.latency.get(sp_name)
+            self.latency[sp_name] = latency if previous is None else (1 - alpha) * previous + alpha * latency
+            self._failing.pop(sp_name, None)
+            self._changed(sp_name)
+
+    def failed(self, sp_name):
+        """
+        Accounts a failed instantiation on a platform
+        """
+        with self._lock:
+            self.failures[sp_name] = self.failures.get(sp_name, 0) + 1
+            consecutive = self._failing.get(sp_name, (0, 0))[0] + 1
+            self._failing[sp_name] = (consecutive, time.monotonic() + self.cooldown * 2 ** min(consecutive - 1, 5))
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'policy': self.name,
+                'cooldown': self.cooldown,
+                'platforms': {
+                    sp_name: {
+                        'in_flight': self.in_flight.get(sp_name, 0),
+                        'latency': round(self.latency[sp_name], 3) if sp_name in self.latency else None,
+                        'selected': self.selected.get(sp_name, 0),
+                        'failures': self.failures.get(sp_name, 0),
+                        'avoided_for': round(max(self._failing[sp_name][1] - now, 0), 1)
+                        if sp_name in self._failing else 0
+                    } for sp_name in set(self.in_flight) | set(self.latency) | set(self.selected) | set(self.failures)
+                }
+            }
+
+    def _select(self, platform_type, sp_list):
+        return sp_list[0]
+
+    def _changed(self, sp_name):
+        pass
+
+
+class RandomBalancer(LoadBalancer):
+    name = 'random'
+
+    def _select(self, platform_type, sp_list):
+        return random.choice(sp_list)
+
+
+class HeapBalancer(LoadBalancer):
+    """
+    Keeps the platforms of each type in a heap ordered by score() and picks
+    the lowest in O(log n). Entries are invalidated lazily: a change of a
+    platform pushes a new entry and bumps its version, stale entries are
+    dropped when they reach the top. Ties go to the platform updated least
+    recently. Platforms of the type left out of a pick, e.g. cooling down
+    or gone from the registry, stay in the heap and are skipped while
+    popping, so each of them costs O(log n) when it ranks above the pick.
+    """
+    def __init__(self, cooldown=None):
+        LoadBalancer.__init__(self, cooldown=cooldown)
+        self._heaps = {}
+        self._members = {}
+        self._versions = {}
+        self._counter = itertools.count()
+
+    def score(self, sp_name):
+        raise NotImplementedError
+
+    def _selected(self, sp_name):
+        pass
+
+    def _select(self, platform_type, sp_list):
+        platforms = {sp['name']: sp for sp in sp_list}
+        members = self._members.setdefault(platform_type, set())
+        heap = self._heaps.setdefault(platform_type, [])
+        for sp_name in platforms:
+            if sp_name not in members:
+                members.add(sp_name)
+                heapq.heappush(heap, self._entry(sp_name))
+        skipped = []
+        while True:
+            score, _, sp_name, version = heap[0]
+            if version != self._versions.get(sp_name, 0):
+                heapq.heappop(heap)
+            elif sp_name not in platforms:
+                skipped.append(heapq.heappop(heap))
+            else:
+                break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        self._selected(sp_name)
+        self._changed(sp_name)
+        return platforms[sp_name]
+
+    def _entry(self, sp_name):
+        return [self.score(sp_name), next(self._counter), sp_name, self._versions.get(sp_name, 0)]
+
+    def _changed(self, sp_name):
+        self._versions[sp_name] = self._versions.get(sp_name, 0) + 1
+        for platform_type, members in self._members.items():
+            if sp_name in members:
+                heap = self._heaps[platform_type]
+                heapq.heappush(heap, self._entry(sp_name))
+                if len(heap) > 4 * len(members) + 16:
+                    # Too many stale entries buried in the heap
+                    heap[:] = [self._entry(member) for member in members]
+                    heapq.heapify(heap)
+
+
+class LeastInFlightBalancer(HeapBalancer):
+    """
+    Picks the platform with the fewest instances in flight
+    """
+    name = 'least_in_flight'
+
+    def score(self, sp_name):
+        return self.in_flight.get(sp_name, 0)
+
+
+class WeightedRoundRobinBalancer(HeapBalancer):
+    """
+    Stride scheduling: each pick advances the virtual time of the platform
+    by 1/weight, the platform with the lowest virtual time goes next, so
+    platforms are picked in proportion to their weight. Weights come from
+    CURATOR_LB_WEIGHTS ('sp1=3,sp2=1') or the 'weight' of the platform, 1 by
+    default (plain round robin).
+    """
+    name = 'weighted_round_robin'
+
+    def __init__(self, weights=None, cooldown=None):
+        HeapBalancer.__init__(self, cooldown=cooldown)
+        self.weights = weights if weights is not None else parse_limits(os.getenv('CURATOR_LB_WEIGHTS', ''))
+        self._virtual_time = {}
+        self._clock = 0
+
+    def score(self, sp_name):
+        return self._virtual_time.get(sp_name, 0)
+
+    def _select(self, platform_type, sp_list):
+        for sp in sp_list:
+            if sp['name'].lower() not in self.weights and sp.get('weight'):
+                self.weights[sp['name'].lower()] = sp['weight']
+        return HeapBalancer._select(self, platform_type, sp_list)
+
+    def _selected(self, sp_name):
+        weight = max(self.weights.get(sp_name.lower(), 1), 1e-3)
+        # The pick has the lowest virtual time, which is the current time of the schedule.
+        # A platform joining late starts from the current time, not from 0
+        start = max(self._virtual_time.get(sp_name, 0), self._clock)
+        self._clock = start
+        self._virtual_time[sp_name] = start + 1 / weight
+
+
+class EWMABalancer(HeapBalancer):
+    """
+    Picks the platform with the lowest expected wait: moving average of its
+    instantiation time times the instances in flight plus one. Platforms
+    without samples score 0, so they get tried
+    """
+    name = 'ewma'
+
+    def score(self, sp_name):
+        return self.latency.get(sp_name, 0) * (self.in_flight.get(sp_name, 0) + 1)
+
+
+BALANCERS = {
+    'first': LoadBalancer,
+    'random': RandomBalancer,
+    'round_robin': WeightedRoundRobinBalancer,
+    'weighted_round_robin': WeightedRoundRobinBalancer,
+    'least_in_flight': LeastInFlightBalancer,
+    'ewma': EWMABalancer,
+}
+
+
+def get_balancer(algorithm=None):
+    """
+    :param algorithm: one of BALANCERS, LB_ALGO by default
+    :return: LoadBalancer
+    """
+    algorithm = (algorithm or os.getenv('LB_ALGO', 'random')).lower()
+    if algorithm not in BALANCERS:
+        _LOG.warning(f'Unknown load balancer {algorithm}, using the first available platform')
+        algorithm = 'first'
+    return BALANCERS[algorithm]()
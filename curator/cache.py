@@ -0,0 +1,274 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+
+import os
+import copy
+import time
+import logging
+import threading
+from collections import OrderedDict
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:cache', log_level=logging.DEBUG, log_json=True)
+
+
+class CacheEntry:
+    __slots__ = ('value', 'etag', 'last_modified', 'expires_at')
+
+    def __init__(self, value, etag=None, last_modified=None, expires_at=0):
+        self.value = value
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    @property
+    def fresh(self):
+        return time.monotonic() < self.expires_at
+
+
+class DescriptorCache:
+    """
+    Size bounded LRU cache with a TTL per entry, for descriptors fetched from
+    the catalogue. Expired entries are kept (until evicted) with their ETag
+    and Last-Modified, so the caller can revalidate them with a conditional
+    GET instead of downloading them again.
+    Values are deep copied in and out, callers are free to modify them.
+    Configuration:
+        CURATOR_DESCRIPTOR_CACHE_SIZE: max entries (0 disables the cache)
+        CURATOR_DESCRIPTOR_CACHE_TTL: seconds an entry is used without revalidation
+    """
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = max_entries if max_entries is not None else \
+            int(os.getenv('CURATOR_DESCRIPTOR_CACHE_SIZE', 512))
+        self.ttl = ttl if ttl is not None else float(os.getenv('CURATOR_DESCRIPTOR_CACHE_TTL', 300))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({len(self._entries)}/{self.max_entries})'
+
+    def get(self, key):
+        """
+        :return: (value, None) on a fresh hit, (None, stale entry) if it must
+            be revalidated, (None, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self._entries.move_to_end(key)
+            if entry.fresh:
+                self.hits += 1
+                return copy.deepcopy(entry.value), None
+            self.misses += 1
+            return None, entry
+
+    def put(self, key, value, etag=None, last_modified=None):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = CacheEntry(copy.deepcopy(value), etag, last_modified, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def refresh(self, key):
+        """
+        Marks a stale entry as fresh again after a 304 Not Modified
+        :return: the cached value or None if it was evicted meanwhile
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry.expires_at = time.monotonic() + self.ttl
+            self.revalidated += 1
+            return copy.deepcopy(entry.value)
+
+    def invalidate(self, match=None):
+        """
+        :param match: drop only the keys containing this string, e.g. a descriptor uuid
+        :return: number of entries dropped
+        """
+        with self._lock:
+            keys = [key for key in self._entries if match is None or match in key]
+            for key in keys:
+                del self._entries[key]
+            self.invalidations += len(keys)
+        _LOG.debug(f'Invalidated {len(keys)} cached descriptors (match={match})')
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+class PackageIndex:
+    """
+    Local index of the catalogue package inventory keyed by the
+    (vendor, name, version) of the NSDs each package contains, so that finding
+    the package of a network service is a dictionary lookup.
+    The inventory is streamed by the loader and refreshed at most every ttl
+    seconds. A refresh sends the previous ETag, and only the packages that are
+    new or whose updated_at changed are re-indexed. A lookup that finds nothing
+    forces a refresh, at most every min_refresh seconds, in case the package was
+    just uploaded.
+    Configuration:
+        CURATOR_PACKAGE_INDEX_TTL, CURATOR_PACKAGE_INDEX_MIN_REFRESH: seconds
+    """
+    NSD_CONTENT_TYPE = 'application/vnd.5gtango.nsd'
+
+    def __init__(self, loader, ttl=None, min_refresh=None):
+        """
+        :param loader: callable(etag) returning (iterable of packages or None if not modified, etag)
+        """
+        self.loader = loader
+        self.ttl = ttl if ttl is not None else float(os.getenv('CURATOR_PACKAGE_INDEX_TTL', 60))
+        self.min_refresh = min_refresh if min_refresh is not None else \
+            float(os.getenv('CURATOR_PACKAGE_INDEX_MIN_REFRESH', 5))
+        self._by_nsd = {}
+        self._packages = {}
+        self._stamps = {}
+        self._etag = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.refreshes = 0
+        self.not_modified = 0
+        self.parsed = 0
+        self.reindexed = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({len(self._packages)} packages)'
+
+    def lookup(self, vendor, name, version):
+        """
+        :return: list of {'uuid', 'pd'} of the packages containing the NSD
+        """
+        key = (vendor, name, version)
+        self.lookups += 1
+        if not self._age_below(self.ttl):
+            self.refresh()
+        packages = self._get(key)
+        if not packages and not self._age_below(self.min_refresh):
+            self.misses += 1
+            self.refresh(force=True)
+            packages = self._get(key)
+        return packages
+
+    def refresh(self, force=False):
+        with self._refresh_lock:
+            if self._age_below(self.min_refresh if force else self.ttl):
+                # Refreshed by another thread while this one was waiting
+                return
+            packages, etag = self.loader(self._etag)
+            self.refreshes += 1
+            if packages is None:
+                self.not_modified += 1
+                self._refreshed_at = time.monotonic()
+                return
+            seen = set()
+            for package in packages:
+                self.parsed += 1
+                package_uuid = package.get('uuid')
+                seen.add(package_uuid)
+                stamp = package.get('updated_at')
+                if stamp is not None and self._stamps.get(package_uuid) == stamp:
+                    continue
+                self._index(package_uuid, stamp, package)
+            with self._lock:
+                for package_uuid in set(self._stamps) - seen:
+                    self._remove(package_uuid)
+                    del self._stamps[package_uuid]
+            self._etag = etag
+            self._refreshed_at = time.monotonic()
+            _LOG.debug(f'Package index refreshed, {len(self._packages)} packages with NSDs')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ttl': self.ttl,
+                'packages': len(self._packages),
+                'nsds': len(self._by_nsd),
+                'lookups': self.lookups,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'not_modified': self.not_modified,
+                'parsed': self.parsed,
+                'reindexed': self.reindexed
+            }
+
+    def _age_below(self, seconds):
+        return self._refreshed_at is not None and time.monotonic() - self._refreshed_at < seconds
+
+    def _get(self, key):
+        with self._lock:
+            return [copy.deepcopy(self._packages[package_uuid][1]) for package_uuid in self._by_nsd.get(key, ())]
+
+    def _index(self, package_uuid, stamp, package):
+        pd = package.get('pd') or {}
+        keys = [
+            (content['id']['vendor'], content['id']['name'], content['id']['version'])
+            for content in pd.get('package_content') or []
+            if content.get('content-type') == self.NSD_CONTENT_TYPE and content.get('id')
+        ]
+        with self._lock:
+            self._remove(package_uuid)
+            self._stamps[package_uuid] = stamp
+            if keys:
+                # Only what the lookups return is kept
+                self._packages[package_uuid] = (keys, {'uuid': package_uuid, 'pd': pd})
+                for key in keys:
+                    self._by_nsd.setdefault(key, set()).add(package_uuid)
+            self.reindexed += 1
+
+    def _remove(self, package_uuid):
+        keys, _ = self._packages.pop(package_uuid, ((), None))
+        for key in keys:
+            self._by_nsd[key].discard(package_uuid)
+            if not self._by_nsd[key]:
+                del self._by_nsd[key]
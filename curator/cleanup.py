@@ -0,0 +1,182 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import wait
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:cleanup', log_level=logging.DEBUG, log_json=True)
+
+
+class CleanupQueue:
+    """
+    Tears down the environment of finished tests. Service instance
+    terminations are queued on a bounded worker pool, and network prunes
+    asked for the same docker host within debounce seconds are coalesced
+    into a single prune, never running two prunes on a host at once.
+    Configuration:
+        CURATOR_PRUNE_DEBOUNCE: seconds a prune waits for others to join it
+    """
+    def __init__(self, submit, connect, release, debounce=None):
+        """
+        :param submit: submit(fn, *args) returning a future
+        :param connect: connect(execution_host) returning a DockerInterface
+        :param release: release(dockeri) once done with it
+        """
+        self.submit = submit
+        self.connect = connect
+        self.release = release
+        self.debounce = debounce if debounce is not None else float(os.getenv('CURATOR_PRUNE_DEBOUNCE', 10))
+        self._terminations = {}
+        self._prunes = {}
+        self._pruning = set()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self.terminated = 0
+        self.termination_failures = 0
+        self.prunes_requested = 0
+        self.prunes_coalesced = 0
+        self.pruned = 0
+        self.prune_failures = 0
+        threading.Thread(target=self._run, name='curator-cleanup', daemon=True).start()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(backlog={self.backlog()})'
+
+    def terminate(self, owner, fn, *args):
+        """
+        Queues the termination of a service instance
+        :param owner: test plan uuid the instance belongs to
+        :param fn: fn(*args) terminating it
+        :return: future of fn
+        """
+        future = self.submit(fn, *args)
+        with self._lock:
+            self._terminations.setdefault(owner, set()).add(future)
+        future.add_done_callback(lambda f: self._terminated(owner, f))
+        return future
+
+    def drain(self, owner, timeout=None):
+        """
+        Waits for the queued terminations of a test plan
+        :return: True if none is left pending
+        """
+        with self._lock:
+            futures = list(self._terminations.get(owner, ()))
+        return not wait(futures, timeout=timeout).not_done
+
+    def prune(self, execution_host):
+        """
+        Asks for a network prune of a docker host, joining one already pending
+        :param execution_host: None for the default docker host
+        """
+        with self._cond:
+            self.prunes_requested += 1
+            if execution_host in self._prunes:
+                self.prunes_coalesced += 1
+                return
+            self._prunes[execution_host] = time.monotonic() + self.debounce
+            self._cond.notify()
+
+    def backlog(self):
+        with self._lock:
+            return sum(len(futures) for futures in self._terminations.values()) + len(self._prunes)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'debounce': self.debounce,
+                'terminations_pending': sum(len(futures) for futures in self._terminations.values()),
+                'prunes_pending': len(self._prunes),
+                'pruning': len(self._pruning),
+                'terminated': self.terminated,
+                'termination_failures': self.termination_failures,
+                'prunes_requested': self.prunes_requested,
+                'prunes_coalesced': self.prunes_coalesced,
+                'pruned': self.pruned,
+                'prune_failures': self.prune_failures
+            }
+
+    def _terminated(self, owner, future):
+        with self._lock:
+            futures = self._terminations.get(owner)
+            if futures is not None:
+                futures.discard(future)
+                if not futures:
+                    del self._terminations[owner]
+            if future.cancelled() or future.exception() is not None:
+                self.termination_failures += 1
+            else:
+                self.terminated += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    ready = [host for host, due in self._prunes.items() if due <= now and host not in self._pruning]
+                    if ready:
+                        break
+                    waiting = [due for host, due in self._prunes.items() if host not in self._pruning]
+                    self._cond.wait(timeout=max(min(waiting) - now, 0) if waiting else None)
+                for host in ready:
+                    del self._prunes[host]
+                    self._pruning.add(host)
+            for host in ready:
+                try:
+                    self.submit(self._prune, host)
+                except Exception as e:
+                    _LOG.error(f'Could not schedule network prune of {host or "default docker host"}: {e}')
+                    self._pruned(host, False)
+
+    def _prune(self, execution_host):
+        succeeded = False
+        try:
+            dockeri = self.connect(execution_host)
+            try:
+                dockeri.network_prune()
+                succeeded = True
+            finally:
+                self.release(dockeri)
+        except Exception as e:
+            _LOG.error(f'Failed network prune of {execution_host or "default docker host"}, reason: {e}')
+        finally:
+            self._pruned(execution_host, succeeded)
+
+    def _pruned(self, execution_host, succeeded):
+        with self._cond:
+            self._pruning.discard(execution_host)
+            if succeeded:
+                self.pruned += 1
+            else:
+                self.prune_failures += 1
+            # A prune asked for meanwhile may be due already
+            self._cond.notify()
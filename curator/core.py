@@ -33,13 +33,24 @@ import logging
 import requests
 from datetime import datetime
 from time import strftime
-from curator.database import context
-from threading import Thread, Event
+from curator.database import context, index, persist, drop_test_plan, get_state_store
+from curator.models import TestPlan, AugmentedDescriptor, TestResult, TestStatus
 import uuid
 from curator.interfaces.vnv_components_interface import PlannerInterface, ExecutorInterface, PlatformAdapterInterface
 from curator.interfaces.common_databases_interface import CatalogueInterface
-from curator.interfaces.docker_interface import DockerInterface
-from curator.helpers import process_test_plan, cancel_test_plan, clean_environment
+from curator.interfaces.docker_interface import DockerInterface, DockerClientPool
+from curator.interfaces.interface import transport_stats, close_transports
+from curator.helpers import run_test_plan, cancel_test_plan, cancel_queued_test_plan, clean_environment, \
+    recover_test_plans, terminate_orphan_instance, terminate_warm_instance, is_idle
+from curator.scheduler import Scheduler, ADMISSION, CLEANUP, CANCELLATION, PULLS, TEARDOWN
+from curator.timers import DeadlineService
+from curator.admission import AdmissionController, platform_type_hint
+from curator.balancer import get_balancer
+from curator.quotas import PlatformQuotas
+from curator.probes import ProbePuller, ProbeImageCache, ProbePrewarmer
+from curator.cleanup import CleanupQueue
+from curator.instances import InstancePool
+from queue import Full
 import time
 from curator.util import CustomEncoder
 from curator.logger import TangoLogger
@@ -73,6 +84,7 @@ ACCEPTED = 202
 BAD_REQUEST = 400
 NOT_FOUND = 404
 NOT_ACCEPTABLE = 406
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
 
 
@@ -105,7 +117,9 @@ def list_routes():
         'test_cancelled': 'Callback to allow Executor to notify the Curator that <test_uuid> cancellation finished,'
                           ' or that there was an error during cancellation or execution',
         'test_in_execution': 'Callback to allow Executor to notify the Curator that a test is running',
-        'test_plan_cancelled': 'Callback to allow Planner to cancel a running Test Plan'
+        'test_plan_cancelled': 'Callback to allow Planner to cancel a running Test Plan',
+        'get_metrics': 'Get internal metrics of the module (worker pools, queues, deadlines, http pools, caches)',
+        'invalidate_descriptor_cache': 'Drop cached catalogue descriptors, optionally only those matching ?match='
     }
     route_output = [
         {
@@ -126,10 +140,9 @@ def handle_new_test_plan():
     :return:
     """
     if request.method == 'GET':
-        response_list = [context['test_preparations'][testplan] for testplan in context['test_preparations'].keys()]
+        response_list = [testplan.to_dict() for testplan in list(context['test_preparations'].values())]
         for testplan in response_list:
-            if 'docker_interface' in testplan.keys():
-                testplan['docker_interface'] = str(testplan['docker_interface'])
+            testplan['queue_position'] = context['admission'].position(testplan['test_plan_uuid'])
         return make_response(
             # json.dumps({k: str(context['test_preparations'][k]) for k in context['test_preparations'].keys()}),
             # json.dumps(context['test_preparations'], cls=CustomEncoder),
@@ -178,7 +191,7 @@ def handle_new_test_plan():
                 # required_keys = {'test_descriptor', 'network_service_descriptor', 'paths'}
                 # if payload.keys() is not None and all(key in payload.keys() for key in required_keys):
                 if new_uuid not in context['test_preparations']:
-                    context['test_preparations'][new_uuid] = payload  # Should have
+                    context['test_preparations'][new_uuid] = TestPlan.from_payload(new_uuid, payload)
                 else:
                     msg = f'test-plan ({new_uuid}) exists, aborting'
                     # app.logger.error(msg)
@@ -188,11 +201,27 @@ def handle_new_test_plan():
                         BAD_REQUEST,
                         {'Content-Type': 'application/json'})
                 create_time = datetime.utcnow().replace(microsecond=0)
-                context['test_preparations'][new_uuid]['created_at'] = create_time
-                context['test_preparations'][new_uuid]['updated_at'] = create_time
-                process_thread = Thread(target=process_test_plan, args=(new_uuid,))
-                process_thread.start()
-                context['threads'].append(process_thread)
+                context['test_preparations'][new_uuid].created_at = create_time
+                context['test_preparations'][new_uuid].updated_at = create_time
+                persist(new_uuid)
+                try:
+                    position = context['admission'].submit(
+                        new_uuid,
+                        platform_type=platform_type_hint(payload),
+                        priority=context['test_preparations'][new_uuid].priority
+                    )
+                except Full as e:
+                    drop_test_plan(new_uuid)
+                    _LOG.warning(f'Rejecting test plan #{new_uuid}: {e}')
+                    return make_response(
+                        json.dumps({'exception': str(e), 'status': 'ERROR'}),
+                        TOO_MANY_REQUESTS,
+                        {'Content-Type': 'application/json',
+                         'Retry-After': str(context['admission'].retry_after)})
+                if position:
+                    return make_response(
+                        json.dumps({'test_plan_uuid': new_uuid, 'status': 'QUEUED', 'queue_position': position}),
+                        CREATED, {'Content-Type': 'application/json'})
                 return make_response(json.dumps({'test_plan_uuid': new_uuid, 'status': 'STARTING'}),
                                      CREATED, {'Content-Type': 'application/json'})
                 # else:
@@ -215,8 +244,16 @@ def test_plan_cancelled(test_plan_uuid):
     if request.method == 'GET':
         # single test_plan status
         # TODO: Update function name and description to avoid misunderstanding
+        if test_plan_uuid not in context['test_preparations']:
+            return make_response(
+                f'{{"exception": "Test plan #{test_plan_uuid} was not found", "status": "ERROR"}}',
+                NOT_FOUND,
+                {'Content-Type': 'application/json'}
+            )
+        test_plan = context['test_preparations'][test_plan_uuid].to_dict()
+        test_plan['queue_position'] = context['admission'].position(test_plan_uuid)
         return make_response(
-            json.dumps(context['test_preparations'][test_plan_uuid]),
+            json.dumps(test_plan),
             OK,
             {'Content-Type': 'application/json'}
         )
@@ -229,10 +266,11 @@ def test_plan_cancelled(test_plan_uuid):
                 NOT_FOUND,
                 {'Content-Type': 'application/json'}
             )
-        context['test_preparations'][test_plan_uuid]['updated_at'] = datetime.utcnow().replace(microsecond=0)
-        process_thread = Thread(target=cancel_test_plan, args=(test_plan_uuid, ))
-        process_thread.start()
-        context['threads'].append(process_thread)
+        context['test_preparations'][test_plan_uuid].touch()
+        if context['admission'].remove(test_plan_uuid):
+            context['scheduler'].submit(CANCELLATION, cancel_queued_test_plan, test_plan_uuid)
+        else:
+            context['scheduler'].submit(CANCELLATION, cancel_test_plan, test_plan_uuid)
         return make_response('{"error": null, "status": "CANCELLING"}', ACCEPTED, {'Content-Type': 'application/json'})
 
 
@@ -254,13 +292,21 @@ def prepare_environment_callback(test_plan_uuid, instance_name):
     try:
         payload = request.get_json()
         if not context['test_preparations'].get(test_plan_uuid):
-            make_response(
+            return make_response(
                 f'{{"error": "Test plan #{test_plan_uuid} has been cancelled or was not found"}}',
                 NOT_FOUND,
                 {'Content-Type': 'application/json'}
             )
+        if instance_name not in context['events'].get(test_plan_uuid, {}):
+            # Setup of this plan timed out or was interrupted by a restart, nobody waits for the instance
+            test_plan = context['test_preparations'][test_plan_uuid]
+            if payload.get('ns_instance_uuid') and \
+                    (instance_name in test_plan.instances or instance_name in test_plan.abandoned):
+                context['scheduler'].submit(CLEANUP, terminate_orphan_instance,
+                                            test_plan_uuid, instance_name, payload['ns_instance_uuid'])
+            return make_response('{"error": null}', OK, {'Content-Type': 'application/json'})
 
-        context['test_preparations'][test_plan_uuid]['updated_at'] = datetime.utcnow().replace(microsecond=0)
+        context['test_preparations'][test_plan_uuid].touch()
         # payload = json.loads(request.get_data().decode("UTF-8"))
         _LOG.debug(f'Callback received, contains {payload}')
         # app.logger.debug(f'Callback received, contains {payload}')
@@ -268,40 +314,25 @@ def prepare_environment_callback(test_plan_uuid, instance_name):
         if all(key in payload.keys() for key in required_keys) and 'error' not in payload.keys():
             # FIXME: Check which entry contains the corresponding type of platform (with nsi_name)
             # FIXME: or ask it in the callback
-            context['test_preparations'][test_plan_uuid]['augmented_descriptors'].append(
-                {
-                    'nsi_uuid': payload['ns_instance_uuid'],
-                    'nsi_name': instance_name,
-                    'functions': payload['functions'],
-                    'platform': {'platform_type': payload['platform_type']},
-                    'error': None
-                }
+            index.add_descriptor(
+                test_plan_uuid,
+                AugmentedDescriptor(
+                    instance_name,
+                    nsi_uuid=payload['ns_instance_uuid'],
+                    functions=payload['functions'],
+                    platform_type=payload['platform_type']
+                )
             )
+            persist(test_plan_uuid)
             context['events'][test_plan_uuid][instance_name].set()  # Unlocks thread
             return make_response('{"error": null}', OK,{'Content-Type': 'application/json'})
         elif 'error' in payload.keys():
-            context['test_preparations'][test_plan_uuid]['augmented_descriptors'].append(
-                {
-                    'nsi_uuid': None,
-                    'platform': {'platform_type': 'unknown'},
-                    'functions': None,
-                    'nsi_name': instance_name,
-                    'error': payload['error']
-                }
-            )
+            index.add_descriptor(test_plan_uuid, AugmentedDescriptor(instance_name, error=payload['error']))
             context['events'][test_plan_uuid][instance_name].set()
             return make_response('{"error": null}', OK, {'Content-Type': 'application/json'})
         else:
             # TODO abort test, reason nsi
-            context['test_preparations'][test_plan_uuid]['augmented_descriptors'].append(
-                {
-                    'nsi_uuid': None,
-                    'platform': {'platform_type': 'unknown'},
-                    'functions': None,
-                    'nsi_name': instance_name,
-                    'error': 'Unknown error'
-                }
-            )
+            index.add_descriptor(test_plan_uuid, AugmentedDescriptor(instance_name, error='Unknown error'))
             context['events'][test_plan_uuid][instance_name].set()
             return make_response(
                 json.dumps({'error': 'Keys {required_keys} required in payload'}),
@@ -329,14 +360,16 @@ def test_in_execution(test_plan_uuid):
                      f'Content-type: {request.headers["Content-type"]}')
     try:
         executor_payload = request.get_json()
-        context['test_preparations'][test_plan_uuid]['updated_at'] = datetime.utcnow().replace(microsecond=0)
-        test_index = next(
-            (index for (index, d) in
-                enumerate(context['test_preparations'][test_plan_uuid]['augmented_descriptors'])
-                if d['test_uuid'] == executor_payload['test_uuid']), None)
-        (context['test_preparations'][test_plan_uuid]['augmented_descriptors']
-            [test_index]['test_status']) = executor_payload['status'] if 'status' in executor_payload.keys() \
-            else 'RUNNING'
+        context['test_preparations'][test_plan_uuid].touch()
+        test_entry = index.by_test(executor_payload['test_uuid'])
+        if not test_entry or test_entry[0] != test_plan_uuid:
+            return make_response(
+                json.dumps({'exception': f'Test #{executor_payload["test_uuid"]} not found in test plan '
+                                         f'#{test_plan_uuid}'}),
+                NOT_FOUND,
+                {'Content-Type': 'application/json'})
+        test_entry[1].test_status = TestStatus(executor_payload.get('status') or 'RUNNING')
+        persist(test_plan_uuid)
         return make_response('{}', OK, {'Content-Type': 'application/json'})
     except Exception as e:
         return make_response(json.dumps({'exception': e.args}), INTERNAL_ERROR, {'Content-Type': 'application/json'})
@@ -351,10 +384,15 @@ def test_finished(test_plan_uuid, test_uuid):
         #                  f'Content-type: {request.headers["Content-type"]}')
         _LOG.debug(f'Callback received {request.path}, contains {request.get_data()}, '
                          f'Content-type: {request.headers["Content-type"]}')
-        context['test_preparations'][test_plan_uuid]['updated_at'] = datetime.utcnow().replace(microsecond=0)
-        process_thread = Thread(target=clean_environment, args=(test_plan_uuid, test_uuid, request.get_json(),))
-        process_thread.start()
-        context['threads'].append(process_thread)
+        test_entry = index.by_test(test_uuid)
+        if not test_entry or test_entry[0] != test_plan_uuid:
+            return make_response(
+                json.dumps({'exception': f'Test #{test_uuid} not found in test plan #{test_plan_uuid}',
+                            'status': 'ERROR'}),
+                NOT_FOUND,
+                {'Content-Type': 'application/json'})
+        context['test_preparations'][test_plan_uuid].touch()
+        context['scheduler'].submit(CLEANUP, clean_environment, test_plan_uuid, test_uuid, request.get_json())
     except Exception as e:
         tb = "".join(traceback.format_exc().split("\n"))
         # app.logger.error(f'Error in test_finished callback: {tb}')
@@ -380,12 +418,13 @@ def test_cancelled(test_plan_uuid, test_uuid):
                 NOT_FOUND,
                 {'Content-Type': 'application/json'}
             )
-        context['test_preparations'][test_plan_uuid]['updated_at'] = datetime.utcnow().replace(microsecond=0)
+        context['test_preparations'][test_plan_uuid].touch()
         if payload['status'] != 'ERROR':
             # app.logger.debug(f'Test #{test_uuid} cancellation was correct on executor')
             _LOG.debug(f'Test #{test_uuid} cancellation was correct on executor')
-            context['test_preparations'][test_plan_uuid]['updated_at'] = datetime.utcnow().replace(microsecond=0)
-            context['test_preparations'][test_plan_uuid]['test_results'].append(payload)
+            context['test_preparations'][test_plan_uuid].touch()
+            index.add_result(test_plan_uuid, TestResult.from_dict(payload, test_uuid=test_uuid))
+            persist(test_plan_uuid)
             if test_uuid in context['events'][test_plan_uuid]:
                 # app.logger.warning(f'Resuming test {test_uuid} cancelation process')
                 _LOG.warning(f'Resuming test {test_uuid} cancellation process')
@@ -396,15 +435,9 @@ def test_cancelled(test_plan_uuid, test_uuid):
         else:
             # app.logger.debug(f'Executor reported some error while cancelling test #{test_uuid}')
             _LOG.debug(f'Executor reported some error while executing or cancelling test #{test_uuid}, status={payload.get("status")}')
-            context['test_preparations'][test_plan_uuid]['updated_at'] = datetime.utcnow().replace(microsecond=0)
-            if test_uuid not in [result_entry['test_uuid']
-                                 for result_entry in context['test_preparations'][test_plan_uuid]['test_results']]:
-                context['test_preparations'][test_plan_uuid]['test_results'].append(payload)
-            else:
-                for idx, item in enumerate(context['test_preparations'][test_plan_uuid]['test_results']):
-                    if test_uuid == item['test_uuid']:
-                        context['test_preparations'][test_plan_uuid]['test_results'][idx] = payload
-                        break
+            context['test_preparations'][test_plan_uuid].touch()
+            index.add_result(test_plan_uuid, TestResult.from_dict(payload, test_uuid=test_uuid))
+            persist(test_plan_uuid)
 
             if test_uuid in context['events'][test_plan_uuid]:
                 context['events'][test_plan_uuid][test_uuid].set()
@@ -417,9 +450,7 @@ def test_cancelled(test_plan_uuid, test_uuid):
             else:
                 error = None
 
-            process_thread = Thread(target=clean_environment, args=(test_plan_uuid, test_uuid, payload, error))
-            process_thread.start()
-            context['threads'].append(process_thread)
+            context['scheduler'].submit(CLEANUP, clean_environment, test_plan_uuid, test_uuid, payload, error)
     except Exception as e:
         tb = "".join(traceback.format_exc().split("\n"))
         # app.logger.error(f'Error in test_cancelled callback: {tb}')
@@ -450,6 +481,54 @@ def get_context():
     )
 
 
+@app.route('/'.join(['', API_ROOT, API_VERSION, 'metrics']), methods=['GET'])
+def get_metrics():
+    metrics = {
+        'scheduler': context['scheduler'].stats(),
+        'admission': context['admission'].stats(),
+        'timers': context['timers'].stats(),
+        'http': transport_stats(),
+        'descriptor_cache': context['plugins']['catalogue'].cache.stats(),
+        'package_index': context['plugins']['catalogue'].packages.stats(),
+        'platforms': context['plugins']['platform_adapter'].platforms.stats(),
+        'balancer': context['balancer'].stats(),
+        'rate_limits': context['plugins']['platform_adapter'].rate_limits.stats(),
+        'probe_pulls': context['pulls'].stats(),
+        'probe_images': context['images'].stats(),
+        'probe_prewarm': context['prewarm'].stats(),
+        'docker_clients': context['dockers'].stats(),
+        'cleanup': context['cleanup'].stats(),
+        'instances': context['instances'].stats(),
+        'quotas': context['quotas'].stats(),
+        'single_flight': {
+            'catalogue': context['plugins']['catalogue'].flights.stats(),
+            'platform_adapter': context['plugins']['platform_adapter'].flights.stats()
+        },
+        'state_store': context['store'].stats(),
+        'index': index.stats()
+    }
+    return make_response(
+        json.dumps(metrics),
+        OK,
+        {'Content-Type': 'application/json'}
+    )
+
+
+@app.route('/'.join(['', API_ROOT, API_VERSION, 'descriptor-cache']), methods=['DELETE'])
+def invalidate_descriptor_cache():
+    """
+    Drops cached catalogue descriptors, all of them or only those whose url
+    contains the 'match' query parameter (e.g. a descriptor uuid)
+    :return:
+    """
+    invalidated = context['plugins']['catalogue'].cache.invalidate(request.args.get('match'))
+    return make_response(
+        json.dumps({'invalidated': invalidated}),
+        OK,
+        {'Content-Type': 'application/json'}
+    )
+
+
 @app.route('/'.join(['', API_ROOT, API_VERSION, 'config', 'mock']), methods=['POST'])
 def configure_mock():
     payload = request.get_json()
@@ -531,8 +610,31 @@ def main():
         'docker': docker_iface
     }
     context['events'] = {}
-    context['threads'] = []
-    app.run(debug=False, host='0.0.0.0', port=context['host'].split(':')[1], threaded=True)
+    context['scheduler'] = Scheduler()
+    context['timers'] = DeadlineService()
+    context['balancer'] = get_balancer()
+    context['quotas'] = PlatformQuotas(reclaim=lambda sp_names: context['instances'].reclaim(sp_names))
+    context['pulls'] = ProbePuller(lambda fn, *args: context['scheduler'].submit(PULLS, fn, *args))
+    context['images'] = ProbeImageCache(context['pulls'])
+    context['dockers'] = DockerClientPool(docker_iface)
+    context['prewarm'] = ProbePrewarmer(context['images'], context['dockers'].acquire, context['dockers'].release,
+                                        is_idle)
+    context['cleanup'] = CleanupQueue(lambda fn, *args: context['scheduler'].submit(TEARDOWN, fn, *args),
+                                      context['dockers'].acquire, context['dockers'].release)
+    context['instances'] = InstancePool(
+        lambda warm: context['cleanup'].terminate(None, terminate_warm_instance, warm))
+    context['admission'] = AdmissionController(
+        dispatch=lambda test_plan_uuid: context['scheduler'].submit(ADMISSION, run_test_plan, test_plan_uuid))
+    context['store'] = get_state_store()
+    recover_test_plans()
+    try:
+        app.run(debug=False, host='0.0.0.0', port=context['host'].split(':')[1], threaded=True)
+    finally:
+        context['admission'].stop()
+        context['timers'].stop()
+        context['scheduler'].shutdown(wait=False)
+        context['store'].close()
+        close_transports()
 
 
 if __name__ == "__main__":
@@ -25,4 +25,353 @@
 # acknowledge the contributions of their colleagues of the 5GTANGO
 # partner consortium (www.5gtango.eu).
 
+import os
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from curator.util import CustomEncoder
+from curator.models import TestPlan
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:database', log_level=logging.DEBUG, log_json=True)
+
 context = dict()
+
+
+def serialize_test_plan(test_plan):
+    d = test_plan.to_dict()
+    d.pop('docker_interface', None)  # live object, makes no sense after a restart
+    return json.dumps(d, cls=CustomEncoder)
+
+
+def deserialize_test_plan(raw):
+    return TestPlan.from_dict(json.loads(raw))
+
+
+class StateStore:
+    """
+    Persistence backend for test plan state, the default one keeps nothing
+    """
+    def save(self, test_plan_uuid, test_plan):
+        pass
+
+    def delete(self, test_plan_uuid):
+        pass
+
+    def load_all(self):
+        return {}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.__class__.__name__}
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Embedded SQLite (WAL mode) state store with write-behind persistence.
+    save() and delete() only mark a plan as changed, a writer thread
+    serializes the changed plans and writes them in a single transaction every
+    flush_interval seconds, so successive transitions of the same plan within
+    that window cost a single serialization and row write, and none of them
+    is paid by the thread that made the transition.
+    """
+    def __init__(self, path, flush_interval=0.05):
+        self.path = path
+        self.flush_interval = flush_interval
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS test_plans '
+                           '(uuid TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)')
+        self._conn.commit()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = True
+        self.writes = 0
+        self.batches = 0
+        self.coalesced = 0
+        self._writer = threading.Thread(target=self._write_loop, name='curator-state-writer', daemon=True)
+        self._writer.start()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.path})'
+
+    def save(self, test_plan_uuid, test_plan):
+        with self._lock:
+            if test_plan_uuid in self._pending:
+                self.coalesced += 1
+            self._pending[test_plan_uuid] = test_plan
+
+    def delete(self, test_plan_uuid):
+        with self._lock:
+            if test_plan_uuid in self._pending:
+                self.coalesced += 1
+            self._pending[test_plan_uuid] = None
+
+    def load_all(self):
+        self.flush()
+        with self._db_lock:
+            rows = self._conn.execute('SELECT uuid, state FROM test_plans').fetchall()
+        test_plans = {}
+        for test_plan_uuid, state in rows:
+            try:
+                test_plans[test_plan_uuid] = deserialize_test_plan(state)
+            except (ValueError, KeyError) as e:
+                _LOG.error(f'Discarding unreadable state of test plan {test_plan_uuid}: {e}')
+        return test_plans
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        now = datetime.utcnow().timestamp()
+        upserts = []
+        for test_plan_uuid, test_plan in batch.items():
+            if test_plan is None:
+                continue
+            try:
+                upserts.append((test_plan_uuid, serialize_test_plan(test_plan), now))
+            except RuntimeError:
+                # Changed by another thread while it was serialized, written with the next batch
+                with self._lock:
+                    self._pending.setdefault(test_plan_uuid, test_plan)
+            except (TypeError, ValueError) as e:
+                _LOG.error(f'Could not persist test plan {test_plan_uuid}: {e}')
+        deletes = [(k,) for k, v in batch.items() if v is None]
+        with self._db_lock:
+            with self._conn:
+                if upserts:
+                    self._conn.executemany('INSERT OR REPLACE INTO test_plans (uuid, state, updated) '
+                                           'VALUES (?, ?, ?)', upserts)
+                if deletes:
+                    self._conn.executemany('DELETE FROM test_plans WHERE uuid = ?', deletes)
+        self.writes += len(upserts) + len(deletes)
+        self.batches += 1
+
+    def _write_loop(self):
+        while self._running:
+            self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                _LOG.error(f'Error persisting test plans state: {e}')
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        self._writer.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'backend': self.__class__.__name__,
+            'path': self.path,
+            'pending': pending,
+            'writes': self.writes,
+            'batches': self.batches,
+            'coalesced': self.coalesced
+        }
+
+
+class PlanIndex:
+    """
+    Secondary indexes over context['test_preparations'] so that callbacks can
+    find their target without scanning plans, descriptors or results:
+        test_uuid -> (test_plan_uuid, augmented descriptor)
+        (test_plan_uuid, instance_name) -> augmented descriptor (None until sp-ready)
+        nsi_uuid -> augmented descriptor
+        test_uuid -> position in the plan test_results
+    Instance names are only unique inside a test plan, hence the composite key.
+    Every mutation of the indexed structures has to go through this class.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._tests = {}
+        self._instances = {}
+        self._nsis = {}
+        self._results = {}
+        self._plan_keys = {}
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(tests={len(self._tests)}, instances={len(self._instances)})'
+
+    def _track(self, test_plan_uuid, kind, key):
+        self._plan_keys.setdefault(test_plan_uuid, set()).add((kind, key))
+
+    def add_instance(self, test_plan_uuid, instance_name):
+        with self._lock:
+            self._instances.setdefault((test_plan_uuid, instance_name), None)
+            self._track(test_plan_uuid, 'instance', (test_plan_uuid, instance_name))
+
+    def add_descriptor(self, test_plan_uuid, descriptor):
+        """
+        Appends an augmented descriptor to its plan and indexes it
+        """
+        with self._lock:
+            context['test_preparations'][test_plan_uuid].augmented_descriptors.append(descriptor)
+            self._index_descriptor(test_plan_uuid, descriptor)
+
+    def remove_descriptor(self, test_plan_uuid, descriptor):
+        """
+        Drops an augmented descriptor from its plan, e.g. of an instantiation that failed over
+        """
+        with self._lock:
+            context['test_preparations'][test_plan_uuid].augmented_descriptors.remove(descriptor)
+            if self._instances.get((test_plan_uuid, descriptor.nsi_name)) is descriptor:
+                self._instances[(test_plan_uuid, descriptor.nsi_name)] = None
+            if descriptor.nsi_uuid and self._nsis.get(descriptor.nsi_uuid) is descriptor:
+                del self._nsis[descriptor.nsi_uuid]
+
+    def _index_descriptor(self, test_plan_uuid, descriptor):
+        if descriptor.nsi_name:
+            self._instances[(test_plan_uuid, descriptor.nsi_name)] = descriptor
+            self._track(test_plan_uuid, 'instance', (test_plan_uuid, descriptor.nsi_name))
+        if descriptor.nsi_uuid:
+            self._nsis[descriptor.nsi_uuid] = descriptor
+            self._track(test_plan_uuid, 'nsi', descriptor.nsi_uuid)
+        if descriptor.test_uuid:
+            self._tests[descriptor.test_uuid] = (test_plan_uuid, descriptor)
+            self._track(test_plan_uuid, 'test', descriptor.test_uuid)
+
+    def set_test_uuid(self, test_plan_uuid, descriptor, test_uuid):
+        with self._lock:
+            descriptor.test_uuid = test_uuid
+            self._tests[test_uuid] = (test_plan_uuid, descriptor)
+            self._track(test_plan_uuid, 'test', test_uuid)
+
+    def add_result(self, test_plan_uuid, result):
+        """
+        Stores a TestResult in its plan, replacing a previous one of the same test
+        """
+        with self._lock:
+            results = context['test_preparations'][test_plan_uuid].test_results
+            test_uuid = result.test_uuid
+            position = self._results.get(test_uuid)
+            if position is not None and position[0] == test_plan_uuid:
+                results[position[1]] = result
+                return
+            results.append(result)
+            if test_uuid:
+                self._results[test_uuid] = (test_plan_uuid, len(results) - 1)
+                self._track(test_plan_uuid, 'result', test_uuid)
+
+    def by_test(self, test_uuid):
+        """
+        :return: (test_plan_uuid, augmented descriptor) or None
+        """
+        return self._tests.get(test_uuid)
+
+    def by_instance(self, test_plan_uuid, instance_name):
+        return self._instances.get((test_plan_uuid, instance_name))
+
+    def by_nsi(self, nsi_uuid):
+        return self._nsis.get(nsi_uuid)
+
+    def has_result(self, test_plan_uuid, test_uuid):
+        position = self._results.get(test_uuid)
+        return position is not None and position[0] == test_plan_uuid
+
+    def rebuild(self, test_plan_uuid):
+        """
+        Indexes a plan loaded as a whole, e.g. recovered from the state store
+        """
+        with self._lock:
+            self.remove_plan(test_plan_uuid)
+            test_plan = context['test_preparations'][test_plan_uuid]
+            for instance_name in test_plan.instances:
+                self.add_instance(test_plan_uuid, instance_name)
+            for descriptor in test_plan.augmented_descriptors or []:
+                self._index_descriptor(test_plan_uuid, descriptor)
+            for position, result in enumerate(test_plan.test_results):
+                if result.test_uuid:
+                    self._results[result.test_uuid] = (test_plan_uuid, position)
+                    self._track(test_plan_uuid, 'result', result.test_uuid)
+
+    def remove_plan(self, test_plan_uuid):
+        with self._lock:
+            indexes = {'test': self._tests, 'instance': self._instances, 'nsi': self._nsis, 'result': self._results}
+            for kind, key in self._plan_keys.pop(test_plan_uuid, ()):
+                indexes[kind].pop(key, None)
+
+    def stats(self):
+        return {
+            'plans': len(self._plan_keys),
+            'tests': len(self._tests),
+            'instances': len(self._instances),
+            'service_instances': len(self._nsis),
+            'results': len(self._results)
+        }
+
+
+index = PlanIndex()
+
+
+def get_state_store():
+    """
+    Builds the state store selected by CURATOR_STATE_BACKEND ('sqlite' or 'memory')
+    Configuration:
+        CURATOR_STATE_PATH: SQLite database file
+        CURATOR_STATE_FLUSH_INTERVAL: seconds between batches of the writer thread
+    :return: StateStore
+    """
+    backend = os.getenv('CURATOR_STATE_BACKEND', 'sqlite').lower()
+    if backend == 'sqlite':
+        return SQLiteStateStore(
+            os.getenv('CURATOR_STATE_PATH', '/var/lib/curator/state.db'),
+            flush_interval=float(os.getenv('CURATOR_STATE_FLUSH_INTERVAL', 0.05))
+        )
+    elif backend == 'memory':
+        return StateStore()
+    else:
+        raise ValueError(f'Unknown state backend {backend}')
+
+
+def persist(test_plan_uuid):
+    """
+    Records the current state of a test plan in the state store, or its
+    removal if it is no longer in the context
+    :param test_plan_uuid:
+    :return:
+    """
+    store = context.get('store')
+    if store is None:
+        return
+    test_plan = context['test_preparations'].get(test_plan_uuid)
+    try:
+        if test_plan is None:
+            store.delete(test_plan_uuid)
+        else:
+            store.save(test_plan_uuid, test_plan)
+    except (TypeError, ValueError, RuntimeError) as e:
+        _LOG.error(f'Could not persist test plan {test_plan_uuid}: {e}')
+
+
+def drop_test_plan(test_plan_uuid):
+    """
+    Removes a finished test plan from the context, its indexes and the state store
+    :param test_plan_uuid:
+    :return:
+    """
+    context['test_preparations'].pop(test_plan_uuid, None)
+    index.remove_plan(test_plan_uuid)
+    persist(test_plan_uuid)
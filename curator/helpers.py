@@ -25,17 +25,26 @@
 # acknowledge the contributions of their colleagues of the 5GTANGO
 # partner consortium (www.5gtango.eu).
 
+
 import time
 import requests
 import json
 import logging
 import threading
-import random
 import os
-from curator.database import context
+from curator.database import context, index, persist, drop_test_plan
+from curator.models import AugmentedDescriptor, ProbeRef, TestResult, TestStatus
+from curator.admission import platform_type_hint
+from curator.instances import WarmInstance, instance_key
+from curator.scheduler import CLEANUP, STAGES, TEARDOWN, ENVIRONMENTS
+from curator.timers import INSTANTIATION, EXECUTION, CANCELLATION
+from curator.pipeline import PlanPipeline, StageError
+from curator.interfaces.resilience import ThrottledError
+import curator.pipeline as stages
+from queue import Full
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
 import curator.interfaces.vnv_components_interface as vnv_i
 import curator.interfaces.common_databases_interface as db_i
-import curator.interfaces.docker_interface as dock_i
 from time import sleep
 import traceback
 from curator.logger import TangoLogger
@@ -44,616 +53,641 @@ from curator.logger import TangoLogger
 _LOG = TangoLogger.getLogger('curator:backend', log_level=logging.DEBUG, log_json=True)
 # _LOG = logging.getLogger('flask.app')
 
+# Service platforms a test plan runs on at once, when it does not name them (0 = all available)
+FANOUT_PLATFORMS = int(os.getenv('CURATOR_FANOUT_PLATFORMS', 1))
+# Instantiation retries on another platform of the same type, and the seconds they may take in total
+FAILOVER_ATTEMPTS = int(os.getenv('CURATOR_FAILOVER_ATTEMPTS', 2))
+FAILOVER_BUDGET = float(os.getenv('CURATOR_FAILOVER_BUDGET', 1800))
+
+# Plans whose last test is being wrapped up, see claim_completion()
+_completing = set()
+_completing_lock = threading.Lock()
+
+
+def run_test_plan(test_plan_uuid):
+    """
+    Entry point for test plans dispatched by the admission controller. The
+    admission slot is released here unless tests were left running, in which
+    case clean_environment or cancel_test_plan release it when they finish.
+    A plan cancelled during its setup is wrapped up here once the setup unwound
+    :param test_plan_uuid:
+    :return:
+    """
+    with _completing_lock:
+        test_plan = context['test_preparations'].get(test_plan_uuid)
+        if not test_plan:
+            _LOG.info(f'Test plan {test_plan_uuid} was cancelled before its setup started')
+            return
+        test_plan.setting_up = True
+    try:
+        process_test_plan(test_plan_uuid)
+    finally:
+        with _completing_lock:
+            test_plan.setting_up = False
+        if test_plan.cancelled:
+            cancel_test_plan(test_plan_uuid)
+            return
+        test_plan = context['test_preparations'].get(test_plan_uuid)
+        if not test_plan or not test_plan.active_tests():
+            context['admission'].release(test_plan_uuid)
+            if test_plan and test_plan.abandoned:
+                # Outcome has already been reported to the planner, nothing to recover, but the
+                # plan stays until the late sp-ready callbacks of its timed out instances arrive
+                context['store'].delete(test_plan_uuid)
+            else:
+                drop_test_plan(test_plan_uuid)
+
+
+def cancel_queued_test_plan(test_plan_uuid):
+    """
+    Cancels a test plan still waiting for admission, nothing was deployed yet
+    :param test_plan_uuid:
+    :return:
+    """
+    _LOG.info(f'Canceling queued test-plan {test_plan_uuid} by planner request')
+    planner = context['plugins']['planner']
+    callback_path = context['test_preparations'][test_plan_uuid].callback_path
+    drop_test_plan(test_plan_uuid)
+    planner_resp = planner.send_callback(callback_path, test_plan_uuid, [], status='CANCELLED')
+    _LOG.debug(f'Response from planner: {planner_resp}')
+
 
 def process_test_plan(test_plan_uuid):
+    """
+    Sets up the test environments of a test plan and dispatches its tests,
+    reporting to the planner any error that prevents it
+    :param test_plan_uuid:
+    :return:
+    """
     _LOG.info(f'Processing {test_plan_uuid}')
     # test_plan contains NSD and TD
-    context['test_preparations'][test_plan_uuid]['augmented_descriptors'] = []
-    context['test_preparations'][test_plan_uuid]['test_results'] = []
+    test_plan = context['test_preparations'][test_plan_uuid]
+    test_plan.augmented_descriptors = []
+    test_plan.test_results = []
     context['events'][test_plan_uuid] = {}
+    persist(test_plan_uuid)
     planner = context['plugins']['planner']
-    execution_host = context['test_preparations'][test_plan_uuid].get('execution_host')
-    err_msg = None
+    callback_path = test_plan.callback_path
+    pipeline = PlanPipeline(test_plan, lambda fn, *args: context['scheduler'].submit(STAGES, fn, *args))
     try:
-        if not execution_host:
-            dockeri = context['plugins']['docker']
-        else:
-            dockeri = dock_i.DockerInterface(execution_host=execution_host)
-            context['test_preparations'][test_plan_uuid]['docker_interface'] = dockeri
-    except Exception as e:
-        err_msg = f'Exception when connecting to execution host: {e}'
+        setup_test_plan(test_plan, pipeline)
+    except CancelledError:
+        _LOG.info(f'Test plan {test_plan_uuid} cancelled during its setup')
+        return
+    except StageError as e:
+        if test_plan.cancelled:
+            _LOG.info(f'Test plan {test_plan_uuid} cancelled during its setup: {e}')
+            return
+        err_msg = str(e)
         _LOG.error(err_msg)
-        callback_path = '/api/v1/test-plans/on-change/completed'
+        release_probes(test_plan)
+        release_execution_host(test_plan)
         planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
         return
 
-    # planner = vnv_i.PlannerInterface()
-    # planner.add_new_test_plan(test_plan_uuid)
-    platform_adapter = context['plugins']['platform_adapter']
-    executor = context['plugins']['executor']
-    vnv_cat = context['plugins']['catalogue']
-    load_balancer_algorithm = os.getenv('LB_ALGO','random')
-    err_msg = None
-    try:
-        callback_path = [
-            d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-            if d['status'] == 'COMPLETED'
-        ][0]
-    except AttributeError as e:
-        # _LOG.exception(e)
-        err_msg = f'Error reading callbacks: {e} but using /test-plans/on-change/completed'
-        _LOG.error(err_msg)
-        callback_path = '/api/v1/test-plans/on-change/completed'
-
-    if 'testd' in context['test_preparations'][test_plan_uuid]:
-        _LOG.warning('Overriding testd_uuid by testd')
-        td = context['test_preparations'][test_plan_uuid]['testd']
-        del context['test_preparations'][test_plan_uuid]['testd_uuid']
+    if test_plan.cancelled:
+        _LOG.info(f'Test plan {test_plan_uuid} cancelled during its setup')
+    elif all([test.test_status and test.test_status.is_final for test in test_plan.augmented_descriptors]):
+        release_probes(test_plan)
+        release_execution_host(test_plan)
+        planner.send_callback(callback_path, test_plan_uuid, result_list=test_plan.planner_results(),
+                              status='ERROR', exception=None)
     else:
+        _LOG.debug(f'Tests of test plan #{test_plan_uuid} dispatched, waiting for executor callbacks')
+
+
+def setup_test_plan(test_plan, pipeline):
+    """
+    Runs the setup stages of a test plan. The execution host and both
+    descriptors are resolved at the same time, then probe images are pulled
+    and catalogue references looked up while the platforms are selected and
+    the network service instantiated. The test descriptor instance is
+    generated and dispatched once all of them are done. A plan fanned out
+    to several platforms sets up one environment per platform at once, and
+    only fails if all of them do.
+    :param test_plan:
+    :param pipeline: PlanPipeline of the test plan
+    :return:
+    :raises StageError: with the error to report to the planner
+    :raises CancelledError: if the plan is cancelled while waiting for platform capacity
+    """
+    execution_host = pipeline.start(stages.EXECUTION_HOST, connect_execution_host, test_plan)
+    testd = pipeline.start(stages.TEST_DESCRIPTOR, resolve_test_descriptor, test_plan)
+    nsd = pipeline.start(stages.NETWORK_DESCRIPTOR, resolve_network_descriptor, test_plan)
+    dockeri = execution_host.result()
+    td = testd.result()
+    nsd_target, nsd = nsd.result()
+
+    platforms = td.get('service_platforms')  # should be a list not null
+    if not platforms:
+        raise StageError(f'"service_platforms" field in test descriptor is required, found {platforms}')
+    _LOG.debug(f'testd: {td}, nsd: {nsd}, nsd_target: {nsd_target}')
+    probes = pipeline.start(stages.PROBES, pull_probes, test_plan, td, dockeri)
+    references = pipeline.start(stages.REFERENCES, resolve_references, test_plan, td, nsd)
+
+    platform_type, service_platforms = pipeline.run(stages.PLATFORM, select_platforms, test_plan, platforms,
+                                                    nsd_target, nsd)
+    instances = [(register_instance(test_plan, td, nsd, service_platform), service_platform)
+                 for service_platform in service_platforms]
+    if probes.done() and probes.exception():
+        # Nothing requested yet, the environment would be unusable anyway
+        for instance_name, service_platform in instances:
+            release_instance(test_plan, instance_name)
+        probes.result()
+    if len(instances) == 1:
+        instance_name, service_platform = instances[0]
+        setup_environment(test_plan, pipeline, td, nsd, platform_type, service_platform, instance_name, probes,
+                          references)
+        return
+
+    # Environments wait for the probes and references stages, so they run on a pool of their
+    # own: on the stages pool they could take every worker those stages need
+    environments = []
+    for instance_name, service_platform in instances:
+        branch = pipeline.branch(service_platform['name'],
+                                 lambda fn, *args: context['scheduler'].submit(ENVIRONMENTS, fn, *args))
+        environments.append(branch.start(stages.ENVIRONMENT, setup_environment, test_plan, branch, td, nsd,
+                                         platform_type, service_platform, instance_name, probes, references))
+    errors = []
+    for (instance_name, service_platform), environment in zip(instances, environments):
         try:
-            raw_td = vnv_cat.get_test_descriptor(context['test_preparations'][test_plan_uuid]['testd_uuid'])
-            td = raw_td['testd']
+            environment.result()
         except Exception as e:
-            err_msg = f'Error when accesing TD: {e}'
-            _LOG.error(err_msg)
-            planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-            return
+            errors.append(e if isinstance(e, StageError) else StageError(f'{service_platform["name"]}: {e}'))
+            augd = index.by_instance(test_plan.uuid, getattr(e, 'instance_name', instance_name))
+            if augd:
+                augd.platform_name = service_platform['name']
+            else:
+                index.add_descriptor(test_plan.uuid, AugmentedDescriptor(
+                    instance_name, platform_name=service_platform['name'], error=str(e),
+                    test_status=TestStatus.ERROR))
+    if len(errors) == len(instances):
+        raise errors[0]
+    if errors:
+        _LOG.warning(f'Test plan {test_plan.uuid} runs on {len(instances) - len(errors)} of {len(instances)} '
+                     f'platforms, the others failed: {[str(e) for e in errors]}')
+
+
+def setup_environment(test_plan, pipeline, td, nsd, platform_type, service_platform, instance_name, probes,
+                      references):
+    """
+    Instantiates the network service on one platform and dispatches its test
+    :param pipeline: PlanPipeline, or its branch for the platform
+    :param probes: future of the probe pulls of the plan
+    :param references: future of the catalogue references of the plan
+    :return:
+    :raises StageError: if the test could not be dispatched
+    """
+    augd, inst_result, instantiation_time, service_platform, instance_name = instantiate_with_failover(
+        test_plan, pipeline, td, nsd, platform_type, service_platform, instance_name)
+    try:
+        probes.result()
+    except Exception as e:
+        _LOG.debug(f'Terminating {instance_name}, its probes are not available')
+        augd.test_status = TestStatus.ERROR
+        augd.error = str(e)
+        augd.platform_name = service_platform['name']
+        context['cleanup'].terminate(test_plan.uuid, terminate_instance, test_plan, augd)
+        if isinstance(e, StageError):
+            raise
+        raise StageError(f'Error getting probes: {e}') from e
+
+    try:
+        references.result()
+        test_descriptor_instance = pipeline.run(stages.TDI, generate_tdi, test_plan, td, nsd, augd, inst_result)
+        pipeline.run(stages.DISPATCH, dispatch_test, test_plan, augd, test_descriptor_instance, service_platform,
+                     instantiation_time)
+    except CancelledError:
+        # The cancellation terminates the instance
+        raise
+    except Exception as e:
+        tb = "".join(traceback.format_exc().split("\n"))
+        _LOG.error(f'Error during test execution: {tb}')
+        augd.test_status = TestStatus.ERROR
+        augd.error = tb
+        augd.platform_name = service_platform['name']
+        context['cleanup'].terminate(test_plan.uuid, terminate_instance, test_plan, augd)
+
+
+def instantiate_with_failover(test_plan, pipeline, td, nsd, platform_type, service_platform, instance_name):
+    """
+    Instantiates the network service, and if the platform fails to, retries
+    on the next best available platform of the same type, up to
+    FAILOVER_ATTEMPTS times within FAILOVER_BUDGET seconds. Plans naming
+    their platforms do not fail over.
+    :return: (augmented descriptor, PA response, instantiation time, service platform, instance name)
+    :raises StageError: with the instance_name of the last attempt
+    """
+    start = time.monotonic()
+    failed_platforms = []
+    while True:
+        try:
+            augd, inst_result, instantiation_time = pipeline.run(
+                stages.INSTANTIATION, instantiate_service, test_plan, platform_type, service_platform, nsd,
+                instance_name)
+            return augd, inst_result, instantiation_time, service_platform, instance_name
+        except StageError as e:
+            e.instance_name = instance_name
+            failed_platforms.append(service_platform['name'])
+            remaining = FAILOVER_BUDGET - (time.monotonic() - start)
+            if test_plan.sp_name or len(failed_platforms) > FAILOVER_ATTEMPTS or remaining <= 0 or \
+                    isinstance(e.__cause__, ThrottledError):
+                raise
+            # Platforms already used by the plan, e.g. by its other branches, are left out
+            in_use = set(test_plan.instances.values()) | set(failed_platforms)
+            sp_list = [sp for sp in context['plugins']['platform_adapter'].available_platforms_by_type(
+                platform_type.lower()) if sp['name'] not in in_use]
+            if not sp_list:
+                raise
+            alternate = context['quotas'].reserve(test_plan.uuid, platform_type.lower(), sp_list,
+                                                  context['balancer'].select, max_wait=remaining)
+            if not alternate:
+                raise
+            _LOG.warning(f'Instantiation of {instance_name} failed ({e}), failing over to {alternate["name"]}')
+            failed = index.by_instance(test_plan.uuid, instance_name)
+            if failed:
+                index.remove_descriptor(test_plan.uuid, failed)
+            service_platform = alternate
+            instance_name = register_instance(test_plan, td, nsd, service_platform)
+
+
+def connect_execution_host(test_plan):
+    """
+    :return: docker interface of the host where the probes run, shared with
+        the other plans using the host until release_execution_host()
+    """
+    if not test_plan.execution_host:
+        return context['plugins']['docker']
+    try:
+        test_plan.docker_interface = context['dockers'].acquire(test_plan.execution_host)
+    except Exception as e:
+        raise StageError(f'Exception when connecting to execution host: {e}')
+    return test_plan.docker_interface
 
-    # OPTIONAL: get sp_name if it is in the payload, None elsecase
-    sp_name = context['test_preparations'][test_plan_uuid].get('sp_name')
 
+def resolve_test_descriptor(test_plan):
+    """
+    :return: test descriptor, from the payload or the catalogue
+    """
+    if test_plan.testd:
+        _LOG.warning('Overriding testd_uuid by testd')
+        test_plan.testd_uuid = None
+        return test_plan.testd
+    try:
+        raw_td = context['plugins']['catalogue'].get_test_descriptor(test_plan.testd_uuid)
+        return raw_td['testd']
+    except Exception as e:
+        raise StageError(f'Error when accesing TD: {e}')
+
+
+def resolve_network_descriptor(test_plan):
+    """
+    :return: (nsd_target, nsd), nsd from the payload or the catalogue
+    """
     # NOTE: support for several nsds (same kind) -> NO
-    # for nsd in context['test_preparations'][test_plan_uuid]['nsd_batch']
     # FIXME: nsd doesn't have platform key
-    if 'nsd' in context['test_preparations'][test_plan_uuid] and \
-            context['test_preparations'][test_plan_uuid]['nsd']['platform'] == '5gtango':
+    if test_plan.nsd and test_plan.nsd['platform'] == '5gtango':
         _LOG.warning('Overriding nsd_uuid by nsd, nsd platform is 5gtango')
-        nsd = context['test_preparations'][test_plan_uuid]['nsd']
-        del context['test_preparations'][test_plan_uuid]['nsd_uuid']
-    elif 'nsd' in context['test_preparations'][test_plan_uuid] and \
-            context['test_preparations'][test_plan_uuid]['nsd']['platform'] == 'osm':
+        test_plan.nsd_uuid = None
+        return '5gtango', test_plan.nsd
+    elif test_plan.nsd and test_plan.nsd['platform'] == 'osm':
         _LOG.warning('Overriding nsd_uuid by nsd, nsd platform is osm')
-        nsd = context['test_preparations'][test_plan_uuid]["nsd"]["nsd:nsd-catalog"]["nsd"][0]
-        del context['test_preparations'][test_plan_uuid]['nsd_uuid']
-    else:
-        try:
-            raw_nsd = vnv_cat.get_network_descriptor(context['test_preparations'][test_plan_uuid]['nsd_uuid'])
-            if raw_nsd['platform'].lower() == '5gtango':
-                nsd_target = raw_nsd['platform'].lower()
-                nsd = raw_nsd['nsd']
-            elif raw_nsd['platform'].lower() == 'sonata':
-                nsd_target = raw_nsd['platform'].lower()
-                nsd = raw_nsd['nsd']
-            elif raw_nsd['platform'].lower() == 'osm':
-                nsd_target = raw_nsd['platform'].lower()
-                if type(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) is list and len(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) == 1:
-                    nsd = raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"][0]
-                elif type(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) is dict:
-                    nsd = raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]
-                elif type(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) is list and len(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) > 1:
-                    raise NotImplementedError('VnV is not compatible with multi-service network services')
-                else:
-                    raise ValueError('VnV is not compatible with this network service descriptor')
-        except Exception as e:
-            err_msg = f'Error when accesing NSD: {e}'
-            _LOG.error(err_msg)
-            planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-            return
-    platforms = td.get('service_platforms')  # should be a list not null
-    if not platforms:
-        err_msg = f'"service_platforms" field in test descriptor is required, found {platforms}'
-        _LOG.error(err_msg)
-        planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-        return
-    context['test_preparations'][test_plan_uuid]['probes'] = []
-    _LOG.debug(f'testd: {td}, nsd: {nsd}, nsd_target: {nsd_target}')
-    # TODO: get nsd and testd if only uuid is included (normal function) and avoid
-    # it if there's testd and/or nsd included in the payload
-    setup_phase = [phase for phase in td['phases'] if phase['id'] == 'setup'].pop()
-    configuration_action = [step for step in setup_phase['steps'] if step['action'] == 'configure'].pop()
+        test_plan.nsd_uuid = None
+        return 'osm', test_plan.nsd["nsd:nsd-catalog"]["nsd"][0]
+    try:
+        raw_nsd = context['plugins']['catalogue'].get_network_descriptor(test_plan.nsd_uuid)
+        nsd_target = raw_nsd['platform'].lower()
+        if nsd_target == '5gtango' or nsd_target == 'sonata':
+            return nsd_target, raw_nsd['nsd']
+        elif nsd_target == 'osm':
+            if type(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) is list and len(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) == 1:
+                return nsd_target, raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"][0]
+            elif type(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) is dict:
+                return nsd_target, raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]
+            elif type(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) is list and len(raw_nsd["nsd"]["nsd:nsd-catalog"]["nsd"]) > 1:
+                raise NotImplementedError('VnV is not compatible with multi-service network services')
+            else:
+                raise ValueError('VnV is not compatible with this network service descriptor')
+        else:
+            raise ValueError(f'VnV is not compatible with {raw_nsd["platform"]} network services')
+    except Exception as e:
+        raise StageError(f'Error when accesing NSD: {e}')
+
+
+def pull_probes(test_plan, td, dockeri):
+    """
+    Pulls the probe images of the test on the execution host, all at the
+    same time, within the pull budget of the plan
+    :raises StageError: with the last error if any probe is missing
+    """
+    test_plan.probes = []
+    err_msg = None
+    try:
+        setup_phase = [phase for phase in td['phases'] if phase['id'] == 'setup'].pop()
+        configuration_action = [step for step in setup_phase['steps'] if step['action'] == 'configure'].pop()
+        probes = configuration_action['probes']
+    except (KeyError, IndexError, TypeError) as e:
+        raise StageError(f'No probes found in the configure step of the test descriptor setup phase: '
+                         f'{e.__class__.__name__} {e}')
     _LOG.debug(f'configuration_phase: {configuration_action}')
-    for probe in configuration_action['probes']:
+    pulls = []
+    for probe in probes:
         _LOG.debug(f'Getting {probe["name"]}')
         try:
             if len(probe['image'].split(':')) == 1:
                 _LOG.warning(f'{probe["image"]} tag is not specified, using latest instead')
-                image = dockeri.pull(':'.join([probe['image'], 'latest']))
+                image_name = ':'.join([probe['image'], 'latest'])
             elif len(probe['image'].split(':')) == 2:
-                image = dockeri.pull(probe['image'])
+                image_name = probe['image']
             else:
                 raise Exception('Probe image name was wrongly formatted?')
+            context['prewarm'].record(test_plan.execution_host, image_name)
+            pulls.append((probe, context['images'].acquire(test_plan.uuid, dockeri, image_name)))
+        except Exception as e:
+            err_msg = f'Exception getting probe {probe["name"]}: {e}'
+            _LOG.error(err_msg)
 
+    deadline = time.monotonic() + context['pulls'].budget
+    for probe, pull in pulls:
+        try:
+            image, pull_time = pull.result(timeout=max(deadline - time.monotonic(), 0))
             if image:
-                context['test_preparations'][test_plan_uuid]['probes'].append(
-                    {
-                        'id': str(image.short_id).split(':')[1],
-                        'name': probe['name'],
-                        'image': probe['image']
-                    }
-                )
-                _LOG.debug(f'Got {probe["name"]}, {image}')
+                test_plan.probes.append(ProbeRef(str(image.short_id).split(':')[1], probe['name'], probe['image'],
+                                                 pull_time=round(pull_time, 3)))
+                _LOG.debug(f'Got {probe["name"]}, {image} in {pull_time:.2f}s')
             else:
                 err_msg = f'Exception getting probe {probe["name"]}: Image not found'
                 _LOG.error(err_msg)
+        except FutureTimeoutError:
+            err_msg = f'Exception getting probe {probe["name"]}: not pulled within {context["pulls"].budget}s'
+            _LOG.error(err_msg)
         except Exception as e:
             err_msg = f'Exception getting probe {probe["name"]}: {e}'
             _LOG.error(err_msg)
+    if err_msg:
+        raise StageError(err_msg)
 
-    if not err_msg and type(platforms) is list:
-        if 'SONATA' in platforms and (nsd_target == '5gtango' or nsd_target == 'sonata'):
-            _LOG.info(f"Accesing {nsd_target}")
-            platform_type = 'SONATA'
-            policy_id = context['test_preparations'][test_plan_uuid].get('policy_id')
-            sp_list = platform_adapter.available_platforms_by_type(platform_type.lower())
-            if not sp_list:
-                err_msg = f'No available platforms of type {platform_type}'
-                _LOG.error(err_msg)
-                try:
-                    callback_path = [
-                        d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-                        if d['status'] == 'COMPLETED'
-                    ][0]
-                    planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR',
-                                          exception=err_msg)
-                    return
-                except AttributeError as e:
-                    # _LOG.exception(e)
-                    err_msg = f'Callbacks: {e} but going fallback to /test-plans/on-change/completed'
-                    _LOG.error(err_msg)
-                    planner.send_callback('/test-plans/on-change/completed', test_plan_uuid, result_list=[],
-                                          status='ERROR', exception=err_msg)
-                    return
-            elif sp_name:
-                _LOG.debug(f"Overriding with service platform {sp_name}")
-                service_platform = [sp for sp in sp_list if sp['name'] == sp_name].pop()
-            elif load_balancer_algorithm == 'random':
-                _LOG.debug(f"Using {load_balancer_algorithm} load balancer")
-                service_platform = random.choice(sp_list)
-                _LOG.debug(f"Platform {service_platform} selected")
-            elif load_balancer_algorithm == 'round_robin':
-                _LOG.debug(f"Using {load_balancer_algorithm} load balancer")
-                if platform_adapter.sonata_sp_usage_count:
-                    least_used_son_sp = sorted(
-                        platform_adapter.sonata_sp_usage_count,
-                        key=platform_adapter.sonata_sp_usage_count.get)[0]
-                    platform_match_list = [sp for sp in sp_list if sp['name'] == least_used_son_sp]
-                    if platform_match_list:
-                        service_platform = platform_match_list[0]
-                        platform_adapter.sonata_sp_usage_count[least_used_son_sp] += 1
-                    else:
-                        service_platform = random.choice(sp_list)
-                        platform_adapter.sonata_sp_usage_count[service_platform['name']] = 1
-                else:
-                    service_platform = random.choice(sp_list)
-                    platform_adapter.sonata_sp_usage_count[service_platform['name']] = 1
-                _LOG.debug(f"Platform {service_platform} selected")
+
+def resolve_references(test_plan, td, nsd):
+    """
+    Looks up the catalogue uuids of descriptors received in the payload
+    """
+    vnv_cat = context['plugins']['catalogue']
+    if not test_plan.testd_uuid:
+        test_cat = vnv_cat.get_test_descriptor_tuple(td['vendor'], td['name'], td['version'])
+        if len(test_cat) == 0:
+            _LOG.warning('Test was not found in V&V catalogue, using a mock uuid')
+            test_plan.testd_uuid = 'deb05341-1337-1337-1337-1c3ecd41e51d'
+        else:
+            test_plan.testd_uuid = test_cat[0]['uuid']
+    if not test_plan.nsd_uuid:
+        nsd_cat = vnv_cat.get_network_descriptor_tuple(nsd['vendor'], nsd['name'], nsd['version'])
+        if len(nsd_cat) == 0:
+            _LOG.warning('Nsd was not found in V&V catalogue, using a mock uuid')
+            test_plan.nsd_uuid = 'deb05341-1337-1337-1337-1c3ecd44e75d'
+        else:
+            test_plan.nsd_uuid = nsd_cat[0]['uuid']
+
+
+def select_platforms(test_plan, platforms, nsd_target, nsd):
+    """
+    Chooses the service platforms for the network service and reserves
+    capacity on them: those named in sp_name (comma separated), or else up
+    to FANOUT_PLATFORMS of the available ones, preferring platforms with a
+    parked instance of it. Beyond the first, platforms without spare
+    capacity are skipped instead of waited for.
+    :return: (platform_type, [service_platform])
+    """
+    if type(platforms) is not list:
+        raise StageError(f'Wrong platform value, should be a list and is a {type(platforms)}')
+    if 'SONATA' in platforms and (nsd_target == '5gtango' or nsd_target == 'sonata'):
+        platform_type = 'SONATA'
+    elif 'OSM' in platforms and nsd_target == 'osm':
+        platform_type = 'OSM'
+    else:
+        if 'ONAP' in platforms and nsd_target == 'onap':
+            _LOG.error(f'Platform ONAP not yet implemented')
+        else:
+            _LOG.warning(f"Platform {nsd_target} is not compatible")
+        raise StageError(f'Curator was not able to setup any of the test environments for {test_plan.uuid}, '
+                         f'sending callback to planner')
+    _LOG.info(f"Accesing {nsd_target}")
+    platform_adapter = context['plugins']['platform_adapter']
+    context['admission'].classify(test_plan.uuid, platform_type)
+    sp_list = platform_adapter.available_platforms_by_type(platform_type.lower())
+    if not sp_list:
+        raise StageError(f'No available platforms of type {platform_type}')
+    if test_plan.sp_name:
+        _LOG.debug(f"Overriding with service platforms {test_plan.sp_name}")
+        sp_list = []
+        for sp_name in [name.strip() for name in test_plan.sp_name.split(',') if name.strip()]:
+            service_platform = find_platform(platform_adapter, platform_type, sp_name)
+            if not service_platform:
+                raise StageError(f'Service platform {sp_name} of type {platform_type} is not available')
+            sp_list.append(service_platform)
+        wanted = len(sp_list)
+    else:
+        wanted = min(FANOUT_PLATFORMS, len(sp_list)) or len(sp_list)
+    reserved = []
+    try:
+        while len(reserved) < wanted:
+            candidates = [sp for sp in sp_list if sp not in reserved]
+            if test_plan.sp_name:
+                candidates = candidates[:1]
+            elif not reserved:
+                warm_platforms = context['instances'].platforms(instance_key(nsd, test_plan.policy_id, None))
+                candidates = [sp for sp in candidates if sp['name'] in warm_platforms] or candidates
+            service_platform = context['quotas'].reserve(test_plan.uuid, platform_type.lower(), candidates,
+                                                         context['balancer'].select,
+                                                         max_wait=None if test_plan.sp_name or not reserved else 0)
+            if service_platform:
+                reserved.append(service_platform)
+            elif reserved and not test_plan.sp_name:
+                break
             else:
-                _LOG.warning(f"No load balancer selected")
-                service_platform = platform_adapter.available_platforms_by_type(platform_type.lower())[0]
-                _LOG.debug(f"Platform {service_platform} selected")
-            _LOG.debug(f'Instantiating nsd {nsd["vendor"]}:{nsd["name"]}:{nsd["version"]}, '
-                       f'in {service_platform["name"]}')
-            instance_name = f"{td['name']}-{nsd['name']}-{service_platform['name']}"
-            instantiation_init = time.time()
+                raise StageError(f'No capacity left on {", ".join(sp["name"] for sp in candidates)} '
+                                 f'after {context["quotas"].max_wait}s')
+    except BaseException:
+        for service_platform in reserved:
+            context['quotas'].release(service_platform['name'])
+        raise
+    _LOG.debug(f"Platforms {[sp['name'] for sp in reserved]} selected by {context['balancer']}")
+    return platform_type, reserved
+
+
+def register_instance(test_plan, td, nsd, service_platform):
+    """
+    Accounts the network service instance about to be requested, from here
+    on release_instance() frees its platform capacity
+    :return: instance name
+    """
+    context['balancer'].acquire(service_platform['name'])
+    instance_name = f"{td['name']}-{nsd['name']}-{service_platform['name']}"
+    test_plan.instances[instance_name] = service_platform['name']
+    index.add_instance(test_plan.uuid, instance_name)
+    persist(test_plan.uuid)
+    return instance_name
+
+
+def instantiate_service(test_plan, platform_type, service_platform, nsd, instance_name):
+    """
+    Requests the network service to the PA and waits for its sp-ready callback
+    :return: (augmented descriptor, PA response, instantiation time in seconds)
+    :raises StageError:
+    """
+    test_plan_uuid = test_plan.uuid
+    platform_adapter = context['plugins']['platform_adapter']
+    key = instance_key(nsd, test_plan.policy_id, service_platform['name'])
+    warm = context['instances'].take(key, instance_ready)
+    if warm:
+        # The capacity reserved by the plan now accounts the instance, the one it held while parked is freed
+        context['balancer'].release(warm.platform_name)
+        context['quotas'].release(warm.platform_name)
+        augd = AugmentedDescriptor(instance_name, nsi_uuid=warm.nsi_uuid, functions=warm.functions,
+                                   platform_type=warm.platform_type, package_uploaded=warm.package_uploaded)
+        index.add_descriptor(test_plan_uuid, augd)
+        persist(test_plan_uuid)
+        return augd, {'package_id': warm.package_id}, 0.0
+    _LOG.debug(f'Instantiating nsd {nsd["vendor"]}:{nsd["name"]}:{nsd["version"]}, '
+               f'in {service_platform["name"]}')
+    # Registered before the request, the PA may call back before it returns
+    context['events'][test_plan_uuid][instance_name] = threading.Event()
+    instantiation_init = time.time()
+    try:
+        if platform_type == 'SONATA':
             inst_result = platform_adapter.automated_instantiation_sonata(
                 service_platform['name'],
                 nsd['name'], nsd['vendor'], nsd['version'],
                 instance_name=instance_name,
                 test_plan_uuid=test_plan_uuid,
-                policy_id=policy_id
+                policy_id=test_plan.policy_id
             )
-            if 'error' in inst_result and inst_result['error']:
-                # Error before instantiation
-                _LOG.error(f"SONATA ERROR Response from PA: {inst_result['error']}")
-                err_msg = inst_result['error']
-
-            else:
-                context['events'][test_plan_uuid][instance_name] = threading.Event()
-                _LOG.debug(f'Waiting for event {test_plan_uuid}.{instance_name}, '
-                           f'E({context["events"][test_plan_uuid][instance_name].is_set()})')
-                context["events"][test_plan_uuid][instance_name].wait()
-                instantiation_end = time.time()
-                del context['events'][test_plan_uuid][instance_name]
-                _LOG.debug(f"Received parameters from SP: "
-                           f"{context['test_preparations'][test_plan_uuid]['augmented_descriptors']}")
-                instantiation_params = [
-                    (p_index, augd) for p_index, augd in
-                    enumerate(context['test_preparations'][test_plan_uuid]['augmented_descriptors'])
-                    if augd['platform']['platform_type'] == platform_type.lower() and not augd['error']
-                ]
-                if len(instantiation_params) < 1:
-                    error_params = [
-                        (p_index, augd) for p_index, augd in
-                        enumerate(context['test_preparations'][test_plan_uuid]['augmented_descriptors'])
-                        if augd['error'] and augd['nsi_name'] == instance_name
-                    ].pop()
-                    if error_params:
-                        _LOG.error(f'Received error from PA: {error_params[1]}')
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][error_params[0]]['test_status']) = 'ERROR'
-                        (context['test_preparations'][test_plan_uuid]['augmented_descriptors']
-                            [error_params[0]]['error']) = f'PA: {error_params[1].get("error")}'
-                        err_msg = context['test_preparations'][test_plan_uuid]['augmented_descriptors'][error_params[0]]['error']
-                        _LOG.error(f'Error processed for {test_plan_uuid}: {err_msg}')
-                        # Prepare callback to planner
-                else:
-                    (context['test_preparations'][test_plan_uuid]['augmented_descriptors']
-                        [instantiation_params[0][0]]['package_uploaded']) = inst_result['package_uploaded'] \
-                        if 'package_uploaded' in inst_result else False
-                    if 'testd_uuid' not in context['test_preparations'][test_plan_uuid]:
-                        test_cat = vnv_cat.get_test_descriptor_tuple(td['vendor'], td['name'], td['version'])
-                        if len(test_cat) == 0:
-                            _LOG.warning('Test was not found in V&V catalogue, using a mock uuid')
-                            context['test_preparations'][test_plan_uuid]['testd_uuid'] = 'deb05341-1337-1337-1337-1c3ecd41e51d'
-                        else:
-                            context['test_preparations'][test_plan_uuid]['testd_uuid'] = test_cat[0]['uuid']
-                    if 'nsd_uuid' not in context['test_preparations'][test_plan_uuid]:
-                        nsd_cat = vnv_cat.get_network_descriptor_tuple(nsd['vendor'], nsd['name'], nsd['version'])
-                        if len(nsd_cat) == 0:
-                            _LOG.warning('Nsd was not found in V&V catalogue, using a mock uuid')
-                            context['test_preparations'][test_plan_uuid]['nsd_uuid'] = 'deb05341-1337-1337-1337-1c3ecd44e75d'
-                        else:
-                            context['test_preparations'][test_plan_uuid]['nsd_uuid'] = nsd_cat[0]['uuid']
-                    try:
-                        test_descriptor_instance = generate_test_descriptor_instance(
-                            td.copy(),
-                            instantiation_params[0][1]['functions'],
-                            test_uuid=context['test_preparations'][test_plan_uuid]['testd_uuid'],
-                            service_uuid=context['test_preparations'][test_plan_uuid]['nsd_uuid'],
-                            package_uuid=inst_result['package_id'],
-                            instance_uuid=instantiation_params[0][1]['nsi_uuid']
-                        )
-                        _LOG.debug(f'Generated tdi: {json.dumps(test_descriptor_instance)}, sending to executor')
-                        ex_response = executor.execution_request(
-                            test_descriptor_instance, test_plan_uuid,
-                            service_instantiation_time=instantiation_end-instantiation_init,
-                            docker_host=context['test_preparations'][test_plan_uuid].get('execution_host')
-                        )
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][instantiation_params[0][0]]
-                            ['platform']['name']) = service_platform['name']
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][instantiation_params[0][0]]
-                            ['tdi']) = test_descriptor_instance
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][instantiation_params[0][0]]
-                            ['test_uuid']) = ex_response['test_uuid']
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][instantiation_params[0][0]]
-                            ['test_status']) = ex_response['status'] if 'status' in ex_response.keys() else 'UNKNOWN'
-                        # del context['events'][test_plan_uuid][instance_name]
-                        _LOG.debug(f'Response from executor: {ex_response}')
-
-                    except Exception as e:
-                        tb = "".join(traceback.format_exc().split("\n"))
-                        _LOG.error(f'Error during test execution: {tb}')
-                        (context['test_preparations'][test_plan_uuid]['augmented_descriptors'][instantiation_params[0][0]]
-                        ['test_status']) = 'ERROR'
-                        (context['test_preparations'][test_plan_uuid]['augmented_descriptors'][instantiation_params[0][0]]
-                        ['error']) = tb
-
-        elif 'OSM' in platforms and nsd_target == 'osm':
-            _LOG.info(f"Accesing {nsd_target}")
-            platform_type = 'OSM'
-            sp_list = platform_adapter.available_platforms_by_type(platform_type.lower())
-            if not sp_list:
-                err_msg = f'No available platforms of type {platform_type}'
-                _LOG.error(err_msg)
-                try:
-                    callback_path = [
-                        d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-                        if d['status'] == 'COMPLETED'
-                    ][0]
-                    planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR',
-                                          exception=err_msg)
-                    return
-                except AttributeError as e:
-                    # _LOG.exception(e)
-                    err_msg = f'Callbacks: {e} but going fallback to /test-plans/on-change/completed'
-                    _LOG.error(err_msg)
-                    planner.send_callback('/test-plans/on-change/completed', test_plan_uuid, result_list=[],
-                                          status='ERROR', exception=err_msg)
-                    return
-            elif sp_name:
-                _LOG.debug(f"Overriding with service platform {sp_name}")
-                service_platform = [sp for sp in sp_list if sp['name'] == sp_name].pop()
-            elif load_balancer_algorithm == 'random':
-                _LOG.debug(f"Using {load_balancer_algorithm} load balancer")
-                service_platform = random.choice(sp_list)
-                _LOG.debug(f"Platform {service_platform} selected")
-            elif load_balancer_algorithm == 'round_robin':
-                _LOG.debug(f"Using {load_balancer_algorithm} load balancer")
-                if platform_adapter.osm_sp_usage_count:
-                    least_used_son_sp = sorted(
-                        platform_adapter.osm_sp_usage_count,
-                        key=platform_adapter.osm_sp_usage_count.get)[0]
-                    platform_match_list = [sp for sp in sp_list if sp['name'] == least_used_son_sp]
-                    if platform_match_list:
-                        service_platform = platform_match_list[0]
-                        platform_adapter.osm_sp_usage_count[least_used_son_sp] += 1
-                    else:
-                        service_platform = random.choice(sp_list)
-                        platform_adapter.osm_sp_usage_count[service_platform['name']] = 1
-                else:
-                    service_platform = random.choice(sp_list)
-                    platform_adapter.osm_sp_usage_count[service_platform['name']] = 1
-                _LOG.debug(f"Platform {service_platform} selected")
-            else:
-                _LOG.warning(f"No load balancer selected")
-                service_platform = platform_adapter.available_platforms_by_type(platform_type.lower())[0]
-                _LOG.debug(f"Platform {service_platform} selected")
-            _LOG.debug(f'Instantiating nsd {nsd["vendor"]}:'
-                       f'{nsd["name"]}:'
-                       f'{nsd["version"]}, '
-                       f'in {service_platform["name"]}')
-            instance_name = f'{td["name"]}-{nsd["name"]}-{service_platform["name"]}'
-            instantiation_init = time.time()
+        else:
             inst_result = platform_adapter.automated_instantiation_osm(
                 service_platform['name'],
-                nsd['name'],
-                nsd['vendor'],
-                nsd['version'],
+                nsd['name'], nsd['vendor'], nsd['version'],
                 instance_name=instance_name,
                 test_plan_uuid=test_plan_uuid
             )
-            if 'error' in inst_result and inst_result['error']:
-                # Error before instantiation
-                _LOG.error(f"OSM ERROR Response from PA: {inst_result['error']}")
-                err_msg = inst_result['error']
+    except ThrottledError as e:
+        # Held back by the curator's own limits, the platform is not penalized
+        _LOG.warning(f'Instantiation of {instance_name} in {service_platform["name"]} throttled: {e}')
+        del context['events'][test_plan_uuid][instance_name]
+        release_instance(test_plan, instance_name)
+        raise StageError(f'Instantiation of {instance_name} throttled: {e}') from e
+    if 'error' in inst_result and inst_result['error']:
+        # Error before instantiation
+        _LOG.error(f"{platform_type} ERROR Response from PA: {inst_result['error']}")
+        del context['events'][test_plan_uuid][instance_name]
+        context['quotas'].record_failure(service_platform['name'])
+        context['balancer'].failed(service_platform['name'])
+        release_instance(test_plan, instance_name)
+        platform_adapter.platforms.request_refresh()
+        raise StageError(inst_result['error'])
 
-            else:
-                context['events'][test_plan_uuid][instance_name] = threading.Event()
-
-                _LOG.debug(f'Waiting for event {test_plan_uuid}.{instance_name}, '
-                           f'E({context["events"][test_plan_uuid][instance_name].is_set()})')
-                context["events"][test_plan_uuid][instance_name].wait()
-                instantiation_end = time.time()
-                del context['events'][test_plan_uuid][instance_name]
-                _LOG.debug(f"Received parameters from SP: "
-                           f"{context['test_preparations'][test_plan_uuid]['augmented_descriptors']}")
-                instantiation_params = [
-                    (p_index, augd) for p_index, augd in
-                    enumerate(context['test_preparations'][test_plan_uuid]['augmented_descriptors'])
-                    if augd['platform']['platform_type'] == platform_type.lower() and not augd['error']
-                ]
-                if len(instantiation_params) < 1:
-                    error_params = [
-                        (p_index, augd) for p_index, augd in
-                        enumerate(context['test_preparations'][test_plan_uuid]['augmented_descriptors'])
-                        if augd['error'] and augd['nsi_name'] == instance_name
-                    ].pop()
-                    if error_params:
-                        _LOG.error(f'Received error from PA: {error_params[1]}')
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][error_params[0]]['test_status']) = 'ERROR'
-                        (context['test_preparations'][test_plan_uuid]['augmented_descriptors']
-                            [error_params[0]]['error']) = f'PA: {error_params[1].get("error")}'
-                        err_msg = context['test_preparations'][test_plan_uuid]['augmented_descriptors'][error_params[0]]['error']
-                        # Prepare callback to planner
-                else:
-                    (context['test_preparations'][test_plan_uuid]['augmented_descriptors']
-                        [instantiation_params[0][0]]['package_uploaded']) = inst_result['package_uploaded'] \
-                            if 'package_uploaded' in inst_result else False
-                    if 'testd_uuid' not in context['test_preparations'][test_plan_uuid]:
-                        test_cat = vnv_cat.get_test_descriptor_tuple(td['vendor'], td['name'], td['version'])
-                        if len(test_cat) == 0:
-                            _LOG.warning('Test was not found in V&V catalogue, using a mock uuid')
-                            context['test_preparations'][test_plan_uuid]['testd_uuid'] = 'deb05341-1337-1337-1337-1c3ecd41e51d'
-                        else:
-                            context['test_preparations'][test_plan_uuid]['testd_uuid'] = test_cat[0]['uuid']
-                    if 'nsd_uuid' not in context['test_preparations'][test_plan_uuid]:
-                        nsd_cat = vnv_cat.get_network_descriptor_tuple(nsd['vendor'], nsd['name'], nsd['version'])
-                        if len(nsd_cat) == 0:
-                            _LOG.warning('Nsd was not found in V&V catalogue, using a mock uuid')
-                            context['test_preparations'][test_plan_uuid]['nsd_uuid'] = 'deb05341-1337-1337-1337-1c3ecd44e75d'
-                        else:
-                            context['test_preparations'][test_plan_uuid]['nsd_uuid'] = nsd_cat[0]['uuid']
-                    try:
-                        test_descriptor_instance = generate_test_descriptor_instance(
-                            td.copy(),
-                            instantiation_params[0][1]['functions'],
-                            test_uuid=context['test_preparations'][test_plan_uuid]['testd_uuid'],
-                            service_uuid=context['test_preparations'][test_plan_uuid]['nsd_uuid'],
-                            package_uuid=inst_result['package_id'],
-                            instance_uuid=instantiation_params[0][1]['nsi_uuid']
-                        )
-                        _LOG.debug(f'Generated tdi: {json.dumps(test_descriptor_instance)}, sending to executor')
-                        ex_response = executor.execution_request(
-                            test_descriptor_instance, test_plan_uuid,
-                            service_instantiation_time=instantiation_end-instantiation_init,
-                            docker_host=context['test_preparations'][test_plan_uuid].get('execution_host')
-                        )
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][instantiation_params[0][0]]
-                            ['platform']['name']) = service_platform['name']
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][instantiation_params[0][0]]
-                            ['tdi']) = test_descriptor_instance
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][instantiation_params[0][0]]
-                            ['test_uuid']) = ex_response['test_uuid']
-                        (context['test_preparations'][test_plan_uuid]
-                            ['augmented_descriptors'][instantiation_params[0][0]]
-                            ['test_status']) = ex_response['status'] if 'status' in ex_response.keys() else 'UNKNOWN'
-                        # del context['events'][test_plan_uuid][instance_name]
-                        _LOG.debug(f'Response from executor: {ex_response}')
-
-                    except Exception as e:
-                        tb = "".join(traceback.format_exc().split("\n"))
-                        _LOG.error(f'Error during test execution: {tb}')
-                        (context['test_preparations'][test_plan_uuid]['augmented_descriptors'][instantiation_params[0][0]]
-                            ['test_status']) = 'ERROR'
-                        (context['test_preparations'][test_plan_uuid]['augmented_descriptors'][instantiation_params[0][0]]
-                            ['error']) = tb
-
-        elif 'ONAP' in platforms and nsd_target == 'onap':
-            _LOG.info(f"Accesing {nsd_target}")
-            platform_type = 'ONAP'
-            _LOG.error(f'Platform {platform_type} not yet implemented')
-        else:
-            _LOG.warning(f"Platform {nsd_target} is not compatible")
+    deadline = context['timers'].schedule(INSTANTIATION, (test_plan_uuid, instance_name),
+                                          context['events'][test_plan_uuid][instance_name].set)
+    if test_plan.cancelled:
+        # Cancelled since the pipeline started the stage, its cancellation may not have seen the event
+        context['events'][test_plan_uuid][instance_name].set()
+    _LOG.debug(f'Waiting for event {test_plan_uuid}.{instance_name}, '
+               f'E({context["events"][test_plan_uuid][instance_name].is_set()})')
+    context["events"][test_plan_uuid][instance_name].wait()
+    deadline.cancel()
+    instantiation_time = time.time() - instantiation_init
+    del context['events'][test_plan_uuid][instance_name]
+    augd = index.by_instance(test_plan_uuid, instance_name)
+    _LOG.debug(f"Received parameters from SP: {augd.to_dict() if augd else None}")
+    if not augd and test_plan.cancelled:
+        # Woken by the cancellation, the instance may still come up and is then terminated by the late callback
+        release_instance(test_plan, instance_name)
+        test_plan.abandoned[instance_name] = service_platform['name']
+        persist(test_plan_uuid)
+        raise CancelledError(f'Test plan {test_plan_uuid} was cancelled while instantiating {instance_name}')
+    if augd and not augd.error:
+        context['balancer'].observe(service_platform['name'], instantiation_time)
+        context['quotas'].record_success(service_platform['name'])
+        augd.package_uploaded = inst_result.get('package_uploaded', False)
+        context['instances'].lend(WarmInstance(key, augd.nsi_uuid, augd.functions, augd.platform_type,
+                                               augd.package_uploaded, inst_result.get('package_id')))
+        return augd, inst_result, instantiation_time
+    elif augd:
+        _LOG.error(f'Received error from PA: {augd.error}')
+        augd.test_status = TestStatus.ERROR
+        augd.error = f'PA: {augd.error}'
+        context['quotas'].record_failure(service_platform['name'])
+        context['balancer'].failed(service_platform['name'])
+        release_instance(test_plan, instance_name)
+        raise StageError(augd.error)
+    elif deadline.expired:
+        context['quotas'].record_failure(service_platform['name'])
+        context['balancer'].failed(service_platform['name'])
+        # Its slot is freed now, the instance may still come up and is then terminated by the late callback
+        release_instance(test_plan, instance_name)
+        test_plan.abandoned[instance_name] = service_platform['name']
+        persist(test_plan_uuid)
+        raise StageError(f'Instantiation of {instance_name} timed out after {deadline.timeout}s')
+    raise StageError(f'No instantiation result received for {instance_name}')
 
-    elif not err_msg:
-        err_msg = f'Wrong platform value, should be a list and is a {type(platforms)}'
-        _LOG.error(err_msg)
-        try:
-            callback_path = [
-                d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-                if d['status'] == 'COMPLETED'
-            ][0]
-            planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-            return
-        except AttributeError as e:
-            # _LOG.exception(e)
-            err_msg = f'Callbacks: {e} but going fallback to /test-plans/on-change/completed'
-            _LOG.error(err_msg)
-            planner.send_callback('/test-plans/on-change/completed', test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-            return
 
-    if not context['test_preparations'][test_plan_uuid]['augmented_descriptors'] and not err_msg:
-        # No correct test executions, sending callback
-        err_msg = f'Curator was not able to setup any of the test environments for {test_plan_uuid}, ' \
-                  f'sending callback to planner'
-        _LOG.warning(err_msg)
-        try:
-            callback_path = [
-                d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-                if d['status'] == 'COMPLETED'
-            ][0]
-            planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-            return
-        except AttributeError as e:
-            # _LOG.exception(e)
-            err_msg = f'Callbacks: {e} but going fallback to /test-plans/on-change/completed'
-            _LOG.error(err_msg)
-            planner.send_callback('/api/v1/test-plans/on-change/completed', test_plan_uuid, result_list=[], status='ERROR',
-                                  exception=err_msg)
-            return
-    elif not context['test_preparations'][test_plan_uuid]['augmented_descriptors'] and err_msg:
-        # Instantiation error
-        _LOG.error(err_msg)
-        try:
-            callback_path = [
-                d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-                if d['status'] == 'COMPLETED'
-            ][0]
-            planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-            return
-        except AttributeError as e:
-            # _LOG.exception(e)
-            err_msg = f'Callbacks: {e} but going fallback to /test-plans/on-change/completed'
-            _LOG.error(err_msg)
-            planner.send_callback('/api/v1/test-plans/on-change/completed', test_plan_uuid, result_list=[],
-                                  status='ERROR',
-                                  exception=err_msg)
-            return
-
-    elif context['test_preparations'][test_plan_uuid] and err_msg:
-        _LOG.error('Triggering unknown failure process')
-        callback_path = [
-            d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-            if d['status'] == 'COMPLETED'
-        ][0]
-        planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-        return
-
-    elif err_msg:
-        # _LOG.error(f"{context['test_preparations'][test_plan_uuid]['augmented_descriptors']}{err_msg}")
-        try:
-            callback_path = [
-                d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-                if d['status'] == 'COMPLETED'
-            ][0]
-            planner.send_callback(callback_path, test_plan_uuid, result_list=[], status='ERROR', exception=err_msg)
-            return
-        except AttributeError as e:
-            # _LOG.exception(e)
-            err_msg = f'Callbacks: {e} but going fallback to /test-plans/on-change/completed'
-            _LOG.error(err_msg)
-            planner.send_callback('/api/v1/test-plans/on-change/completed', test_plan_uuid, result_list=[],
-                                  status='ERROR',
-                                  exception=err_msg)
-            return
+def generate_tdi(test_plan, td, nsd, augd, inst_result):
+    """
+    :return: test descriptor instance for the executor
+    """
+    package_uuid = inst_result.get('package_id')
+    if not package_uuid:
+        # Not every PA response has it, the package of the NSD is then found in the catalogue
+        package_uuid = context['plugins']['catalogue'].get_package_id_from_nsd_tuple(
+            nsd['vendor'], nsd['name'], nsd['version'])['uuid']
+    return generate_test_descriptor_instance(
+        json.loads(json.dumps(td)),
+        augd.functions,
+        test_uuid=test_plan.testd_uuid,
+        service_uuid=test_plan.nsd_uuid,
+        package_uuid=package_uuid,
+        instance_uuid=augd.nsi_uuid
+    )
 
-    elif all([
-        test['test_status'] == 'COMPLETED'
-        or test['test_status'] == 'ERROR'
-        or test['test_status'] == 'CANCELLED'
-        for test in context['test_preparations'][test_plan_uuid]['augmented_descriptors']
-    ]):
-        try:
-            callback_path = [
-                d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-                if d['status'] == 'COMPLETED'
-            ][0]
-            results = [test.get('test_results') for test in context['test_preparations'][test_plan_uuid]]
-            planner.send_callback(callback_path, test_plan_uuid, result_list=results, status='ERROR', exception=err_msg)
-            return
-        except AttributeError as e:
-            # _LOG.exception(e)
-            err_msg = f'Callbacks: {e} but going fallback to /test-plans/on-change/completed'
-            _LOG.error(err_msg)
-            planner.send_callback('/api/v1/test-plans/on-change/completed', test_plan_uuid, result_list=[], status='ERROR',
-                                  exception=err_msg)
-            return
 
-    else:
-        # Shouldn't reach here, check why it did
-        _LOG.error(f'Should not reach this point, check why app did it. Test_plan: #{test_plan_uuid}')
-        _LOG.debug(f'var_trace:{vars()}')
-        callback_path = [
-            d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-            if d['status'] == 'COMPLETED'
-        ][0]
-        results = [
-            context['test_preparations'][test_plan_uuid]['test_results'][test]
-            for test in context['test_preparations'][test_plan_uuid]['test_results']
-        ]
-        planner.send_callback(callback_path, test_plan_uuid, result_list=results, status='ERROR')
-        return
-    # LOG.debug('completed ' + test_plan)
+def dispatch_test(test_plan, augd, test_descriptor_instance, service_platform, instantiation_time):
+    """
+    Sends the test to the executor and starts its execution deadline
+    """
+    _LOG.debug(f'Generated tdi: {json.dumps(test_descriptor_instance)}, sending to executor')
+    ex_response = context['plugins']['executor'].execution_request(
+        test_descriptor_instance, test_plan.uuid,
+        service_instantiation_time=instantiation_time,
+        docker_host=test_plan.execution_host
+    )
+    augd.platform_name = service_platform['name']
+    augd.tdi = test_descriptor_instance
+    index.set_test_uuid(test_plan.uuid, augd, ex_response['test_uuid'])
+    schedule_execution_deadline(test_plan.uuid, augd.test_uuid)
+    augd.test_status = TestStatus(ex_response.get('status') or 'UNKNOWN')
+    persist(test_plan.uuid)
+    _LOG.debug(f'Response from executor: {ex_response}')
 
 
 def clean_environment(test_plan_uuid, test_id=None, content=None, error=None):
     _LOG.info(f'Test {test_id} from test-plan {test_plan_uuid} finished')
     _LOG.debug(f'Callback content: {content}')
-    platform_adapter = context['plugins']['platform_adapter']
-    remote_docker_interface = context['test_preparations'][test_plan_uuid].get('docker_interface')
-    if not remote_docker_interface:
-        dockeri = context['plugins']['docker']
-    else:
-        dockeri = remote_docker_interface
+    context['timers'].cancel(EXECUTION, (test_plan_uuid, test_id))
+    test_plan = context['test_preparations'][test_plan_uuid]
     planner = context['plugins']['planner']
-    try:
-        callback_path = [
-            d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-            if d['status'] == 'COMPLETED'
-        ][0]
-    except AttributeError as e:
-        # _LOG.exception(e)
-        _LOG.error(f'Callbacks: {e} but going forward')
-        callback_path = ''
+    callback_path = test_plan.callback_path
     if not error and content:
-        context['test_preparations'][test_plan_uuid]['test_results'].append(content)
-        context['test_results'].append(content)  # just for debugging
-        test_finished = [
-            (p_index, augd) for p_index, augd in
-            enumerate(context['test_preparations'][test_plan_uuid]['augmented_descriptors'])
-            if augd['test_uuid'] == test_id
-        ][0]
-        (context['test_preparations'][test_plan_uuid]['augmented_descriptors']
-            [test_finished[0]]['test_status']) = content['status'] if 'status' in content.keys() else 'FINISHED'
-
-
-        #  Shutdown instance
-        # _LOG.debug(f'Termination surpressed for {test_finished[1]["nsi_uuid"]} on {test_finished[1]["platform"]}')
-        _LOG.debug(f'Terminating service instance {test_finished[1]["nsi_uuid"]} on {test_finished[1]["platform"]}')
-        pa_termination_response = platform_adapter.shutdown_package(
-            test_finished[1]['platform']['name'],
-            test_finished[1]['nsi_uuid'],
-            test_finished[1]["package_uploaded"]
-        )
-        _LOG.debug(f'Termination response from PA: {pa_termination_response}')
+        result = TestResult.from_dict(content, test_uuid=test_id)
+        index.add_result(test_plan_uuid, result)
+        test_finished = index.by_test(test_id)[1]
+        test_finished.test_status = TestStatus(content.get('status') or 'FINISHED')
+        persist(test_plan_uuid)
+
+        #  Shutdown instance, unless it is kept for the next plan
+        if test_finished.test_status is not TestStatus.ERROR and context['instances'].park(test_finished.nsi_uuid):
+            # The parked instance keeps its platform capacity until it is terminated
+            test_plan.instances.pop(test_finished.nsi_name, None)
+        else:
+            context['cleanup'].terminate(test_plan_uuid, terminate_instance, test_plan, test_finished)
         # pa_package_removal_response = platform_adapter.delete_package(
         #     test_finished[1]['platform_type'],
         #     test_finished[1]['tdi']['package_uuid']
@@ -661,53 +695,65 @@ def clean_environment(test_plan_uuid, test_id=None, content=None, error=None):
         # )
         # TODO: remove package from SP
     elif error:
-        pass
-    if all([d['test_status'] != 'STARTING' and d['test_status'] != 'RUNNING'
-            for d in context['test_preparations'][test_plan_uuid]['augmented_descriptors']]):
-        #  Remove probe images if there are no more instances running on this test plan
+        entry = index.by_test(test_id)
+        test_failed = entry[1] if entry and entry[0] == test_plan_uuid else None
+        # A cancellation waiting for this test wraps it up itself
+        if test_failed and test_failed.test_status and test_failed.test_status.is_active and \
+                test_id not in context['events'].get(test_plan_uuid, {}):
+            test_failed.test_status = TestStatus.ERROR
+            test_failed.error = error
+            persist(test_plan_uuid)
+            context['cleanup'].terminate(test_plan_uuid, terminate_instance, test_plan, test_failed)
+    if claim_completion(test_plan):
+        #  Release probe images if there are no more instances running on this test plan
         _LOG.debug(f'Test {test_id} was the last for test-plan {test_plan_uuid}, '
                    f'cleaning up and sending results to planner')
-        for probe in context['test_preparations'][test_plan_uuid]['probes']:
-            try:
-                _LOG.debug(f'Removing {probe["name"]}')
-                if not probe['id'].startswith('aa-bb-cc-dd'):
-                    dockeri.rm_image(probe['image'])
-            except Exception as e:
-                tb = "".join(traceback.format_exc().split("\n"))
-                _LOG.error(f'Failed removal of {probe["name"]}, reason: {e}, traceback: {tb}')
-        try:
-            # Do network prune
-            dockeri.network_prune()
-        except Exception as e:
-            tb = "".join(traceback.format_exc().split("\n"))
-            _LOG.error(f'Failed removal of {probe["name"]}, reason: {e}, traceback: {tb}')
+        release_probes(test_plan)
+        context['cleanup'].prune(test_plan.execution_host)
+        # Results are reported once the instances are gone
+        context['cleanup'].drain(test_plan_uuid)
 
         #  Answer to planner
         try:
-            res_list = [
-                {
-                    'test_uuid': d['test_uuid'],
-                    'test_result_uuid': d['results_uuid'],
-                    'test_status': d['status']
-                }
-                for d in context['test_preparations'][test_plan_uuid]['test_results'] if d is not None
-            ]
-            if all([res['test_status'] == 'COMPLETED' for res in res_list]):
+            res_list = test_plan.planner_results()
+            # Platforms of a fanned out plan that never ran their test
+            failed = [augd for augd in test_plan.augmented_descriptors if augd.error]
+            if all([res['test_status'] == 'COMPLETED' for res in res_list]) and not failed:
                 final_status = 'COMPLETED'
             else:
                 final_status = 'ERROR'
+            if failed and not error:
+                error = '; '.join(f'{augd.platform_name or augd.nsi_name}: {augd.error}' for augd in failed)
             _LOG.debug(f'results for test_plan #{test_plan_uuid}: {res_list}')
             planner_resp = planner.send_callback(callback_path, test_plan_uuid, res_list, status=final_status, exception=error)
             _LOG.debug(f'Response from planner: {planner_resp}')
-            # if planner_resp ok, clean test_preparations entry
-            if remote_docker_interface:
-                dockeri.close()
-            del context['test_preparations'][test_plan_uuid]
         except Exception as e:
             tb = "".join(traceback.format_exc().split("\n"))
             _LOG.error(f'Error during test_results recovery: {tb}')
             planner_resp = planner.send_callback(callback_path, test_plan_uuid, [], status='ERROR', exception=tb)
             _LOG.debug(f'Response from planner (Errback): {planner_resp}')
+        finally:
+            # The plan is over whatever the planner answered, free its slot
+            release_execution_host(test_plan)
+            drop_test_plan(test_plan_uuid)
+            context['admission'].release(test_plan_uuid)
+            with _completing_lock:
+                _completing.discard(test_plan_uuid)
+
+
+def claim_completion(test_plan):
+    """
+    Tests of a plan, e.g. fanned out to several platforms, may finish at the
+    same time; only one of their callbacks reports the plan to the planner
+    :param test_plan:
+    :return: True for the caller that has to wrap the plan up
+    """
+    with _completing_lock:
+        if test_plan.active_tests() or test_plan.uuid in _completing or test_plan.cancelled or \
+                context['test_preparations'].get(test_plan.uuid) is not test_plan:
+            return False
+        _completing.add(test_plan.uuid)
+        return True
 
 
 def test_status_update(test_plan_uuid, test_id, content):
@@ -723,95 +769,352 @@ def execute_test_plan():
 def cancel_test_plan(test_plan_uuid):
     """
     Cancel all running tests on that test_bundle
-    and return response to planner
+    and return response to planner. Every test is asked to cancel at once and
+    the confirmations are awaited under a single deadline; tests that do not
+    confirm in time, or the executor failed to cancel, are reported as ERROR
+    and their instances terminated anyway. A plan still being set up is only
+    woken up, run_test_plan calls this again once its setup unwound
     :param test_plan_uuid:
     :param content:
     :return:
     """
     _LOG.info(f'Canceling test-plan {test_plan_uuid} by planner request')
+    test_plan = context['test_preparations'][test_plan_uuid]
+    with _completing_lock:
+        test_plan.cancelled = True
+        setting_up = test_plan.setting_up
+    if context['quotas'].withdraw(test_plan_uuid):
+        _LOG.debug(f'Test plan {test_plan_uuid} was waiting for platform capacity')
+    if setting_up:
+        _LOG.debug(f'Test plan {test_plan_uuid} is being set up, waking up its instantiations')
+        for event in list(context['events'].get(test_plan_uuid, {}).values()):
+            event.set()
+        return
     planner = context['plugins']['planner']
     executor = context['plugins']['executor']
-    platform_adapter = context['plugins']['platform_adapter']
-    remote_docker_interface = context['test_preparations'][test_plan_uuid].get('docker_interface')
-    if not remote_docker_interface:
-        dockeri = context['plugins']['docker']
-    else:
-        dockeri = remote_docker_interface
-    try:
-        callback_path = [
-            d['url'] for d in context['test_preparations'][test_plan_uuid]['test_plan_callbacks']
-            if d['status'] == 'COMPLETED'
-        ][0]
-    except AttributeError as e:
-        # _LOG.exception(e)
-        _LOG.error(f'Callbacks: {e} but going forward')
-        callback_path = ''
+    callback_path = test_plan.callback_path
+    unconfirmed = []
     # Cancel running tests
     try:
-        for test in [run_test for run_test in context['test_preparations'][test_plan_uuid]['augmented_descriptors']
-                     if run_test['test_status'] == 'RUNNING' or run_test['test_status'] == 'STARTING']:
-            context['events'][test_plan_uuid][test['test_uuid']] = threading.Event()
-            _LOG.debug(f'Cancelling test #{test["test_uuid"]}')
-            executor.execution_cancel(test_plan_uuid, test['test_uuid'])
-            context['events'][test_plan_uuid][test['test_uuid']].wait()
-            del context['events'][test_plan_uuid][test['test_uuid']]
-            # clean service platform
-            _LOG.debug(f'Cleaning up test #{test["test_uuid"]} environment')
-            pa_termination_response = platform_adapter.shutdown_package(
-                context['events'][test_plan_uuid][test['test_uuid']]['platform']['name'],
-                context['events'][test_plan_uuid][test['test_uuid']]['nsi_uuid'],
-                context['events'][test_plan_uuid][test['test_uuid']]['package_uploaded']
-            )
-            _LOG.debug(f'Test #{test["test_uuid"]}: Termination response from PA: {pa_termination_response}')
+        tests = test_plan.active_tests()
+        events = {}
+        for test in tests:
+            events[test.test_uuid] = context['events'][test_plan_uuid][test.test_uuid] = threading.Event()
+            context['timers'].cancel(EXECUTION, (test_plan_uuid, test.test_uuid))
+        expired = threading.Event()
+        deadline = context['timers'].schedule(CANCELLATION, (test_plan_uuid, None), expired.set)
+        cancellations = [context['scheduler'].submit(TEARDOWN, executor.execution_cancel, test_plan_uuid,
+                                                     test.test_uuid)
+                         for test in tests]
+        _LOG.debug(f'Cancelling tests {list(events)}')
+        failures = {}
+        for test, cancellation in zip(tests, cancellations):
+            try:
+                cancellation.result()
+            except Exception as e:
+                _LOG.error(f'Executor failed to cancel test {test.test_uuid}: {e}')
+                failures[test.test_uuid] = f'Executor failed to cancel the test: {e}'
+        for test in tests:
+            while test.test_uuid not in failures and not expired.is_set() and \
+                    not events[test.test_uuid].wait(timeout=context['timers'].tick):
+                pass
+            del context['events'][test_plan_uuid][test.test_uuid]
+            if events[test.test_uuid].is_set():
+                test.test_status = TestStatus.CANCELLED
+            else:
+                unconfirmed.append(test.test_uuid)
+                test.test_status = TestStatus.ERROR
+                test.error = failures.get(test.test_uuid) or \
+                    f'Executor did not confirm cancellation after {deadline.timeout}s'
+            # clean service platform, all instances at once
+            _LOG.debug(f'Cleaning up test #{test.test_uuid} environment')
+            context['cleanup'].terminate(test_plan_uuid, terminate_instance, test_plan, test)
+        deadline.cancel()
+        if unconfirmed:
+            _LOG.warning(f'Executor did not confirm cancellation of tests {unconfirmed} '
+                         f'after {deadline.timeout}s, cleaning up anyway')
+        context['cleanup'].drain(test_plan_uuid)
+        # Instances the interrupted setup left behind, instantiated or only reserved
+        for instance_name in list(test_plan.instances):
+            augd = index.by_instance(test_plan_uuid, instance_name)
+            if augd and augd.nsi_uuid:
+                augd.platform_name = augd.platform_name or test_plan.instances[instance_name]
+                context['cleanup'].terminate(test_plan_uuid, terminate_instance, test_plan, augd)
+            else:
+                release_instance(test_plan, instance_name)
+        context['cleanup'].drain(test_plan_uuid)
 
         _LOG.debug(f'Finished cancellation for test-plan {test_plan_uuid}, '
                    f'cleaning up and sending results to planner')
 
     except Exception as e:
         tb = "".join(traceback.format_exc().split("\n"))
-        _LOG.error(f'Error during test_results recovery: {tb}')
-        res_list = [
-            {
-                'test_uuid': d['test_uuid'],
-                'test_result_uuid': d['results_uuid'],
-                'test_status': d['status']
-            }
-            for d in context['test_preparations'][test_plan_uuid]['test_results'] if d is not None
-        ]
-        planner_resp = planner.send_callback(callback_path, test_plan_uuid, res_list, status='ERROR', exception=tb)
-        _LOG.debug(f'Response from planner (Errback): {planner_resp}')
-
-    # Remove probe images
-    if 'probes' in context['test_preparations'][test_plan_uuid]:
-        for probe in context['test_preparations'][test_plan_uuid]['probes']:
-            try:
-                _LOG.debug(f'Removing {probe["name"]}')
-                dockeri.rm_image(probe['image'])
-            except Exception as e:
-                _LOG.exception(f'Failed removal of {probe["name"]}, reason: {e}')
+        _LOG.error(f'Error during cancellation of test-plan {test_plan_uuid}: {tb}')
+
+    # Release probe images
+    if test_plan.probes:
+        release_probes(test_plan)
     else:
         _LOG.warning(f'No probes for test plan {test_plan_uuid}')
 
-
-    res_list = [
-        {
-            'test_uuid': d['test_uuid'],
-            'test_result_uuid': d['results_uuid'],
-            'test_status': d['status']
-        }
-        for d in context['test_preparations'][test_plan_uuid]['test_results'] if d is not None
-    ]
-
-    #  Callback to planner
-    planner_resp = planner.send_callback(callback_path, test_plan_uuid, res_list, status='CANCELLED')
+    #  Callback to planner, partial if some tests did not confirm
+    planner_resp = planner.send_callback(callback_path, test_plan_uuid, test_plan.planner_results(),
+                                         status='CANCELLED',
+                                         exception=f'Cancellation not confirmed for tests {unconfirmed}'
+                                         if unconfirmed else None)
     # if planner_resp ok, clean test_preparations entry
-    if remote_docker_interface:
-        dockeri.close()
+    release_execution_host(test_plan)
     _LOG.debug(f'Response from planner: {planner_resp}')
-    del context['test_preparations'][test_plan_uuid]
+    if test_plan.abandoned:
+        # Kept until the late sp-ready callbacks of the instances its setup was waiting for arrive
+        context['store'].delete(test_plan_uuid)
+    else:
+        drop_test_plan(test_plan_uuid)
+    context['admission'].release(test_plan_uuid)
     _LOG.debug(f'Finished cancellation of {test_plan_uuid}')
 
 
+def schedule_execution_deadline(test_plan_uuid, test_uuid):
+    """
+    Aborts the test if the executor does not report its end within the
+    execution timeout. The wheel thread only hands it over to the cleanup pool
+    :param test_plan_uuid:
+    :param test_uuid:
+    :return: Deadline
+    """
+    return context['timers'].schedule(EXECUTION, (test_plan_uuid, test_uuid),
+                                      context['scheduler'].submit, CLEANUP, abort_timed_out_test,
+                                      test_plan_uuid, test_uuid)
+
+
+def abort_timed_out_test(test_plan_uuid, test_uuid):
+    """
+    Expiry action of the execution deadline: asks the executor to stop the
+    test and cleans its environment, reporting it as failed
+    :param test_plan_uuid:
+    :param test_uuid:
+    :return:
+    """
+    entry = index.by_test(test_uuid)
+    if not entry or entry[0] != test_plan_uuid or not entry[1].test_status or not entry[1].test_status.is_active:
+        return
+    err_msg = f'Test {test_uuid} did not finish within {context["timers"].timeouts[EXECUTION]}s'
+    _LOG.error(err_msg)
+    try:
+        executor_resp = context['plugins']['executor'].execution_cancel(test_plan_uuid, test_uuid)
+        _LOG.debug(f'Response from executor: {executor_resp}')
+    except Exception as e:
+        _LOG.error(f'Error cancelling timed out test {test_uuid}: {e}')
+    clean_environment(test_plan_uuid, test_uuid, {'test_uuid': test_uuid, 'status': 'ERROR', 'message': err_msg})
+
+
+def recover_test_plans():
+    """
+    Reloads the test plans which were in flight when the curator stopped:
+    queued plans are resubmitted, plans with tests running on the executor
+    keep waiting for their callbacks and plans caught in the middle of their
+    setup are aborted, terminating the service instances they created
+    :return:
+    """
+    recovered = context['store'].load_all()
+    for test_plan_uuid, test_plan in sorted(recovered.items(), key=lambda item: str(item[1].created_at)):
+        context['test_preparations'][test_plan_uuid] = test_plan
+        for sp_name in test_plan.instances.values():
+            context['balancer'].acquire(sp_name)
+            context['quotas'].adopt(sp_name)
+        context['events'][test_plan_uuid] = {}
+        index.rebuild(test_plan_uuid)
+        if not test_plan.started:
+            _LOG.info(f'Recovered queued test plan {test_plan_uuid}, resubmitting it')
+            try:
+                context['admission'].submit(
+                    test_plan_uuid,
+                    platform_type=platform_type_hint(test_plan.to_dict()),
+                    priority=test_plan.priority
+                )
+            except Full:
+                test_plan.recovered = True
+                context['scheduler'].submit(CLEANUP, abort_recovered_test_plan, test_plan_uuid)
+        elif test_plan.active_tests():
+            _LOG.info(f'Recovered running test plan {test_plan_uuid}, waiting for executor callbacks')
+            context['admission'].adopt(test_plan_uuid)
+            for test in test_plan.active_tests():
+                schedule_execution_deadline(test_plan_uuid, test.test_uuid)
+        else:
+            _LOG.warning(f'Recovered test plan {test_plan_uuid} was interrupted during its setup, aborting it')
+            test_plan.recovered = True
+            context['scheduler'].submit(CLEANUP, abort_recovered_test_plan, test_plan_uuid)
+    _LOG.info(f'Recovered {len(recovered)} test plans from {context["store"]}')
+
+
+def abort_recovered_test_plan(test_plan_uuid):
+    """
+    Terminates the service instances already reported for a plan whose setup
+    was interrupted by a restart and notifies the planner. The plan is kept
+    while instances are still pending, so that their late sp-ready callback
+    can terminate them too
+    :param test_plan_uuid:
+    :return:
+    """
+    test_plan = context['test_preparations'][test_plan_uuid]
+    planner = context['plugins']['planner']
+    platform_adapter = context['plugins']['platform_adapter']
+    instances = test_plan.instances
+    for augd in test_plan.augmented_descriptors or []:
+        if augd.nsi_uuid and augd.nsi_name in instances:
+            _LOG.debug(f'Terminating recovered service instance {augd.nsi_uuid}')
+            try:
+                pa_termination_response = platform_adapter.shutdown_package(
+                    instances[augd.nsi_name], augd.nsi_uuid, augd.package_uploaded)
+                _LOG.debug(f'Termination response from PA: {pa_termination_response}')
+            except ThrottledError as e:
+                _LOG.error(f'Could not terminate recovered service instance {augd.nsi_uuid}: {e}')
+        release_instance(test_plan, augd.nsi_name)
+    planner.send_callback(test_plan.callback_path, test_plan_uuid, result_list=[], status='ERROR',
+                          exception='Curator was restarted while the test plan was being prepared')
+    if not instances:
+        drop_test_plan(test_plan_uuid)
+    else:
+        context['store'].delete(test_plan_uuid)
+
+
+def terminate_orphan_instance(test_plan_uuid, instance_name, instance_uuid):
+    """
+    Terminates an instance reported by the PA for an aborted recovered plan,
+    or after its instantiation timed out
+    :param test_plan_uuid:
+    :param instance_name:
+    :param instance_uuid:
+    :return:
+    """
+    platform_adapter = context['plugins']['platform_adapter']
+    test_plan = context['test_preparations'][test_plan_uuid]
+    sp_name = test_plan.instances.get(instance_name) or test_plan.abandoned.pop(instance_name)
+    _LOG.debug(f'Terminating orphan service instance {instance_uuid} ({instance_name})')
+    try:
+        pa_termination_response = platform_adapter.shutdown_package(sp_name, instance_uuid, False)
+        _LOG.debug(f'Termination response from PA: {pa_termination_response}')
+    finally:
+        release_instance(test_plan, instance_name)
+    if not test_plan.instances and not test_plan.abandoned and not test_plan.active_tests():
+        drop_test_plan(test_plan_uuid)
+
+
+def release_instance(test_plan, instance_name):
+    """
+    Forgets a terminated (or never created) service instance and frees its
+    slot in the load balancer and platform quota, only the first call for an
+    instance counts
+    :param test_plan:
+    :param instance_name:
+    :return:
+    """
+    sp_name = test_plan.instances.pop(instance_name, None)
+    if sp_name:
+        context['balancer'].release(sp_name)
+        context['quotas'].release(sp_name)
+
+
+def is_idle():
+    """
+    :return: True if no test plan is waiting for admission or being set up
+    """
+    pools = context['scheduler'].stats()
+    return not context['admission'].stats()['queued'] and \
+        not pools[STAGES]['running'] and not pools[ENVIRONMENTS]['running'] and \
+        not context['pulls'].stats()['in_flight']
+
+
+def release_probes(test_plan):
+    """
+    Drops the references of a test plan to its probe images, images no other
+    plan uses stay cached on the execution host until evicted
+    :param test_plan:
+    :return:
+    """
+    try:
+        context['images'].release(test_plan.uuid, test_plan.docker_interface or context['plugins']['docker'])
+    except Exception as e:
+        tb = "".join(traceback.format_exc().split("\n"))
+        _LOG.error(f'Failed release of probes of {test_plan.uuid}, reason: {e}, traceback: {tb}')
+
+
+def terminate_instance(test_plan, augd):
+    """
+    Terminates the service instance of a test, run on the cleanup queue
+    :param test_plan:
+    :param augd: AugmentedDescriptor of the test
+    :return:
+    """
+    _LOG.debug(f'Terminating service instance {augd.nsi_uuid} on {augd.platform_name}')
+    context['instances'].discard(augd.nsi_uuid)
+    try:
+        pa_termination_response = context['plugins']['platform_adapter'].shutdown_package(
+            augd.platform_name,
+            augd.nsi_uuid,
+            augd.package_uploaded
+        )
+        _LOG.debug(f'Termination response from PA: {pa_termination_response}')
+    finally:
+        release_instance(test_plan, augd.nsi_name)
+
+
+def instance_ready(warm):
+    """
+    Readiness check of a parked network service instance before its reuse
+    :param warm: WarmInstance
+    :return: True if the PA reports it ready
+    """
+    instantiation = context['plugins']['platform_adapter'].get_service_instantiation(warm.platform_name,
+                                                                                     warm.nsi_uuid)
+    return bool(instantiation) and not instantiation.get('error') and instantiation.get('status') == 'READY'
+
+
+def terminate_warm_instance(warm):
+    """
+    Terminates a parked network service instance evicted from the pool and
+    frees the platform capacity it held
+    :param warm: WarmInstance
+    :return:
+    """
+    try:
+        pa_termination_response = context['plugins']['platform_adapter'].shutdown_package(
+            warm.platform_name, warm.nsi_uuid, warm.package_uploaded)
+        _LOG.debug(f'Termination response from PA: {pa_termination_response}')
+    finally:
+        context['balancer'].release(warm.platform_name)
+        context['quotas'].release(warm.platform_name)
+
+
+def release_execution_host(test_plan):
+    """
+    Gives the docker client of the execution host of a plan back to the pool
+    :param test_plan:
+    :return:
+    """
+    dockeri, test_plan.docker_interface = test_plan.docker_interface, None
+    context['dockers'].release(dockeri)
+
+
+def find_platform(platform_adapter, platform_type, sp_name):
+    """
+    Looks a service platform up by name, refreshing the platform registry
+    once if it is not known, e.g. it was registered in the PA moments ago
+    :param platform_adapter:
+    :param platform_type:
+    :param sp_name:
+    :return: service platform or None
+    """
+    for attempt in range(2):
+        matching = [sp for sp in platform_adapter.available_platforms_by_type(platform_type.lower())
+                    if sp['name'] == sp_name]
+        if matching:
+            return matching[0]
+        if not attempt:
+            platform_adapter.platforms.refresh()
+    return None
+
+
 def generate_test_descriptor_instance(test_descriptor, instantiation_parameters,
                                       test_uuid=None, service_uuid=None,
                                       package_uuid=None, instance_uuid=None):
@@ -899,5 +1202,3 @@ def route_from_text(obj, route):
         tail = obj[route[0]]
     else:
         raise ValueError(obj, route)
-    return tail
-
@@ -0,0 +1,257 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:instances', log_level=logging.DEBUG, log_json=True)
+
+
+def instance_key(nsd, policy_id, platform_name):
+    """
+    :param policy_id: policy the service was instantiated with, instances of
+        different policies are not interchangeable
+    :return: key of the network service instances interchangeable between plans
+    """
+    return nsd['vendor'], nsd['name'], nsd['version'], policy_id, platform_name
+
+
+class WarmInstance:
+    """
+    Network service instance that can be handed from one test plan to the next
+    """
+    __slots__ = ('key', 'nsi_uuid', 'functions', 'platform_type', 'package_uploaded', 'package_id', 'parked_at',
+                 'uses')
+
+    def __init__(self, key, nsi_uuid, functions, platform_type, package_uploaded, package_id):
+        self.key = key
+        self.nsi_uuid = nsi_uuid
+        self.functions = functions
+        self.platform_type = platform_type
+        self.package_uploaded = package_uploaded
+        self.package_id = package_id
+        self.parked_at = None
+        self.uses = 1
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.nsi_uuid})'
+
+    @property
+    def platform_name(self):
+        return self.key[-1]
+
+
+class InstancePool:
+    """
+    Opt-in reuse of network service instances. Instead of being terminated,
+    the instance of a test that finished cleanly is parked, and handed to the
+    next plan asking for the same NSD on the same platform once it passes a
+    readiness check. Parked instances keep holding their platform capacity;
+    they are terminated after idle_ttl seconds, when more than max_idle are
+    parked (least recently parked first), when they fail their check or when
+    a plan waits for the capacity they hold, see reclaim().
+    Parked instances are not persisted, they are not reused after a restart.
+    Configuration:
+        CURATOR_INSTANCE_REUSE: true to enable it
+        CURATOR_INSTANCE_POOL_SIZE: instances kept parked
+        CURATOR_INSTANCE_IDLE_TTL: seconds a parked instance waits for a plan (0 = no expiry)
+    """
+    def __init__(self, terminate, enabled=None, max_idle=None, idle_ttl=None):
+        """
+        :param terminate: terminate(warm_instance) shutting it down
+        """
+        self.terminate = terminate
+        self.enabled = enabled if enabled is not None else \
+            os.getenv('CURATOR_INSTANCE_REUSE', 'false').lower() in ('1', 'true', 'yes')
+        self.max_idle = max_idle if max_idle is not None else int(os.getenv('CURATOR_INSTANCE_POOL_SIZE', 10))
+        self.idle_ttl = idle_ttl if idle_ttl is not None else float(os.getenv('CURATOR_INSTANCE_IDLE_TTL', 900))
+        self._idle = OrderedDict()
+        self._lent = {}
+        self._lock = threading.Lock()
+        self.parked = 0
+        self.reused = 0
+        self.expired = 0
+        self.evicted = 0
+        self.reclaimed = 0
+        self.unhealthy = 0
+        if self.enabled and self.idle_ttl:
+            threading.Thread(target=self._run, name='curator-instance-pool', daemon=True).start()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(idle={len(self._idle)}, lent={len(self._lent)})'
+
+    def lend(self, warm):
+        """
+        Tracks an instance in use by a plan, so that it can be parked afterwards
+        :param warm: WarmInstance
+        """
+        if self.enabled:
+            with self._lock:
+                self._lent[warm.nsi_uuid] = warm
+
+    def park(self, nsi_uuid):
+        """
+        :return: True if the instance is kept for another plan, False if it must be terminated
+        """
+        if not self.enabled or not self.max_idle:
+            return False
+        with self._lock:
+            warm = self._lent.pop(nsi_uuid, None)
+            if warm is None:
+                return False
+            warm.parked_at = time.monotonic()
+            self._idle[nsi_uuid] = warm
+            self.parked += 1
+            evicted = []
+            while len(self._idle) > self.max_idle:
+                evicted.append(self._idle.popitem(last=False)[1])
+                self.evicted += 1
+        _LOG.debug(f'Parked network service instance {nsi_uuid} of {warm.key}')
+        for old in evicted:
+            self._terminate(old, 'the pool is full')
+        return True
+
+    def discard(self, nsi_uuid):
+        """
+        Forgets an instance in use that is being terminated
+        """
+        with self._lock:
+            self._lent.pop(nsi_uuid, None)
+
+    def platforms(self, key):
+        """
+        :param key: instance_key() with any platform name, e.g. None
+        :return: names of the platforms holding parked instances of the service
+        """
+        with self._lock:
+            return {warm.platform_name for warm in self._idle.values() if warm.key[:-1] == key[:-1]}
+
+    def take(self, key, ready):
+        """
+        Hands a parked instance over to a plan
+        :param key: instance_key()
+        :param ready: ready(warm_instance), True if it can run another test
+        :return: WarmInstance or None if there is none to reuse
+        """
+        if not self.enabled:
+            return None
+        while True:
+            with self._lock:
+                candidates = [warm for warm in self._idle.values() if warm.key == key]
+                if not candidates:
+                    return None
+                # Most recently parked, the least likely to have gone stale
+                warm = self._idle.pop(candidates[-1].nsi_uuid)
+            try:
+                healthy = ready(warm)
+            except Exception as e:
+                _LOG.warning(f'Readiness check of {warm.nsi_uuid} failed: {e}')
+                healthy = False
+            if healthy:
+                with self._lock:
+                    warm.uses += 1
+                    self._lent[warm.nsi_uuid] = warm
+                    self.reused += 1
+                _LOG.info(f'Reusing network service instance {warm.nsi_uuid} of {key}')
+                return warm
+            with self._lock:
+                self.unhealthy += 1
+            self._terminate(warm, 'it is not ready')
+
+    def reclaim(self, platform_names):
+        """
+        Terminates the least recently parked instance on one of the platforms,
+        to free its capacity for a plan waiting for it
+        :param platform_names: platforms the plan can use
+        :return: True if an instance is being terminated
+        """
+        with self._lock:
+            warm = next((warm for warm in self._idle.values() if warm.platform_name in platform_names), None)
+            if warm is None:
+                return False
+            del self._idle[warm.nsi_uuid]
+            self.reclaimed += 1
+        self._terminate(warm, 'a plan needs its capacity')
+        return True
+
+    def expire(self):
+        """
+        Terminates the instances parked for longer than idle_ttl, in the calling thread
+        """
+        if not self.idle_ttl:
+            return
+        now = time.monotonic()
+        with self._lock:
+            expired = [warm for warm in self._idle.values() if now - warm.parked_at > self.idle_ttl]
+            for warm in expired:
+                del self._idle[warm.nsi_uuid]
+            self.expired += len(expired)
+        for warm in expired:
+            self._terminate(warm, f'it was idle for {self.idle_ttl}s')
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            idle = {}
+            for warm in self._idle.values():
+                name = ':'.join(str(part) for part in warm.key if part is not None)
+                entry = idle.setdefault(name, {'instances': 0, 'oldest': 0})
+                entry['instances'] += 1
+                entry['oldest'] = max(entry['oldest'], round(now - warm.parked_at, 1))
+            return {
+                'enabled': self.enabled,
+                'max_idle': self.max_idle,
+                'idle_ttl': self.idle_ttl,
+                'idle': idle,
+                'lent': len(self._lent),
+                'parked': self.parked,
+                'reused': self.reused,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'reclaimed': self.reclaimed,
+                'unhealthy': self.unhealthy
+            }
+
+    def _terminate(self, warm, reason):
+        _LOG.info(f'Terminating network service instance {warm.nsi_uuid} of {warm.key}, {reason}')
+        try:
+            self.terminate(warm)
+        except Exception as e:
+            _LOG.error(f'Could not terminate network service instance {warm.nsi_uuid}: {e}')
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.idle_ttl, 60))
+            try:
+                self.expire()
+            except Exception as e:
+                _LOG.exception(f'Instance pool expiry failed: {e}')
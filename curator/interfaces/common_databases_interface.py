@@ -26,10 +26,13 @@
 # partner consortium (www.5gtango.eu).
 
 import os
-import requests
+import copy
 import logging
 import shutil
-from curator.interfaces.interface import Interface
+from curator.interfaces.interface import Interface, get_transport
+from curator.interfaces.singleflight import SingleFlight
+from curator.cache import DescriptorCache, PackageIndex
+from curator.util import iter_json_array
 from curator.logger import TangoLogger
 
 
@@ -37,6 +40,11 @@ _LOG = TangoLogger.getLogger('curator:catalogue', log_level=logging.DEBUG, log_j
 # _LOG = logging.getLogger('flask.app')
 
 
+def _copy_content(result):
+    # (content, response): the response is only read, content may be modified by each caller
+    return copy.deepcopy(result[0]), result[1]
+
+
 class CatalogueInterface(Interface):
     """
     This is a Interface class for V&V catalogue
@@ -44,18 +52,59 @@ class CatalogueInterface(Interface):
     def __init__(self):
         Interface.__init__(self)
         self.base_url = os.getenv('CAT_BASE')
+        self.http = get_transport('catalogue')
+        self.cache = DescriptorCache()
+        self.packages = PackageIndex(self.stream_package_inventory)
+        self.flights = SingleFlight('catalogue', copier=_copy_content)
         self.VERSION = 'v2'
 
+    def _cached_get(self, url, headers):
+        """
+        GET through the descriptor cache. Stale entries are revalidated with
+        If-None-Match/If-Modified-Since when the catalogue sent an ETag or
+        Last-Modified, successful non empty responses are cached. Concurrent
+        misses for the same url share one request
+        :param url:
+        :param headers:
+        :return: (content, response), response is None if content came from the cache
+        """
+        content, stale = self.cache.get(url)
+        if content is not None:
+            return content, None
+        return self.flights.do(url, self._fetch, url, headers, stale)
+
+    def _fetch(self, url, headers, stale):
+        conditional = dict(headers)
+        if stale and stale.etag:
+            conditional['If-None-Match'] = stale.etag
+        if stale and stale.last_modified:
+            conditional['If-Modified-Since'] = stale.last_modified
+        response = self.http.get(url, headers=conditional)
+        if response.status_code == 304:
+            content = self.cache.refresh(url)
+            if content is not None:
+                return content, None
+            response = self.http.get(url, headers=headers)
+        if response.status_code != 200:
+            return None, response
+        content = response.json()
+        if content:
+            self.cache.put(url, content, etag=response.headers.get('ETag'),
+                           last_modified=response.headers.get('Last-Modified'))
+        return content, response
+
     def get_network_descriptor(self, network_uuid):
         url = '/'.join([self.base_url, 'api', self.VERSION,
                         'network-services', network_uuid])
         headers = {"Content-type": "application/json"}
         _LOG.debug(f'Getting {url}')
         try:
-            response = requests.get(url, headers=headers)
+            content, response = self._cached_get(url, headers)
+            if response is None:
+                return content
             _LOG.debug(f'RESP {response.content}')
             if response.status_code == 200:
-                return response.json()
+                return content
             elif response.status_code == 404:
                 raise FileNotFoundError(response.json()['error'])
         except Exception as e:
@@ -72,10 +121,12 @@ class CatalogueInterface(Interface):
         _LOG.debug(f'GET {url}{query}')
         headers = {"Content-type": "application/json"}
         try:
-            response = requests.get(url + query, headers=headers)
+            content, response = self._cached_get(url + query, headers)
+            if response is None:
+                return content
             _LOG.debug(f'RESP {response.content}')
             if response.status_code == 200:
-                return response.json()
+                return content
             elif response.status_code == 404:
                 raise FileNotFoundError(response.json()['error'])
         except Exception as e:
@@ -87,10 +138,12 @@ class CatalogueInterface(Interface):
         headers = {"Content-type": "application/json"}
         _LOG.debug(f'Getting {url}')
         try:
-            response = requests.get(url, headers=headers)
+            content, response = self._cached_get(url, headers)
+            if response is None:
+                return content
             _LOG.debug(f'RESP {response.content}')
             if response.status_code == 200:
-                return response.json()
+                return content
             elif response.status_code == 404:
                 raise FileNotFoundError(error=response.json()['error'])
         except Exception as e:
@@ -114,41 +167,18 @@ class CatalogueInterface(Interface):
         headers = {"Content-type": "application/json"}
         _LOG.debug(f'GET {url}{query}')
         try:
-            response = requests.get(url + query, headers=headers)
+            content, response = self._cached_get(url + query, headers)
+            if response is None:
+                return content
             _LOG.debug(f'RESP {response.content}')
             if response.status_code == 200:
-                return response.json()
+                return content
             elif response.status_code == 404:
                 raise FileNotFoundError
         except Exception as e:
             _LOG.exception(e)
             raise e
 
-    def get_package_from_nsd_tuple(self, vendor, name, version):
-        """
-        Gets all packages, filter by package.nsd info (Vendor, Name, Version), returns package
-        :param vendor:
-        :param name:
-        :param version:
-        :return: {package}
-        """
-        package_inventory = self.get_package_descriptor_inventory()
-        filtered_packages = [
-            package['pd'] for package in package_inventory if [
-                pd for pd in package['pd']['package_content']
-                if pd['content-type'] == 'application/vnd.5gtango.nsd'
-                and pd['id']['vendor'] == vendor
-                and pd['id']['name'] == name
-                and pd['id']['version'] == version
-            ]
-        ]
-        if len(filtered_packages) > 1:
-            raise Warning('More than one matching package: {}'.format(
-                [p['package_file_uuid'] for p in filtered_packages]))
-        elif len(filtered_packages) == 0:
-            raise FileNotFoundError
-        return filtered_packages[0]
-
     def get_package_id_from_nsd_tuple(self, vendor, name, version):
         """
         Gets all packages, filter by package.nsd info (Vendor, Name, Version), returns package id
@@ -158,16 +188,7 @@ class CatalogueInterface(Interface):
         :return: package{'uuid', 'vendor', 'name', 'version',
                         'package_file_uuid', 'package_file_name'}
         """
-        package_inventory = self.get_package_descriptor_inventory()
-        filtered_packages = [
-            package for package in package_inventory if [
-                package_content for package_content in package['pd']['package_content']
-                if package_content['content-type'] == 'application/vnd.5gtango.nsd'
-                and package_content['id']['vendor'] == vendor
-                and package_content['id']['name'] == name
-                and package_content['id']['version'] == version
-            ]
-        ]
+        filtered_packages = self.packages.lookup(vendor, name, version)
         if len(filtered_packages) > 1:
             raise Warning('More than one matching package: {}'.format(
                 [p['uuid'] for p in filtered_packages]))
@@ -186,7 +207,7 @@ class CatalogueInterface(Interface):
         url = '/'.join([self.base_url, 'api', self.VERSION, 'packages'])
         headers = {"Content-type": "application/json"}
         try:
-            response = requests.get(url, headers=headers)
+            response = self.http.get(url, headers=headers)
             if response.status_code == 200:
                 return response.json()
             elif response.status_code == 404:
@@ -195,6 +216,37 @@ class CatalogueInterface(Interface):
             _LOG.exception(e)
             raise e
 
+    def stream_package_inventory(self, etag=None):
+        """
+        Streams the package inventory, parsing packages one at a time
+        :param etag: ETag of the last inventory, if it did not change nothing is downloaded
+        :return: (generator of packages or None if not modified, ETag of the inventory)
+        """
+        url = '/'.join([self.base_url, 'api', self.VERSION, 'packages'])
+        headers = {"Content-type": "application/json"}
+        if etag:
+            headers['If-None-Match'] = etag
+        try:
+            response = self.http.get(url, headers=headers, stream=True)
+            if response.status_code == 304:
+                response.close()
+                return None, etag
+            elif response.status_code == 200:
+                return self._iter_packages(response), response.headers.get('ETag')
+            elif response.status_code == 404:
+                raise FileNotFoundError
+            else:
+                raise ValueError(f'Code not expected, status={response.status_code}')
+        except Exception as e:
+            _LOG.exception(e)
+            raise e
+
+    def _iter_packages(self, response):
+        try:
+            yield from iter_json_array(response.iter_content(chunk_size=65536))
+        finally:
+            response.close()
+
     def get_package_descriptor(self, package_uuid):
         """
 
@@ -204,7 +256,7 @@ class CatalogueInterface(Interface):
         url = '/'.join([self.base_url, 'api', self.VERSION, 'packages', package_uuid])
         headers = {"Content-type": "application/json"}
         try:
-            response = requests.get(url, headers=headers)
+            response = self.http.get(url, headers=headers)
             if response.status_code == 200:
                 return response.json()
             elif response.status_code == 404:
@@ -224,7 +276,7 @@ class CatalogueInterface(Interface):
         headers = {"Content-type": "application/json"}
         path = '/tmp/{}'.format(tgo_package_name)
         try:
-            response = requests.get(url, headers=headers, stream=True)
+            response = self.http.get(url, headers=headers, stream=True)
             if response.status_code == 200:
                 with open(path, 'wb') as f:
                     response.raw.decode_content = True
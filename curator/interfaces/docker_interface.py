@@ -26,10 +26,12 @@
 # partner consortium (www.5gtango.eu).
 
 import os
+import time
 import requests
 # import yaml
 import docker
 import logging
+import threading
 from curator.interfaces.interface import Interface
 from curator.database import context
 from curator.logger import TangoLogger
@@ -43,6 +45,7 @@ class DockerInterface(Interface):
     def __init__(self, execution_host=None):
         # connect to docker
         Interface.__init__(self)
+        self.execution_host = execution_host
         if not execution_host:
             # The default docker manager
             self.docker_manager = self.connect()
@@ -178,5 +181,165 @@ class DockerInterface(Interface):
         self.docker_manager.remove_container(container=cn_name, force=True)
         self.docker_manager.remove_image(image=image, force=True)
 
+    def ping(self):
+        return self.docker_manager.ping()
+
     def close(self):
         self.docker_manager.close()
+
+
+class _PooledClient:
+    __slots__ = ('dockeri', 'leases', 'last_used')
+
+    def __init__(self, dockeri):
+        self.dockeri = dockeri
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+
+class DockerClientPool:
+    """
+    Shares one DockerInterface per execution host between the test plans
+    using it, instead of connecting once per plan. A background thread pings
+    the clients: one failing its ping is dropped, and closed once no plan
+    holds it, so the next plan reconnects. Clients no plan has used for
+    idle_timeout seconds are closed.
+    The default docker host is not pooled, it is always the default interface.
+    Configuration:
+        CURATOR_DOCKER_PING_INTERVAL, CURATOR_DOCKER_IDLE_TIMEOUT: seconds
+    """
+    def __init__(self, default, ping_interval=None, idle_timeout=None, factory=None):
+        """
+        :param default: DockerInterface of the default docker host
+        :param factory: factory(execution_host) returning a connected DockerInterface
+        """
+        self.default = default
+        self.factory = factory or (lambda execution_host: DockerInterface(execution_host=execution_host))
+        self.ping_interval = ping_interval if ping_interval is not None else \
+            float(os.getenv('CURATOR_DOCKER_PING_INTERVAL', 30))
+        self.idle_timeout = idle_timeout if idle_timeout is not None else \
+            float(os.getenv('CURATOR_DOCKER_IDLE_TIMEOUT', 300))
+        self._clients = {}
+        self._retired = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+        self.unhealthy = 0
+        if self.ping_interval:
+            threading.Thread(target=self._run, name='curator-docker-pool', daemon=True).start()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({len(self._clients)} hosts)'
+
+    def acquire(self, execution_host):
+        """
+        :param execution_host: None for the default docker host
+        :return: DockerInterface, to be given back with release()
+        :raises: the connection error if the host cannot be reached
+        """
+        if not execution_host:
+            return self.default
+        with self._lock:
+            client = self._clients.get(execution_host)
+            if client is not None:
+                client.leases += 1
+                client.last_used = time.monotonic()
+                self.reused += 1
+                return client.dockeri
+        # Connect outside the lock, a slow host must not block the others
+        dockeri = self.factory(execution_host)
+        with self._lock:
+            client = self._clients.get(execution_host)
+            if client is None:
+                client = self._clients[execution_host] = _PooledClient(dockeri)
+                self.created += 1
+                dockeri = None
+            else:
+                # Another plan connected meanwhile
+                self.reused += 1
+            client.leases += 1
+            client.last_used = time.monotonic()
+        if dockeri is not None:
+            dockeri.close()
+        return client.dockeri
+
+    def release(self, dockeri):
+        if dockeri is None or dockeri is self.default:
+            return
+        with self._lock:
+            client = self._clients.get(getattr(dockeri, 'execution_host', None))
+            if client is None or client.dockeri is not dockeri:
+                client = next((retired for retired in self._retired if retired.dockeri is dockeri), None)
+            if client is None:
+                return
+            client.leases = max(client.leases - 1, 0)
+            client.last_used = time.monotonic()
+            close = client in self._retired and not client.leases
+            if close:
+                self._retired.remove(client)
+        if close:
+            self._close(dockeri)
+
+    def check(self):
+        """
+        Closes idle clients and drops those failing their ping, in the calling thread
+        """
+        with self._lock:
+            clients = list(self._clients.items())
+        for execution_host, client in clients:
+            with self._lock:
+                idle = not client.leases and time.monotonic() - client.last_used > self.idle_timeout
+                if idle and self._clients.get(execution_host) is client:
+                    del self._clients[execution_host]
+                    self.expired += 1
+            if idle:
+                _LOG.debug(f'Closing idle docker client of {execution_host}')
+                self._close(client.dockeri)
+                continue
+            try:
+                healthy = client.dockeri.ping()
+            except Exception as e:
+                _LOG.warning(f'Docker host {execution_host} did not answer its ping: {e}')
+                healthy = False
+            if healthy:
+                continue
+            with self._lock:
+                if self._clients.get(execution_host) is not client:
+                    continue
+                del self._clients[execution_host]
+                self.unhealthy += 1
+                close = not client.leases
+                if not close:
+                    self._retired.append(client)
+            if close:
+                self._close(client.dockeri)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'ping_interval': self.ping_interval,
+                'idle_timeout': self.idle_timeout,
+                'hosts': {execution_host: {'leases': client.leases, 'idle': round(now - client.last_used, 1)}
+                          for execution_host, client in self._clients.items()},
+                'retired': len(self._retired),
+                'created': self.created,
+                'reused': self.reused,
+                'expired': self.expired,
+                'unhealthy': self.unhealthy
+            }
+
+    def _close(self, dockeri):
+        try:
+            dockeri.close()
+        except Exception as e:
+            _LOG.warning(f'Error closing docker client of {dockeri.execution_host}: {e}')
+
+    def _run(self):
+        while True:
+            time.sleep(self.ping_interval)
+            try:
+                self.check()
+            except Exception as e:
+                _LOG.exception(f'Docker client pool check failed: {e}')
@@ -25,6 +25,213 @@
 # acknowledge the contributions of their colleagues of the 5GTANGO
 # partner consortium (www.5gtango.eu).
 
+import os
+import re
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+from curator.interfaces.resilience import CircuitBreaker, AIMDLimiter, CircuitOpenError
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:transport', log_level=logging.DEBUG, log_json=True)
+
+_ID_SEGMENT = re.compile(r'^([0-9a-fA-F-]{32,36}|\d+)$')
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def _setting(name, key, default):
+    # Per downstream override, e.g. CURATOR_CATALOGUE_HTTP_READ_TIMEOUT, then global CURATOR_HTTP_READ_TIMEOUT
+    return os.getenv(f'CURATOR_{name.upper()}_HTTP_{key}', os.getenv(f'CURATOR_HTTP_{key}', default))
+
+
+class HttpTransport:
+    """
+    Keep-alive HTTP session to one downstream component. Connections are
+    pooled per host and reused across threads, idempotent requests are retried
+    on connection errors and gateway errors, and every request gets a connect
+    and a read timeout unless the caller sets its own.
+    Requests go through a circuit breaker for the whole downstream and an
+    adaptive concurrency limit per endpoint (method and path, ids removed), so
+    a slow or failing component makes callers fail fast instead of piling up.
+    Requests made on behalf of a target behind the downstream, e.g. a service
+    platform behind the platform adapter, go through a breaker of the target
+    instead, so that one failing platform does not cut the others off.
+    Configuration (global, or per downstream as CURATOR_<NAME>_HTTP_<KEY>):
+        CURATOR_HTTP_POOL_SIZE: connections kept per host
+        CURATOR_HTTP_CONNECT_TIMEOUT, CURATOR_HTTP_READ_TIMEOUT: seconds
+        CURATOR_HTTP_RETRIES, CURATOR_HTTP_BACKOFF: retry policy
+        CURATOR_HTTP_FAILURE_THRESHOLD, CURATOR_HTTP_RESET_TIMEOUT: circuit breaker
+        CURATOR_HTTP_MAX_CONCURRENCY, CURATOR_HTTP_LIMIT_WAIT: endpoint limits
+    """
+    def __init__(self, name, pool_size=None, connect_timeout=None, read_timeout=None, retries=None, backoff=None):
+        self.name = name
+        self.pool_size = pool_size if pool_size is not None else int(_setting(name, 'POOL_SIZE', 10))
+        self.timeout = (
+            connect_timeout if connect_timeout is not None else float(_setting(name, 'CONNECT_TIMEOUT', 5)),
+            read_timeout if read_timeout is not None else float(_setting(name, 'READ_TIMEOUT', 60))
+        )
+        retries = retries if retries is not None else int(_setting(name, 'RETRIES', 3))
+        backoff = backoff if backoff is not None else float(_setting(name, 'BACKOFF', 0.5))
+        # Default method whitelist leaves POST out, an instantiation is never sent twice
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504), raise_on_status=False)
+        self._adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        self.breaker = CircuitBreaker(
+            name,
+            failure_threshold=int(_setting(name, 'FAILURE_THRESHOLD', 5)),
+            reset_timeout=float(_setting(name, 'RESET_TIMEOUT', 30))
+        )
+        self.max_concurrency = int(_setting(name, 'MAX_CONCURRENCY', 64))
+        self.limit_wait = float(_setting(name, 'LIMIT_WAIT', 30))
+        self._limiters = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+    def request(self, method, url, target=None, **kwargs):
+        """
+        :param target: e.g. service platform the request is for, None for the downstream itself
+        :raises CircuitOpenError, ConcurrencyLimitError: (ConnectionError) without sending the request
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        parts = urlsplit(url)
+        host = f'{parts.hostname}:{parts.port or (443 if parts.scheme == "https" else 80)}'
+        breaker = self._breaker(target)
+        limiter = self._limiter(method, parts.path)
+        limiter.acquire()
+        try:
+            breaker.allow()
+        except CircuitOpenError:
+            limiter.cancel()
+            raise
+        start = time.monotonic()
+        success = False
+        try:
+            response = self.session.request(method, url, **kwargs)
+            success = response.status_code < 500
+        except requests.RequestException:
+            self._count(host, 'errors')
+            raise
+        finally:
+            limiter.release(time.monotonic() - start, success)
+            if success:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        self._count(host, 'requests')
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def _breaker(self, target):
+        if target is None:
+            return self.breaker
+        with self._lock:
+            if target not in self._breakers:
+                self._breakers[target] = CircuitBreaker(
+                    f'{self.name} {target}',
+                    failure_threshold=self.breaker.failure_threshold,
+                    reset_timeout=self.breaker.reset_timeout
+                )
+            return self._breakers[target]
+
+    def _limiter(self, method, path):
+        endpoint = ' '.join([method, '/'.join('*' if _ID_SEGMENT.match(s) else s for s in path.split('/'))])
+        with self._lock:
+            if endpoint not in self._limiters:
+                self._limiters[endpoint] = AIMDLimiter(
+                    f'{self.name} {endpoint}',
+                    initial_limit=min(self.pool_size, self.max_concurrency),
+                    max_limit=self.max_concurrency,
+                    max_wait=self.limit_wait
+                )
+            return self._limiters[endpoint]
+
+    def _count(self, host, key):
+        with self._lock:
+            counters = self._hosts.setdefault(host, {'requests': 0, 'errors': 0})
+            counters[key] += 1
+
+    def stats(self):
+        """
+        Per host request counters, connections opened by the pool and how
+        many requests reused an already open connection
+        """
+        with self._lock:
+            hosts = {host: dict(counters) for host, counters in self._hosts.items()}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f'{pool.host}:{pool.port}'
+            counters = hosts.setdefault(host, {'requests': 0, 'errors': 0})
+            counters['connections_opened'] = counters.get('connections_opened', 0) + pool.num_connections
+            counters['connections_reused'] = counters.get('connections_reused', 0) + \
+                max(0, pool.num_requests - pool.num_connections)
+        with self._lock:
+            limiters = dict(self._limiters)
+            breakers = dict(self._breakers)
+        return {
+            'pool_size': self.pool_size,
+            'timeout': list(self.timeout),
+            'hosts': hosts,
+            'circuit': self.breaker.stats(),
+            'targets': {target: breaker.stats() for target, breaker in breakers.items()},
+            'endpoints': {endpoint: limiter.stats() for endpoint, limiter in limiters.items()}
+        }
+
+    def close(self):
+        self.session.close()
+
+
+def get_transport(name):
+    """
+    Shared transport of a downstream component, created on first use
+    :param name: e.g. 'planner', 'platform_adapter', 'executor', 'catalogue'
+    :return: HttpTransport
+    """
+    with _transports_lock:
+        if name not in _transports:
+            _transports[name] = HttpTransport(name)
+            _LOG.debug(f'HTTP transport {name}: pool_size={_transports[name].pool_size}, '
+                       f'timeout={_transports[name].timeout}')
+        return _transports[name]
+
+
+def transport_stats():
+    with _transports_lock:
+        transports = dict(_transports)
+    return {name: transport.stats() for name, transport in transports.items()}
+
+
+def close_transports():
+    with _transports_lock:
+        for transport in _transports.values():
+            transport.close()
+        _transports.clear()
+
 
 class Interface:
     """
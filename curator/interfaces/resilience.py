@@ -0,0 +1,326 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+
+import time
+import logging
+import threading
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:resilience', log_level=logging.DEBUG, log_json=True)
+
+CLOSED = 'CLOSED'
+OPEN = 'OPEN'
+HALF_OPEN = 'HALF_OPEN'
+
+
+class ThrottledError(ConnectionError):
+    """
+    The curator itself held a request back, the downstream did not fail it
+    """
+    pass
+
+
+class CircuitOpenError(ThrottledError):
+    """
+    Raised instead of sending a request to a downstream known to be failing
+    """
+    pass
+
+
+class ConcurrencyLimitError(ThrottledError):
+    """
+    Raised when an endpoint stays at its concurrency limit for too long
+    """
+    pass
+
+
+class RateLimitError(ThrottledError):
+    """
+    Raised when a request would have to wait too long for its rate limit
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a downstream after failure_threshold
+    consecutive failures. After reset_timeout seconds a few probe requests are
+    let through (HALF_OPEN): a success closes the circuit again, a failure
+    keeps it open for another reset_timeout.
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, half_open_requests=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_requests = half_open_requests
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.name}, {self.state})'
+
+    def allow(self):
+        """
+        :raises CircuitOpenError: if the request must not be sent
+        """
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpenError(f'{self.name} is unavailable, retry in {int(remaining) + 1}s')
+                self.state = HALF_OPEN
+                self._probes = 0
+                _LOG.info(f'Circuit {self.name} half open, probing')
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_requests:
+                    self.rejected += 1
+                    raise CircuitOpenError(f'{self.name} is recovering, retry later')
+                self._probes += 1
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                _LOG.info(f'Circuit {self.name} closed')
+            self.state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self._failures >= self.failure_threshold):
+                _LOG.warning(f'Circuit {self.name} open after {self._failures} consecutive failures')
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self._failures,
+                'opened': self.opened,
+                'rejected': self.rejected
+            }
+
+
+class AIMDLimiter:
+    """
+    Adaptive concurrency limit of one endpoint. The limit grows by one every
+    limit successful requests (additive increase) and is cut by
+    backoff_ratio (multiplicative decrease) on a failure or when a request
+    takes longer than latency_tolerance times the smoothed latency (and
+    longer than latency_floor, to ignore jitter of fast endpoints), at most
+    once per smoothed latency so a burst of slow responses counts once.
+    Callers over the limit wait up to max_wait seconds for a slot.
+    """
+    def __init__(self, name, initial_limit=8, min_limit=1, max_limit=64, backoff_ratio=0.5,
+                 latency_tolerance=2.0, latency_floor=0.25, max_wait=30):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.latency_floor = latency_floor
+        self.max_wait = max_wait
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._latency = None
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.rejected = 0
+        self.decreases = 0
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.name}, limit={self.limit})'
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        """
+        :raises ConcurrencyLimitError: if no slot frees up within max_wait
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            while self.in_flight >= self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise ConcurrencyLimitError(f'{self.name} is at its concurrency limit ({self.limit})')
+                self._cond.wait(remaining)
+            self.in_flight += 1
+
+    def cancel(self):
+        """
+        Gives the slot back without a latency sample, the request was not sent
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def release(self, latency, success):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            slow = self._latency is not None and latency > max(self.latency_tolerance * self._latency,
+                                                               self.latency_floor)
+            if not success or slow:
+                if now - self._last_decrease > (self._latency or 0):
+                    self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+                    self._last_decrease = now
+                    self.decreases += 1
+                    _LOG.debug(f'{self.name} limit decreased to {self.limit} '
+                               f'(latency={latency:.3f}s, success={success})')
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if success:
+                # Slow samples are folded in too, so a lasting slowdown becomes the new baseline
+                self._latency = latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'latency': round(self._latency, 4) if self._latency is not None else None,
+                'decreases': self.decreases,
+                'rejected': self.rejected
+            }
+
+
+class TokenBucket:
+    """
+    Lets through rate requests per second on average and bursts of up to
+    burst requests. A caller without a token reserves the next one and sleeps
+    until it is due, so waiting callers are spaced 1/rate apart in arrival
+    order instead of all retrying at once. A rate of 0 disables the limit.
+    """
+    def __init__(self, name, rate, burst=1, max_wait=300):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.throttled = 0
+        self.throttled_time = 0.0
+        self.rejected = 0
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.name}, rate={self.rate}/s, burst={self.burst})'
+
+    def acquire(self):
+        """
+        :return: seconds waited
+        :raises RateLimitError: if the token would be due after max_wait
+        """
+        with self._lock:
+            if not self.rate:
+                self.granted += 1
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if wait > self.max_wait:
+                self.rejected += 1
+                raise RateLimitError(f'{self.name} is rate limited, next slot in {wait:.0f}s')
+            self._tokens -= 1
+            self.granted += 1
+            if wait:
+                self.throttled += 1
+                self.throttled_time += wait
+        if wait:
+            _LOG.debug(f'{self.name} throttled for {wait:.2f}s')
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                'per_minute': round(self.rate * 60, 3),
+                'burst': self.burst,
+                'granted': self.granted,
+                'throttled': self.throttled,
+                'throttled_time': round(self.throttled_time, 3),
+                'rejected': self.rejected
+            }
+
+
+class RateLimits:
+    """
+    Token buckets per operation and target (e.g. service platform), created
+    on first use
+    """
+    def __init__(self, name, operations, overrides=None, max_wait=300):
+        """
+        :param operations: {operation: (requests per minute, burst)}
+        :param overrides: {operation: {target: requests per minute}}
+        """
+        self.name = name
+        self.operations = operations
+        self.overrides = overrides or {}
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, operation, target):
+        """
+        :return: seconds waited
+        :raises RateLimitError:
+        """
+        return self._bucket(operation, target).acquire()
+
+    def _bucket(self, operation, target):
+        key = (operation, target)
+        with self._lock:
+            if key not in self._buckets:
+                per_minute, burst = self.operations.get(operation, (0, 1))
+                per_minute = self.overrides.get(operation, {}).get(str(target).lower(), per_minute)
+                self._buckets[key] = TokenBucket(f'{self.name} {operation} {target}', per_minute / 60.0,
+                                                 burst=burst, max_wait=self.max_wait)
+            return self._buckets[key]
+
+    def stats(self):
+        with self._lock:
+            buckets = dict(self._buckets)
+        stats = {}
+        for (operation, target), bucket in buckets.items():
+            stats.setdefault(operation, {})[target] = bucket.stats()
+        return stats
@@ -26,10 +26,13 @@
 # partner consortium (www.5gtango.eu).
 
 import os
-import requests
 import logging
 import json
-from curator.interfaces.interface import Interface
+from curator.interfaces.interface import Interface, get_transport
+from curator.interfaces.singleflight import SingleFlight
+from curator.interfaces.resilience import RateLimits, ThrottledError
+from curator.admission import parse_limits
+from curator.platforms import PlatformRegistry
 from curator.database import context
 from curator.logger import TangoLogger
 
@@ -38,6 +41,23 @@ _LOG = TangoLogger.getLogger('curator:interfaces', log_level=logging.DEBUG, log_
 
 # States: STARTING, COMPLETED, CANCELLING, CANCELLED, ERROR
 
+# Rate limited operations on service platforms
+INSTANTIATE = 'instantiate'
+TERMINATE = 'terminate'
+
+
+def _platform_rate_limits():
+    # Requests per minute and burst per platform, e.g. CURATOR_PA_INSTANTIATE_RATE,
+    # with per platform overrides in CURATOR_PA_INSTANTIATE_RATE_PER_PLATFORM='sp1=10,sp2=60'
+    operations = {}
+    overrides = {}
+    for operation, rate, burst in ((INSTANTIATE, 30, 5), (TERMINATE, 60, 10)):
+        operations[operation] = (int(os.getenv(f'CURATOR_PA_{operation.upper()}_RATE', rate)),
+                                 int(os.getenv(f'CURATOR_PA_{operation.upper()}_BURST', burst)))
+        overrides[operation] = parse_limits(os.getenv(f'CURATOR_PA_{operation.upper()}_RATE_PER_PLATFORM', ''))
+    return RateLimits('platform_adapter', operations, overrides,
+                      max_wait=float(os.getenv('CURATOR_PA_RATE_LIMIT_WAIT', 300)))
+
 
 class PlannerInterface(Interface):
     """
@@ -57,6 +77,7 @@ class PlannerInterface(Interface):
     def __init__(self, cu_api_root, cu_api_version):
         Interface.__init__(self, cu_api_root, cu_api_version)
         self.__base_url = os.getenv('PLANNER_BASE')
+        self.http = get_transport('planner')
         self.__running_test_plans = []
 
     def add_new_test_plan(self, test_plan_uuid):
@@ -76,7 +97,7 @@ class PlannerInterface(Interface):
         _LOG.debug(f'Accesing {url}')
         _LOG.debug(f'Payload {payload}')
         try:
-            r = requests.post(url, headers=headers, json=payload)
+            r = self.http.post(url, headers=headers, json=payload)
             _LOG.debug(f'ResContent {r.text}'.replace('\n', ' '))
             _LOG.debug(f'ResHeaders {r.headers}')
             # resp = r.json()  # Response should be None
@@ -96,39 +117,53 @@ class PlatformAdapterInterface(Interface):
     def __init__(self, cu_api_root, cu_api_version):
         Interface.__init__(self, cu_api_root, cu_api_version)
         self.base_url = os.getenv('PLATFORM_ADAPTER_BASE')
+        self.http = get_transport('platform_adapter')
+        self.flights = SingleFlight('platform_adapter')
+        self.platforms = PlatformRegistry(self.get_service_platforms)
+        self.rate_limits = _platform_rate_limits()
         # self.running_instances = []
         self.events = []
-        self.osm_sp_usage_count = dict()
-        self.sonata_sp_usage_count = dict()
 
     def available_platforms(self):
-        url = '/'.join([self.base_url, 'service_platforms'])
-        headers = {"Content-type": "application/json"}
         try:
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 404:
-                raise FileNotFoundError
+            return self.platforms.all()
         except Exception as e:
             _LOG.exception(e)
             raise e
 
     def available_platforms_by_type(self, sp_type):
-        url = '/'.join([self.base_url, 'service_platforms'])
-        headers = {"Content-type": "application/json"}
+        """
+        Served from the platform registry, refreshed in background
+        :param sp_type:
+        :return:
+        """
         try:
-            _LOG.debug(f'Getting {url}')
-            response = requests.get(url, headers=headers)
-            _LOG.debug(f'Response {response.json()}')
-            if response.status_code == 200:
-                return list(filter(lambda x: x['type'] == sp_type, response.json()))
-            elif response.status_code == 404:
-                raise FileNotFoundError
+            return self.platforms.by_type(sp_type)
         except Exception as e:
             _LOG.exception(e)
             raise e
 
+    def get_service_platforms(self):
+        """
+        Loader of the platform registry, concurrent calls share the same request
+        :return: list of service platforms
+        """
+        url = '/'.join([self.base_url, 'service_platforms'])
+        headers = {"Content-type": "application/json"}
+        return self.flights.do(url, self._get_platforms, url, headers)
+
+    def _get_platforms(self, url, headers):
+        _LOG.debug(f'Getting {url}')
+        response = self.http.get(url, headers=headers)
+        if response.status_code == 200:
+            platforms = response.json()
+            _LOG.debug(f'Response {platforms}')
+            return platforms
+        elif response.status_code == 404:
+            raise FileNotFoundError
+        else:
+            raise ValueError(f'Code not expected, {response.content}, status={response.status_code}')
+
     def remote_download_package(self, package_id):
         """
         Command the PA to download the package on his volume
@@ -139,7 +174,7 @@ class PlatformAdapterInterface(Interface):
         """
         url = '/'.join([self.base_url, 'adapters', 'packages', package_id, 'download'])
         try:
-            response = requests.get(url)
+            response = self.http.get(url)
             if response.status_code == 200:
                 return response.text  # FIXME: Should be a json
             elif response.status_code == 404:
@@ -175,7 +210,7 @@ class PlatformAdapterInterface(Interface):
                         name, vendor, version, 'id'])
         headers = {"Content-type": "application/json"}
         try:
-            response = requests.post(url, headers=headers)
+            response = self.http.post(url, headers=headers, target=service_platform)
             if response.status_code == 200:
                 return response.text
                 # return response.json()  # FIXME: Every request should respond a JSON
@@ -217,7 +252,7 @@ class PlatformAdapterInterface(Interface):
         url = '/'.join([self.base_url, 'adapters', service_platform, 'instantiations'])
         headers = {"Content-type": "application/json"}
         try:
-            response = requests.get(url, headers=headers)
+            response = self.http.get(url, headers=headers, target=service_platform)
             if response.status_code == 200:
                 return response.json()
             elif response.status_code == 404:
@@ -260,7 +295,7 @@ class PlatformAdapterInterface(Interface):
         headers = {"Content-type": "application/json"}
         _LOG.debug(f'Accesing {url}')
         try:
-            response = requests.get(url, headers=headers)
+            response = self.http.get(url, headers=headers, target=service_platform)
             _LOG.debug(f'ResContent {response.text}')
             _LOG.debug(f'ResHeaders {response.headers}')
             if response.status_code == 200:
@@ -302,8 +337,10 @@ class PlatformAdapterInterface(Interface):
         url = '/'.join([self.base_url, 'adapters', 'instantiate_service'])
         _LOG.debug(f'Accesing {url}')
         headers = {"Content-type": "application/json"}
+        # Throttled requests raise, the platform is not to blame for them
+        self.rate_limits.acquire(INSTANTIATE, service_platform)
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = self.http.post(url, headers=headers, json=data, target=service_platform)
             _LOG.debug(f'Response {response.text}'.replace('\n', ' '))
             if response.status_code == 200 and not response.json()['error']:
                 return response.json()
@@ -317,6 +354,8 @@ class PlatformAdapterInterface(Interface):
             msg = f'Wrong JSON from PA: {response.raw}, exception: {e}'
             _LOG.error(msg)
             return {'error': msg}
+        except ThrottledError:
+            raise
         except Exception as e:
             _LOG.exception(e)
             return {'error': e}
@@ -350,8 +389,10 @@ class PlatformAdapterInterface(Interface):
         url = '/'.join([self.base_url, 'adapters', 'instantiate_service'])
         _LOG.debug(f'Accesing {url}')
         headers = {"Content-type": "application/json"}
+        # Throttled requests raise, the platform is not to blame for them
+        self.rate_limits.acquire(INSTANTIATE, service_platform)
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = self.http.post(url, headers=headers, json=data, target=service_platform)
             _LOG.debug(f'Response {response.text}'.replace('\n', ' '))
             if response.status_code == 200:
                 return response.json()
@@ -365,6 +406,8 @@ class PlatformAdapterInterface(Interface):
             msg = f'Wrong JSON from PA: {response.raw}, exception: {e}'
             _LOG.error(msg)
             return {'error': msg}
+        except ThrottledError:
+            raise
         except Exception as e:
             _LOG.exception(e)
             return {'error': e}
@@ -381,10 +424,11 @@ class PlatformAdapterInterface(Interface):
 
         data = {"instance_uuid": instance_uuid, "request_type": "TERMINATE_SERVICE", "package_uploaded": package_uploaded}
         headers = {"Content-type": "application/json"}
+        self.rate_limits.acquire(TERMINATE, service_platform)
         try:
             _LOG.debug(f'Accesing {url}')
             _LOG.debug(f'Payload {data}')
-            response = requests.post(url, headers=headers, json=data)
+            response = self.http.post(url, headers=headers, json=data, target=service_platform)
             _LOG.debug(f'ResContent {response.text}'.replace('\n', ' '))
             _LOG.debug(f'ResHeaders {response.headers}')
             if response.status_code == 200:
@@ -395,6 +439,8 @@ class PlatformAdapterInterface(Interface):
             msg = f'Wrong JSON from PA: {response.raw}, exception: {e}'
             _LOG.error(msg)
             return {'error': msg}
+        except ThrottledError:
+            raise
         except Exception as e:
             _LOG.exception(e)
             return {'error': e}
@@ -411,7 +457,7 @@ class PlatformAdapterInterface(Interface):
         data = {"package": f"/app/packages/{package_file_uuid}.tgo"}
         headers = {"Content-type": "application/json"}
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = self.http.post(url, headers=headers, json=data, target=platform)
             if response.status_code == 200:
                 return response.json()
             elif response.status_code == 404:
@@ -431,7 +477,7 @@ class PlatformAdapterInterface(Interface):
         #     version = str()
         url = '/'.join([self.base_url, 'adapters', service_platform, 'packages',
                         name, vendor, version])
-        response = requests.delete(url)
+        response = self.http.delete(url, target=service_platform)
 
     def get_inventory(self, platform):
         url = '/'.join([self.base_url, 'adapters', platform, 'packages'])
@@ -444,6 +490,7 @@ class ExecutorInterface(Interface):
     def __init__(self, cu_api_root, cu_api_version):
         Interface.__init__(self, cu_api_root, cu_api_version)
         self.base_url = os.getenv('EXECUTOR_BASE')
+        self.http = get_transport('executor')
         self.version = 'v1'
         self.api = 'api'
         self.events = []
@@ -489,7 +536,7 @@ class ExecutorInterface(Interface):
         _LOG.debug(f'Sending to executor {url} with payload {json.dumps(data)}')
 
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = self.http.post(url, headers=headers, json=data)
             _LOG.debug(f'Rstatus: {response.status_code}')
             _LOG.debug(f'Rdata: {response.content}')
             _LOG.debug(f'RESPONSE decoded: {response.json()}')
@@ -519,7 +566,7 @@ class ExecutorInterface(Interface):
         url = '/'.join([self.base_url, self.api, self.version, 'test-executions', test_uuid, 'cancel'])
         headers = {"Content-type": "application/json"}
         try:
-            response = requests.delete(url, headers=headers, json=data)
+            response = self.http.delete(url, headers=headers, json=data)
             _LOG.debug(f'Rstatus: {response.status_code}')
             _LOG.debug(f'Rdata: {response.raw}')
             if response.status_code == 200:  # and not response.json()['error']:
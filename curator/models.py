@@ -0,0 +1,298 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+from enum import Enum
+from datetime import datetime
+
+
+DEFAULT_CALLBACK_PATH = '/api/v1/test-plans/on-change/completed'
+
+
+class TestStatus(Enum):
+    """
+    Status of a test execution as reported by the executor
+    """
+    STARTING = 'STARTING'
+    RUNNING = 'RUNNING'
+    FINISHED = 'FINISHED'
+    COMPLETED = 'COMPLETED'
+    CANCELLING = 'CANCELLING'
+    CANCELLED = 'CANCELLED'
+    ERROR = 'ERROR'
+    UNKNOWN = 'UNKNOWN'
+
+    @classmethod
+    def _missing_(cls, value):
+        return cls.UNKNOWN
+
+    @property
+    def is_active(self):
+        return self is TestStatus.STARTING or self is TestStatus.RUNNING
+
+    @property
+    def is_final(self):
+        return self is TestStatus.COMPLETED or self is TestStatus.ERROR or self is TestStatus.CANCELLED
+
+
+def _parse_datetime(value):
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return value
+    return value
+
+
+class ProbeRef:
+    """
+    Probe image pulled for a test plan
+    """
+    __slots__ = ('id', 'name', 'image', 'pull_time')
+
+    def __init__(self, id, name, image, pull_time=None):
+        self.id = id
+        self.name = name
+        self.image = image
+        self.pull_time = pull_time  # seconds
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'image': self.image, 'pull_time': self.pull_time}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get('id'), d.get('name'), d.get('image'), pull_time=d.get('pull_time'))
+
+
+class AugmentedDescriptor:
+    """
+    A network service instance reported by the PA, and the test running on it
+    """
+    __slots__ = ('nsi_uuid', 'nsi_name', 'functions', 'platform_type', 'platform_name', 'error',
+                 'package_uploaded', 'tdi', 'test_uuid', 'test_status')
+
+    def __init__(self, nsi_name, nsi_uuid=None, functions=None, platform_type='unknown', platform_name=None,
+                 error=None, package_uploaded=False, tdi=None, test_uuid=None, test_status=None):
+        self.nsi_name = nsi_name
+        self.nsi_uuid = nsi_uuid
+        self.functions = functions
+        self.platform_type = platform_type
+        self.platform_name = platform_name
+        self.error = error
+        self.package_uploaded = package_uploaded
+        self.tdi = tdi
+        self.test_uuid = test_uuid
+        self.test_status = test_status
+
+    def to_dict(self):
+        d = {
+            'nsi_uuid': self.nsi_uuid,
+            'nsi_name': self.nsi_name,
+            'functions': self.functions,
+            'platform': {'platform_type': self.platform_type},
+            'error': self.error,
+            'package_uploaded': self.package_uploaded,
+            'test_uuid': self.test_uuid,
+            'test_status': self.test_status.value if self.test_status else None
+        }
+        if self.platform_name:
+            d['platform']['name'] = self.platform_name
+        if self.tdi is not None:
+            d['tdi'] = self.tdi
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        platform = d.get('platform') or {}
+        return cls(
+            d.get('nsi_name'),
+            nsi_uuid=d.get('nsi_uuid'),
+            functions=d.get('functions'),
+            platform_type=platform.get('platform_type', 'unknown'),
+            platform_name=platform.get('name'),
+            error=d.get('error'),
+            package_uploaded=d.get('package_uploaded', False),
+            tdi=d.get('tdi'),
+            test_uuid=d.get('test_uuid'),
+            test_status=TestStatus(d['test_status']) if d.get('test_status') else None
+        )
+
+
+class TestResult:
+    """
+    Outcome of a test as reported by the executor on finish or cancel
+    """
+    __slots__ = ('test_uuid', 'results_uuid', 'status', 'message')
+
+    def __init__(self, test_uuid, results_uuid=None, status=TestStatus.UNKNOWN, message=None):
+        self.test_uuid = test_uuid
+        self.results_uuid = results_uuid
+        self.status = status
+        self.message = message
+
+    def to_dict(self):
+        return {
+            'test_uuid': self.test_uuid,
+            'results_uuid': self.results_uuid,
+            'status': self.status.value,
+            'message': self.message
+        }
+
+    def to_planner(self):
+        return {
+            'test_uuid': self.test_uuid,
+            'test_result_uuid': self.results_uuid,
+            'test_status': self.status.value
+        }
+
+    @classmethod
+    def from_dict(cls, d, test_uuid=None):
+        return cls(
+            d.get('test_uuid') or test_uuid,
+            results_uuid=d.get('results_uuid'),
+            status=TestStatus(d.get('status') or 'UNKNOWN'),
+            message=d.get('message')
+        )
+
+
+class TestPlan:
+    """
+    A test plan received from the planner and everything the curator does for it.
+    Payload fields the curator does not use are kept in extra, so that the API
+    shape of the plan does not change.
+    """
+    __slots__ = ('uuid', 'nsd_uuid', 'testd_uuid', 'nsd', 'testd', 'test_plan_callbacks', 'sp_name', 'sp_type',
+                 'policy_id', 'execution_host', 'priority', 'created_at', 'updated_at', 'augmented_descriptors',
+                 'test_results', 'probes', 'instances', 'abandoned', 'docker_interface', 'recovered', 'stages',
+                 'cancelled', 'setting_up', 'extra')
+
+    PAYLOAD_KEYS = ('nsd_uuid', 'testd_uuid', 'nsd', 'testd', 'test_plan_callbacks', 'sp_name', 'sp_type',
+                    'policy_id', 'execution_host', 'priority')
+
+    def __init__(self, uuid, nsd_uuid=None, testd_uuid=None, nsd=None, testd=None, test_plan_callbacks=None,
+                 sp_name=None, sp_type=None, policy_id=None, execution_host=None, priority=0,
+                 created_at=None, updated_at=None, extra=None):
+        self.uuid = uuid
+        self.nsd_uuid = nsd_uuid
+        self.testd_uuid = testd_uuid
+        self.nsd = nsd
+        self.testd = testd
+        self.test_plan_callbacks = test_plan_callbacks
+        self.sp_name = sp_name
+        self.sp_type = sp_type
+        self.policy_id = policy_id
+        self.execution_host = execution_host
+        self.priority = int(priority or 0)
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.augmented_descriptors = None  # None until processing starts
+        self.test_results = []
+        self.probes = []
+        self.instances = {}
+        self.abandoned = {}  # timed out instances, a late sp-ready callback terminates them
+        self.docker_interface = None
+        self.recovered = False
+        self.stages = []  # setup stage transitions, see curator.pipeline
+        self.cancelled = False
+        self.setting_up = False  # run_test_plan in progress, a cancellation leaves the wrap-up to it
+        self.extra = extra or {}
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.uuid})'
+
+    @property
+    def started(self):
+        return self.augmented_descriptors is not None
+
+    @property
+    def callback_path(self):
+        """
+        Planner path to notify the completion of the plan
+        """
+        try:
+            return [d['url'] for d in self.test_plan_callbacks if d['status'] == 'COMPLETED'][0]
+        except (AttributeError, IndexError, KeyError, TypeError):
+            return DEFAULT_CALLBACK_PATH
+
+    def touch(self):
+        self.updated_at = datetime.utcnow().replace(microsecond=0)
+
+    def active_tests(self):
+        return [d for d in self.augmented_descriptors or [] if d.test_status and d.test_status.is_active]
+
+    def planner_results(self):
+        return [result.to_planner() for result in self.test_results if result is not None]
+
+    def to_dict(self):
+        d = dict(self.extra)
+        for key in self.PAYLOAD_KEYS:
+            value = getattr(self, key)
+            if value is not None:
+                d[key] = value
+        d['test_plan_uuid'] = self.uuid
+        d['created_at'] = self.created_at
+        d['updated_at'] = self.updated_at
+        if self.augmented_descriptors is not None:
+            d['augmented_descriptors'] = [augd.to_dict() for augd in self.augmented_descriptors]
+        d['test_results'] = [result.to_dict() for result in self.test_results]
+        d['probes'] = [probe.to_dict() for probe in self.probes]
+        if self.instances:
+            d['instances'] = dict(self.instances)
+        if self.abandoned:
+            d['abandoned'] = dict(self.abandoned)
+        if self.docker_interface:
+            d['docker_interface'] = str(self.docker_interface)
+        if self.recovered:
+            d['recovered'] = True
+        if self.stages:
+            d['stages'] = list(self.stages)
+        return d
+
+    @classmethod
+    def from_payload(cls, test_plan_uuid, payload):
+        kwargs = {key: payload[key] for key in cls.PAYLOAD_KEYS if key in payload}
+        extra = {k: v for k, v in payload.items() if k not in cls.PAYLOAD_KEYS and k != 'test_plan_uuid'}
+        return cls(test_plan_uuid, extra=extra, **kwargs)
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Rebuilds a plan from to_dict() output, e.g. loaded from the state store
+        """
+        internal = ('test_plan_uuid', 'created_at', 'updated_at', 'augmented_descriptors', 'test_results',
+                    'probes', 'instances', 'abandoned', 'docker_interface', 'recovered', 'stages', 'queue_position')
+        test_plan = cls.from_payload(d['test_plan_uuid'], {k: v for k, v in d.items() if k not in internal})
+        test_plan.created_at = _parse_datetime(d.get('created_at'))
+        test_plan.updated_at = _parse_datetime(d.get('updated_at'))
+        if d.get('augmented_descriptors') is not None:
+            test_plan.augmented_descriptors = [AugmentedDescriptor.from_dict(a) for a in d['augmented_descriptors']]
+        test_plan.test_results = [TestResult.from_dict(r) for r in d.get('test_results', []) if r]
+        test_plan.probes = [ProbeRef.from_dict(p) for p in d.get('probes', [])]
+        test_plan.instances = dict(d.get('instances') or {})
+        test_plan.abandoned = dict(d.get('abandoned') or {})
+        test_plan.recovered = d.get('recovered', False)
+        test_plan.stages = list(d.get('stages') or [])
+        return test_plan
@@ -0,0 +1,137 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+
+import time
+import logging
+import threading
+from queue import Full
+from concurrent.futures import Future, CancelledError
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:pipeline', log_level=logging.DEBUG, log_json=True)
+
+# Stages of the setup of a test plan
+EXECUTION_HOST = 'execution_host'
+TEST_DESCRIPTOR = 'test_descriptor'
+NETWORK_DESCRIPTOR = 'network_descriptor'
+PROBES = 'probes'
+REFERENCES = 'references'
+PLATFORM = 'platform'
+ENVIRONMENT = 'environment'
+INSTANTIATION = 'instantiation'
+TDI = 'tdi'
+DISPATCH = 'dispatch'
+
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+FAILED = 'FAILED'
+
+
+class StageError(Exception):
+    """
+    A stage could not complete, the message is reported to the planner
+    """
+    pass
+
+
+class PlanPipeline:
+    """
+    Runs the setup stages of one test plan and records their transitions in
+    test_plan.stages. run() executes a stage in the calling thread, start()
+    submits a stage that does not depend on the one in progress so both
+    overlap, and returns a future. Stages repeated for each service platform
+    of a plan run on a branch() of the pipeline, named after the platform.
+    No stage starts once the plan is cancelled.
+    """
+    def __init__(self, test_plan, submit, branch=None, lock=None):
+        """
+        :param test_plan:
+        :param submit: submit(fn, *args) returning a future, raises queue.Full if saturated
+        """
+        self.test_plan = test_plan
+        self.submit = submit
+        self.name = branch
+        self._lock = lock or threading.Lock()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.test_plan.uuid}{f", {self.name}" if self.name else ""})'
+
+    def branch(self, name, submit=None):
+        """
+        :param submit: where the branch starts its stages, the pipeline's by default
+        :return: PlanPipeline recording its stages with the given branch name
+        """
+        return PlanPipeline(self.test_plan, submit or self.submit, branch=name, lock=self._lock)
+
+    def run(self, stage, fn, *args):
+        """
+        :return: whatever fn returns
+        :raises: whatever fn raises, the stage is recorded as FAILED
+        :raises CancelledError: if the plan was cancelled
+        """
+        if self.test_plan.cancelled:
+            raise CancelledError(f'Test plan {self.test_plan.uuid} was cancelled')
+        self._record(stage, RUNNING)
+        start = time.monotonic()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self._record(stage, FAILED, time.monotonic() - start, str(e) or e.__class__.__name__)
+            raise
+        self._record(stage, DONE, time.monotonic() - start)
+        return result
+
+    def start(self, stage, fn, *args):
+        """
+        :return: concurrent.futures.Future of the stage
+        """
+        try:
+            return self.submit(self.run, stage, fn, *args)
+        except Full:
+            # Stage pool saturated, run it here rather than failing the plan
+            _LOG.warning(f'Stage pool full, running {stage} of {self.test_plan.uuid} inline')
+            future = Future()
+            try:
+                future.set_result(self.run(stage, fn, *args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+    def _record(self, stage, state, elapsed=None, error=None):
+        transition = {'stage': stage, 'state': state, 'at': round(time.time(), 3)}
+        if self.name:
+            transition['branch'] = self.name
+        if elapsed is not None:
+            transition['elapsed'] = round(elapsed, 3)
+        if error:
+            transition['error'] = error
+        with self._lock:
+            self.test_plan.stages.append(transition)
+        _LOG.debug(f'Test plan {self.test_plan.uuid}: {stage}{f"@{self.name}" if self.name else ""} {state}'
+                   f'{f" in {elapsed:.3f}s" if elapsed is not None else ""}')
@@ -0,0 +1,164 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+
+import os
+import copy
+import time
+import logging
+import threading
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:platforms', log_level=logging.DEBUG, log_json=True)
+
+
+class PlatformRegistry:
+    """
+    In-memory view of the service platforms known by the PA, indexed by type
+    and name. A background thread reloads it every refresh_interval seconds
+    (retry_interval after a failure, keeping the last known platforms), and
+    callers can ask for a refresh when a platform turns out to be missing or
+    failing.
+    Configuration:
+        CURATOR_PLATFORM_REFRESH_INTERVAL, CURATOR_PLATFORM_RETRY_INTERVAL: seconds
+    """
+    def __init__(self, loader, refresh_interval=None, retry_interval=None):
+        """
+        :param loader: callable returning the list of platforms from the PA
+        """
+        self.loader = loader
+        self.refresh_interval = refresh_interval if refresh_interval is not None else \
+            float(os.getenv('CURATOR_PLATFORM_REFRESH_INTERVAL', 30))
+        self.retry_interval = retry_interval if retry_interval is not None else \
+            float(os.getenv('CURATOR_PLATFORM_RETRY_INTERVAL', 5))
+        self._by_type = {}
+        self._by_name = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.refreshes = 0
+        self.failures = 0
+        self.forced = 0
+        self.last_error = None
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({len(self._by_name)} platforms)'
+
+    def by_type(self, sp_type):
+        """
+        :param sp_type: e.g. 'sonata', 'osm'
+        :return: list of platforms (copies)
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return copy.deepcopy(self._by_type.get(sp_type, []))
+
+    def by_name(self, name):
+        self._ensure_loaded()
+        with self._lock:
+            platform = self._by_name.get(name)
+            return copy.deepcopy(platform) if platform else None
+
+    def all(self):
+        self._ensure_loaded()
+        with self._lock:
+            return copy.deepcopy(list(self._by_name.values()))
+
+    def refresh(self):
+        """
+        Reloads the platforms now, in the calling thread
+        :raises: the loader exception, the previous platforms are kept
+        """
+        with self._load_lock:
+            try:
+                platforms = self.loader()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                raise
+            by_type = {}
+            by_name = {}
+            for platform in platforms or []:
+                by_type.setdefault(platform.get('type'), []).append(platform)
+                by_name[platform.get('name')] = platform
+            with self._lock:
+                self._by_type = by_type
+                self._by_name = by_name
+                self._loaded_at = time.monotonic()
+            self.refreshes += 1
+            self.last_error = None
+
+    def request_refresh(self):
+        """
+        Asks the background thread for a refresh without waiting for it, e.g.
+        after an instantiation error
+        """
+        self.forced += 1
+        self._start()
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'refresh_interval': self.refresh_interval,
+                'platforms': len(self._by_name),
+                'by_type': {sp_type: len(platforms) for sp_type, platforms in self._by_type.items()},
+                'age': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at is not None else None,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'forced': self.forced,
+                'last_error': self.last_error
+            }
+
+    def _ensure_loaded(self):
+        self._start()
+        if self._loaded_at is None:
+            with self._load_lock:
+                # Loaded by the background thread or another caller meanwhile?
+                if self._loaded_at is None:
+                    self.refresh()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='curator-platform-registry', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        delay = 0
+        while True:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            try:
+                self.refresh()
+                delay = self.refresh_interval
+            except Exception as e:
+                _LOG.warning(f'Could not refresh service platforms, retrying in {self.retry_interval}s: {e}')
+                delay = self.retry_interval
@@ -0,0 +1,460 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from curator.admission import parse_limits
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:probes', log_level=logging.DEBUG, log_json=True)
+
+DEFAULT_REGISTRY = 'docker.io'
+
+
+def registry_of(image_name):
+    """
+    :param image_name: e.g. 'sonatanfv/probe:1.0' or 'registry.local:5000/probe'
+    :return: registry host, docker.io if the name does not include one
+    """
+    first = image_name.split('/', 1)[0]
+    if '/' in image_name and ('.' in first or ':' in first or first == 'localhost'):
+        return first.lower()
+    return DEFAULT_REGISTRY
+
+
+class ProbePuller:
+    """
+    Pulls probe images on a bounded worker pool, so the probes of a plan
+    are fetched at the same time. A pull of an image already being pulled
+    on the same docker host joins it instead of starting another one, and
+    each registry gets at most a few pulls at a time.
+    Configuration:
+        CURATOR_PULL_PER_REGISTRY: concurrent pulls per registry
+        CURATOR_PULL_REGISTRY_LIMITS: per registry overrides, e.g. 'docker.io=2,registry.local=8'
+        CURATOR_PULL_BUDGET: seconds a plan may spend waiting for its probes
+    """
+    def __init__(self, submit, per_registry=None, registry_limits=None, budget=None):
+        """
+        :param submit: submit(fn, *args) returning a future
+        """
+        self.submit = submit
+        self.per_registry = per_registry if per_registry is not None else \
+            int(os.getenv('CURATOR_PULL_PER_REGISTRY', 4))
+        self.registry_limits = registry_limits if registry_limits is not None else \
+            parse_limits(os.getenv('CURATOR_PULL_REGISTRY_LIMITS', ''))
+        self.budget = budget if budget is not None else float(os.getenv('CURATOR_PULL_BUDGET', 600))
+        self._pulls = {}
+        self._lock = threading.RLock()
+        self._cond = threading.Condition()
+        self._active = {}
+        self.requested = 0
+        self.collapsed = 0
+        self.pulled = 0
+        self.failed = 0
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(in_flight={len(self._pulls)})'
+
+    def pull(self, dockeri, image_name):
+        """
+        :param dockeri: DockerInterface of the host the image is pulled on
+        :param image_name: image with its tag
+        :return: future of (image or None, seconds the pull took)
+        """
+        key = (getattr(dockeri, 'execution_host', None), image_name)
+        with self._lock:
+            self.requested += 1
+            future = self._pulls.get(key)
+            if future is not None:
+                self.collapsed += 1
+                _LOG.debug(f'Joining pull of {image_name} already in progress')
+                return future
+            future = self._pulls[key] = self.submit(self._pull, dockeri, image_name)
+            future.add_done_callback(lambda f: self._forget(key, f))
+            return future
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._pulls)
+        with self._cond:
+            registries = {registry: {'limit': self._limit(registry), 'active': active}
+                          for registry, active in self._active.items()}
+        return {
+            'per_registry': self.per_registry,
+            'budget': self.budget,
+            'in_flight': in_flight,
+            'requested': self.requested,
+            'collapsed': self.collapsed,
+            'pulled': self.pulled,
+            'failed': self.failed,
+            'registries': registries
+        }
+
+    def _limit(self, registry):
+        return self.registry_limits.get(registry, self.per_registry)
+
+    def _pull(self, dockeri, image_name):
+        registry = registry_of(image_name)
+        with self._cond:
+            while self._limit(registry) and self._active.get(registry, 0) >= self._limit(registry):
+                self._cond.wait()
+            self._active[registry] = self._active.get(registry, 0) + 1
+        start = time.monotonic()
+        try:
+            image = dockeri.pull(image_name)
+        finally:
+            with self._cond:
+                self._active[registry] -= 1
+                self._cond.notify_all()
+        elapsed = time.monotonic() - start
+        _LOG.debug(f'Pulled {image_name} from {registry} in {elapsed:.2f}s')
+        return image, elapsed
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._pulls.get(key) is future:
+                del self._pulls[key]
+            if future.cancelled() or future.exception() is not None or not future.result()[0]:
+                self.failed += 1
+            else:
+                self.pulled += 1
+
+
+class _CachedImage:
+    __slots__ = ('name', 'image', 'size', 'refs', 'pull')
+
+    def __init__(self, name):
+        self.name = name
+        self.image = None
+        self.size = 0
+        self.refs = set()
+        self.pull = None
+
+
+class ProbeImageCache:
+    """
+    Keeps the probe images pulled on each docker host and the test plans
+    using them. An image used by a running plan is never removed; images no
+    plan uses are kept for the next plans and evicted, least recently used
+    first, only when the host holds more than max_images images or
+    max_bytes of them.
+    Configuration:
+        CURATOR_PROBE_CACHE_IMAGES: images kept per host (0 = remove when unused)
+        CURATOR_PROBE_CACHE_SIZE: MB of images kept per host (0 = no limit)
+    """
+    def __init__(self, puller, max_images=None, max_bytes=None):
+        self.puller = puller
+        self.max_images = max_images if max_images is not None else \
+            int(os.getenv('CURATOR_PROBE_CACHE_IMAGES', 50))
+        self.max_bytes = max_bytes if max_bytes is not None else \
+            int(os.getenv('CURATOR_PROBE_CACHE_SIZE', 10240)) * 1024 * 1024
+        self._hosts = {}
+        self._removing = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(hosts={len(self._hosts)})'
+
+    def acquire(self, owner, dockeri, image_name):
+        """
+        Gets an image for a test plan, pulling it unless the host already has it
+        :param owner: test plan uuid
+        :param dockeri: DockerInterface of the host
+        :param image_name: image with its tag
+        :return: future of (image or None, seconds spent pulling, 0 if cached)
+        """
+        host = getattr(dockeri, 'execution_host', None)
+        while True:
+            with self._lock:
+                removal = self._removing.get((host, image_name))
+                if removal is None:
+                    break
+            # Pulled again once the eviction removed it, or the removal would delete the new pull
+            removal.wait()
+        with self._lock:
+            images = self._hosts.setdefault(host, OrderedDict())
+            entry = images.get(image_name)
+            if entry is not None:
+                entry.refs.add(owner)
+                images.move_to_end(image_name)
+                if entry.image is not None:
+                    self.hits += 1
+                    future = Future()
+                    future.set_result((entry.image, 0.0))
+                    return future
+                self.misses += 1
+                return entry.pull
+            entry = images[image_name] = _CachedImage(image_name)
+            entry.refs.add(owner)
+            self.misses += 1
+            entry.pull = future = self.puller.pull(dockeri, image_name)
+        # A pull already done runs the callback here, which clears entry.pull
+        future.add_done_callback(lambda pull: self._pulled(host, entry, pull))
+        return future
+
+    def warm(self, dockeri, image_name):
+        """
+        Pulls an image ahead of the plans that will use it, without referencing it
+        :return: future of (image or None, seconds spent pulling), None if already cached
+        """
+        host = getattr(dockeri, 'execution_host', None)
+        with self._lock:
+            images = self._hosts.setdefault(host, OrderedDict())
+            if image_name in images or (host, image_name) in self._removing:
+                return None
+            entry = images[image_name] = _CachedImage(image_name)
+            # Least recently used, a warmed image nobody asks for goes first
+            images.move_to_end(image_name, last=False)
+            entry.pull = future = self.puller.pull(dockeri, image_name)
+        # A pull already done runs the callback here, which clears entry.pull
+        future.add_done_callback(lambda pull: self._pulled(host, entry, pull))
+        return future
+
+    def cached(self, host):
+        """
+        :param host: execution host, None for the default docker host
+        :return: {image name: size in bytes} of the images cached on the host
+        """
+        with self._lock:
+            return {name: entry.size for name, entry in self._hosts.get(host, {}).items() if entry.image is not None}
+
+    def release(self, owner, dockeri):
+        """
+        Drops the references of a test plan on a host and evicts what is over
+        the limits
+        """
+        host = getattr(dockeri, 'execution_host', None)
+        with self._lock:
+            images = self._hosts.get(host, {})
+            for entry in images.values():
+                entry.refs.discard(owner)
+            victims = self._victims(images)
+            for entry in victims:
+                del images[entry.name]
+                self._removing[(host, entry.name)] = threading.Event()
+            self.evictions += len(victims)
+        for entry in victims:
+            try:
+                _LOG.debug(f'Evicting probe image {entry.name}')
+                dockeri.rm_image(entry.name)
+            except Exception as e:
+                _LOG.error(f'Failed removal of {entry.name}, reason: {e}')
+            finally:
+                with self._lock:
+                    self._removing.pop((host, entry.name)).set()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            hosts = {}
+            for host, images in self._hosts.items():
+                cached = [entry for entry in images.values() if entry.image is not None]
+                hosts[host or 'local'] = {
+                    'images': len(cached),
+                    'in_use': sum(1 for entry in cached if entry.refs),
+                    'bytes': sum(entry.size for entry in cached)
+                }
+            return {
+                'max_images': self.max_images,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'hosts': hosts
+            }
+
+    def _pulled(self, host, entry, pull):
+        with self._lock:
+            entry.pull = None
+            if pull.cancelled() or pull.exception() is not None or not pull.result()[0]:
+                # Not cached, the next plan tries again
+                if self._hosts.get(host, {}).get(entry.name) is entry:
+                    del self._hosts[host][entry.name]
+                return
+            entry.image = pull.result()[0]
+            entry.size = (getattr(entry.image, 'attrs', None) or {}).get('Size', 0)
+
+    def _victims(self, images):
+        cached = [entry for entry in images.values() if entry.image is not None]
+        count = len(cached)
+        size = sum(entry.size for entry in cached)
+        victims = []
+        # OrderedDict keeps the least recently used first
+        for entry in cached:
+            if count <= self.max_images and (not self.max_bytes or size <= self.max_bytes):
+                break
+            if not entry.refs:
+                victims.append(entry)
+                count -= 1
+                size -= entry.size
+        return victims
+
+
+class ProbePrewarmer:
+    """
+    Learns which probe images the test plans use most and pulls them in the
+    background onto the default docker host and the execution hosts seen
+    recently, while the curator is idle, so that common plans find their
+    probes already cached. Usage counts decay every round, so images that
+    are no longer used stop being pre-warmed.
+    Configuration:
+        CURATOR_PREWARM_INTERVAL: seconds between rounds (0 = disabled)
+        CURATOR_PREWARM_TOP: most used images pre-warmed on each host
+        CURATOR_PREWARM_MIN_USES: uses before an image is pre-warmed
+        CURATOR_PREWARM_BUDGET: MB of cached images per host above which nothing is pre-warmed
+        CURATOR_PREWARM_IMAGES: images always pre-warmed, comma separated
+    """
+    def __init__(self, cache, connect, release, is_idle, interval=None, top=None, min_uses=None, budget=None, images=None,
+                 host_ttl=86400, decay=0.9):
+        """
+        :param cache: ProbeImageCache
+        :param connect: connect(execution_host) returning a DockerInterface
+        :param release: release(dockeri) once done with it
+        :param is_idle: callable, True when no plan is being set up
+        """
+        self.cache = cache
+        self.connect = connect
+        self.release = release
+        self.is_idle = is_idle
+        self.interval = interval if interval is not None else float(os.getenv('CURATOR_PREWARM_INTERVAL', 300))
+        self.top = top if top is not None else int(os.getenv('CURATOR_PREWARM_TOP', 5))
+        self.min_uses = min_uses if min_uses is not None else float(os.getenv('CURATOR_PREWARM_MIN_USES', 2))
+        self.budget = (budget if budget is not None else int(os.getenv('CURATOR_PREWARM_BUDGET', 4096))) * 1024 * 1024
+        self.images = images if images is not None else \
+            [image.strip() for image in os.getenv('CURATOR_PREWARM_IMAGES', '').split(',') if image.strip()]
+        self.host_ttl = host_ttl
+        self.decay = decay
+        self._uses = {}
+        self._hosts = {None: time.monotonic()}
+        self._lock = threading.Lock()
+        self.rounds = 0
+        self.skipped = 0
+        self.warmed = 0
+        self.failed = 0
+        if self.interval:
+            threading.Thread(target=self._run, name='curator-probe-prewarmer', daemon=True).start()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(images={len(self._uses)}, hosts={len(self._hosts)})'
+
+    def record(self, execution_host, image_name):
+        """
+        Counts a use of a probe image by a test plan
+        """
+        with self._lock:
+            self._uses[image_name] = self._uses.get(image_name, 0) + 1
+            self._hosts[execution_host] = time.monotonic()
+
+    def candidates(self):
+        """
+        :return: images to pre-warm, most used first
+        """
+        with self._lock:
+            used = sorted((image for image, uses in self._uses.items() if uses >= self.min_uses),
+                          key=lambda image: -self._uses[image])
+        return list(OrderedDict.fromkeys(self.images + used[:self.top]))
+
+    def warm_up(self):
+        """
+        Runs a round now, in the calling thread
+        """
+        images = self.candidates()
+        with self._lock:
+            now = time.monotonic()
+            hosts = [host for host, seen in self._hosts.items() if host is None or now - seen < self.host_ttl]
+            for host in set(self._hosts) - set(hosts):
+                del self._hosts[host]
+            for image in list(self._uses):
+                self._uses[image] *= self.decay
+                if self._uses[image] < 0.5:
+                    del self._uses[image]
+        for host in hosts:
+            cached = self.cache.cached(host)
+            missing = [image for image in images if image not in cached]
+            if not missing or sum(cached.values()) >= self.budget:
+                continue
+            try:
+                dockeri = self.connect(host)
+            except Exception as e:
+                _LOG.warning(f'Could not connect to {host or "default docker host"} to pre-warm probes: {e}')
+                continue
+            try:
+                for image in missing:
+                    if not self.is_idle() or sum(self.cache.cached(host).values()) >= self.budget:
+                        break
+                    pull = self.cache.warm(dockeri, image)
+                    if pull is None:
+                        continue
+                    try:
+                        if pull.result()[0]:
+                            self.warmed += 1
+                            _LOG.info(f'Pre-warmed {image} on {host or "default docker host"}')
+                        else:
+                            self.failed += 1
+                    except Exception as e:
+                        self.failed += 1
+                        _LOG.warning(f'Could not pre-warm {image} on {host or "default docker host"}: {e}')
+            finally:
+                self.release(dockeri)
+
+    def stats(self):
+        with self._lock:
+            uses = {image: round(count, 2) for image, count in self._uses.items()}
+            hosts = len(self._hosts)
+        return {
+            'interval': self.interval,
+            'budget': self.budget,
+            'candidates': self.candidates(),
+            'uses': uses,
+            'hosts': hosts,
+            'rounds': self.rounds,
+            'skipped': self.skipped,
+            'warmed': self.warmed,
+            'failed': self.failed
+        }
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.is_idle():
+                self.skipped += 1
+                continue
+            self.rounds += 1
+            try:
+                self.warm_up()
+            except Exception as e:
+                _LOG.exception(f'Probe pre-warm round failed: {e}')
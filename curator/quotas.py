@@ -0,0 +1,254 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import CancelledError
+from curator.admission import parse_limits
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:quotas', log_level=logging.DEBUG, log_json=True)
+
+
+class _Waiter:
+    __slots__ = ('owner', 'names', 'since', 'cancelled')
+
+    def __init__(self, owner, names):
+        self.owner = owner
+        self.names = names
+        self.since = time.monotonic()
+        self.cancelled = False
+
+
+class PlatformQuotas:
+    """
+    Caps the service instances deployed at the same time on each service
+    platform. A plan that finds no candidate platform with spare capacity
+    waits in the queue of every candidate and takes the first slot freed in
+    any of them; each platform serves its queue in FIFO order. Before
+    waiting, it asks reclaim to free capacity held by idle instances.
+    With adaptive limits an instantiation failure halves the limit of the
+    platform (down to 1) and successes raise it by one every limit
+    instantiations, never above the configured capacity.
+    Configuration:
+        CURATOR_PLATFORM_CAPACITY: per platform name, e.g. 'sp1=10,sp2=4'
+        CURATOR_PLATFORM_CAPACITY_DEFAULT: platforms not listed (0 = unlimited)
+        CURATOR_PLATFORM_CAPACITY_ADAPTIVE: learn limits from failures (true/false)
+        CURATOR_PLATFORM_MAX_WAIT: seconds a plan waits for capacity
+    """
+    def __init__(self, capacity=None, default_capacity=None, adaptive=None, max_wait=None, backoff_ratio=0.5,
+                 reclaim=None):
+        """
+        :param reclaim: reclaim(sp_names) terminating an idle instance on one of the platforms,
+            e.g. InstancePool.reclaim. Called with the quotas locked, it must not wait for the termination
+        """
+        self.capacity = capacity if capacity is not None else \
+            parse_limits(os.getenv('CURATOR_PLATFORM_CAPACITY', ''))
+        self.default_capacity = default_capacity if default_capacity is not None else \
+            int(os.getenv('CURATOR_PLATFORM_CAPACITY_DEFAULT', 0))
+        self.adaptive = adaptive if adaptive is not None else \
+            os.getenv('CURATOR_PLATFORM_CAPACITY_ADAPTIVE', 'false').lower() in ('1', 'true', 'yes')
+        self.max_wait = max_wait if max_wait is not None else float(os.getenv('CURATOR_PLATFORM_MAX_WAIT', 600))
+        self.backoff_ratio = backoff_ratio
+        self.reclaim = reclaim
+        self._learned = {}
+        self._in_use = {}
+        self._queues = {}
+        self._waiters = {}
+        self._counters = {}
+        self._cond = threading.Condition()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(in_use={sum(self._in_use.values())}, waiting={self._waiting()})'
+
+    def limit(self, sp_name):
+        """
+        :return: current limit of the platform, 0 if unlimited
+        """
+        configured = self.capacity.get(sp_name.lower(), self.default_capacity)
+        learned = self._learned.get(sp_name)
+        if learned is None:
+            return configured
+        return min(int(learned), configured) if configured else int(learned)
+
+    def reserve(self, owner, platform_type, sp_list, select, max_wait=None):
+        """
+        Takes a slot on one of the candidate platforms, waiting if all are full
+        :param owner: test plan uuid, used by withdraw(). A plan fanned out to
+            several platforms may wait for more than one slot at once
+        :param platform_type:
+        :param sp_list: candidate platforms, not empty
+        :param select: select(platform_type, sp_list) choosing among those with spare capacity
+        :param max_wait: seconds, CURATOR_PLATFORM_MAX_WAIT by default
+        :return: the reserved platform, None if none had capacity within max_wait
+        :raises CancelledError: if withdrawn while waiting
+        """
+        deadline = time.monotonic() + (max_wait if max_wait is not None else self.max_wait)
+        with self._cond:
+            free = [sp for sp in sp_list if self._has_capacity(sp['name']) and not self._queues.get(sp['name'])]
+            if free:
+                return self._grant(select(platform_type, free), None)
+            waiter = _Waiter(owner, [sp['name'] for sp in sp_list])
+            self._waiters.setdefault(owner, []).append(waiter)
+            for sp_name in waiter.names:
+                self._queues.setdefault(sp_name, deque()).append(waiter)
+            _LOG.info(f'Test plan {owner} waiting for capacity on {", ".join(waiter.names)}')
+            if self.reclaim and deadline > time.monotonic():
+                try:
+                    self.reclaim(waiter.names)
+                except Exception as e:
+                    _LOG.error(f'Could not reclaim capacity on {", ".join(waiter.names)}: {e}')
+            try:
+                while True:
+                    if waiter.cancelled:
+                        raise CancelledError(f'Test plan {owner} stopped waiting for capacity')
+                    free = [sp for sp in sp_list
+                            if self._has_capacity(sp['name']) and self._queues[sp['name']][0] is waiter]
+                    if free:
+                        return self._grant(select(platform_type, free), time.monotonic() - waiter.since)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        for sp_name in waiter.names:
+                            self._count(sp_name, 'timeouts')
+                        _LOG.warning(f'Test plan {owner} found no capacity on {", ".join(waiter.names)} '
+                                     f'after {time.monotonic() - waiter.since:.0f}s')
+                        return None
+                    self._cond.wait(remaining)
+            finally:
+                for sp_name in waiter.names:
+                    self._queues[sp_name].remove(waiter)
+                    if not self._queues[sp_name]:
+                        del self._queues[sp_name]
+                self._waiters[owner].remove(waiter)
+                if not self._waiters[owner]:
+                    del self._waiters[owner]
+                self._cond.notify_all()
+
+    def withdraw(self, owner):
+        """
+        Stops every wait of a plan for capacity, e.g. when it is cancelled
+        :return: True if the plan was waiting
+        """
+        with self._cond:
+            waiters = self._waiters.get(owner)
+            if not waiters:
+                return False
+            for waiter in waiters:
+                waiter.cancelled = True
+            self._cond.notify_all()
+            return True
+
+    def adopt(self, sp_name):
+        """
+        Accounts an instance deployed before a restart
+        """
+        with self._cond:
+            self._in_use[sp_name] = self._in_use.get(sp_name, 0) + 1
+
+    def release(self, sp_name):
+        with self._cond:
+            if self._in_use.get(sp_name):
+                self._in_use[sp_name] -= 1
+                self._cond.notify_all()
+
+    def record_success(self, sp_name):
+        with self._cond:
+            learned = self._learned.get(sp_name)
+            if learned is None:
+                return
+            configured = self.capacity.get(sp_name.lower(), self.default_capacity)
+            learned += 1 / learned
+            if configured and learned >= configured:
+                del self._learned[sp_name]
+                _LOG.info(f'Capacity of {sp_name} back to {configured}')
+            else:
+                self._learned[sp_name] = learned
+            self._cond.notify_all()
+
+    def record_failure(self, sp_name):
+        with self._cond:
+            self._count(sp_name, 'failures')
+            if not self.adaptive:
+                return
+            current = self._learned.get(sp_name) or self.limit(sp_name) or max(self._in_use.get(sp_name, 0), 1)
+            self._learned[sp_name] = max(1.0, current * self.backoff_ratio)
+            _LOG.warning(f'Instantiation failed on {sp_name}, capacity lowered to {self.limit(sp_name)}')
+
+    def stats(self):
+        with self._cond:
+            names = set(self._in_use) | set(self._queues) | set(self._counters) | set(self._learned)
+            platforms = {}
+            for sp_name in names:
+                counters = self._counters.get(sp_name, {})
+                queue = self._queues.get(sp_name, ())
+                platforms[sp_name] = {
+                    'limit': self.limit(sp_name) or None,
+                    'in_use': self._in_use.get(sp_name, 0),
+                    'queued': len(queue),
+                    'oldest_wait': round(time.monotonic() - queue[0].since, 3) if queue else 0,
+                    'granted': counters.get('granted', 0),
+                    'waited': counters.get('waited', 0),
+                    'avg_wait': round(counters['wait_time'] / counters['waited'], 3) if counters.get('waited') else 0,
+                    'max_wait': round(counters.get('max_wait', 0), 3),
+                    'timeouts': counters.get('timeouts', 0),
+                    'failures': counters.get('failures', 0)
+                }
+            return {
+                'default_capacity': self.default_capacity,
+                'adaptive': self.adaptive,
+                'max_wait': self.max_wait,
+                'waiting': self._waiting(),
+                'platforms': platforms
+            }
+
+    def _waiting(self):
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _has_capacity(self, sp_name):
+        limit = self.limit(sp_name)
+        return not limit or self._in_use.get(sp_name, 0) < limit
+
+    def _grant(self, platform, waited):
+        sp_name = platform['name']
+        self._in_use[sp_name] = self._in_use.get(sp_name, 0) + 1
+        self._count(sp_name, 'granted')
+        if waited is not None:
+            self._count(sp_name, 'waited')
+            self._count(sp_name, 'wait_time', waited)
+            counters = self._counters[sp_name]
+            counters['max_wait'] = max(counters.get('max_wait', 0), waited)
+            _LOG.debug(f'Capacity on {sp_name} granted after {waited:.1f}s')
+        return platform
+
+    def _count(self, sp_name, key, value=1):
+        counters = self._counters.setdefault(sp_name, {})
+        counters[key] = counters.get(key, 0) + value
@@ -0,0 +1,170 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import os
+import logging
+import threading
+import traceback
+from queue import Full
+from concurrent.futures import ThreadPoolExecutor
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:scheduler', log_level=logging.DEBUG, log_json=True)
+
+ADMISSION = 'admission'
+CLEANUP = 'cleanup'
+CANCELLATION = 'cancellation'
+STAGES = 'stages'
+PULLS = 'pulls'
+TEARDOWN = 'teardown'
+ENVIRONMENTS = 'environments'
+
+# pool name: (env var for workers, default workers, env var for queue limit)
+DEFAULT_POOLS = {
+    ADMISSION: ('CURATOR_ADMISSION_WORKERS', 32, 'CURATOR_ADMISSION_QUEUE'),
+    CLEANUP: ('CURATOR_CLEANUP_WORKERS', 8, 'CURATOR_CLEANUP_QUEUE'),
+    CANCELLATION: ('CURATOR_CANCELLATION_WORKERS', 8, 'CURATOR_CANCELLATION_QUEUE'),
+    STAGES: ('CURATOR_STAGE_WORKERS', 32, 'CURATOR_STAGE_QUEUE'),
+    PULLS: ('CURATOR_PULL_WORKERS', 8, 'CURATOR_PULL_QUEUE'),
+    TEARDOWN: ('CURATOR_TEARDOWN_WORKERS', 8, 'CURATOR_TEARDOWN_QUEUE'),
+    ENVIRONMENTS: ('CURATOR_ENVIRONMENT_WORKERS', 16, 'CURATOR_ENVIRONMENT_QUEUE'),
+}
+
+
+class WorkerPool:
+    """
+    Bounded executor with accounting of queued, running and finished work.
+    Finished futures are reaped as soon as they complete, so nothing keeps
+    growing while the curator is under sustained load.
+    """
+    def __init__(self, name, workers, max_queued=0):
+        self.name = name
+        self.workers = workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'curator-{name}')
+        self._lock = threading.Lock()
+        self._active = set()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.name}, workers={self.workers})'
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self.max_queued and self.queued >= self.max_queued:
+                self.rejected += 1
+                raise Full(f'{self.name} queue is full ({self.queued} tasks waiting)')
+            self.queued += 1
+        future = self._executor.submit(self._run, fn, *args, **kwargs)
+        with self._lock:
+            self._active.add(future)
+        future.add_done_callback(self._reap)
+        return future
+
+    def _run(self, fn, *args, **kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def _reap(self, future):
+        with self._lock:
+            self._active.discard(future)
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            tb = "".join(traceback.format_exception(type(e), e, e.__traceback__)).replace('\n', ' ')
+            _LOG.error(f'Task in {self.name} pool failed: {tb}')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_queued': self.max_queued,
+                'queued': self.queued,
+                'running': self.running,
+                'active': len(self._active),
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class Scheduler:
+    """
+    Holds one bounded WorkerPool per kind of background work (admission of
+    new test plans, setup stages running alongside them, probe image pulls,
+    environment cleanup, instance terminations and network prunes, and
+    cancellation), so that a burst of one kind cannot starve the others.
+    Pool sizes are read from the environment, e.g. CURATOR_ADMISSION_WORKERS,
+    and an optional queue limit from CURATOR_ADMISSION_QUEUE (0 = unbounded).
+    """
+    def __init__(self, pools=None):
+        self.pools = {}
+        for name, (workers_var, default_workers, queue_var) in (pools or DEFAULT_POOLS).items():
+            workers = int(os.getenv(workers_var, default_workers))
+            max_queued = int(os.getenv(queue_var, 0))
+            self.pools[name] = WorkerPool(name, workers, max_queued=max_queued)
+            _LOG.debug(f'Scheduler pool {name}: workers={workers}, max_queued={max_queued}')
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({", ".join(self.pools.keys())})'
+
+    def submit(self, pool, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) on the given pool
+        :param pool: one of ADMISSION, STAGES, PULLS, CLEANUP, TEARDOWN, CANCELLATION, ENVIRONMENTS
+        :param fn:
+        :return: concurrent.futures.Future
+        :raises queue.Full: if the pool queue limit has been reached
+        """
+        return self.pools[pool].submit(fn, *args, **kwargs)
+
+    def queue_depth(self, pool):
+        return self.pools[pool].stats()['queued']
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+    def shutdown(self, wait=True):
+        for pool in self.pools.values():
+            pool.shutdown(wait=wait)
@@ -0,0 +1,83 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+"""
+Measures what persisting test plan state costs on the request path: the
+time spent in persist() for a burst of plan transitions, and how the
+write-behind store batches and coalesces them.
+
+    python -m curator.tests.bench_state_store [plans] [transitions per plan] [callbacks/s]
+"""
+
+import os
+import sys
+import time
+import tempfile
+from curator.database import SQLiteStateStore, context, persist
+from curator.models import AugmentedDescriptor, TestPlan, TestStatus
+
+
+def _test_plan(test_plan_uuid, functions):
+    test_plan = TestPlan.from_payload(test_plan_uuid, {
+        'nsd': {'vendor': 'eu.5gtango', 'name': 'ns-test', 'version': '0.1'},
+        'testd': {'name': 'test-immersive-media', 'phases': [{'id': 'setup', 'steps': []}]},
+        'test_plan_callbacks': [{'url': '/cb', 'status': 'COMPLETED'}]
+    })
+    test_plan.augmented_descriptors = [AugmentedDescriptor(f'{test_plan_uuid}-instance', nsi_uuid=test_plan_uuid,
+                                                           functions=functions, platform_name='sp1')]
+    test_plan.instances = {f'{test_plan_uuid}-instance': 'sp1'}
+    return test_plan
+
+
+def main(plans=100, transitions=4, rate=400):
+    functions = [{'id': f'vnf-{i}', 'endpoints': [{'id': 'ext', 'address': f'10.0.0.{i}'}]} for i in range(5)]
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteStateStore(os.path.join(directory, 'state.db'))
+        context['store'] = store
+        context['test_preparations'] = {f'plan-{i}': _test_plan(f'plan-{i}', functions) for i in range(plans)}
+        statuses = [TestStatus.STARTING, TestStatus.RUNNING, TestStatus.COMPLETED, TestStatus.FINISHED]
+        costs = []
+        start = time.monotonic()
+        for step in range(transitions):
+            for test_plan_uuid, test_plan in context['test_preparations'].items():
+                test_plan.augmented_descriptors[0].test_status = statuses[step % len(statuses)]
+                before = time.perf_counter()
+                persist(test_plan_uuid)
+                costs.append(time.perf_counter() - before)
+                # Paced like the callbacks that trigger the transitions
+                time.sleep(max(0.0, start + len(costs) / rate - time.monotonic()))
+        store.close()
+        costs.sort()
+        stats = store.stats()
+        print(f'{len(costs)} persist() calls at {rate}/s, '
+              f'mean {sum(costs) / len(costs) * 1000:.3f} ms, '
+              f'p99 {costs[int(len(costs) * 0.99)] * 1000:.3f} ms')
+        print(f'{stats["writes"]} row writes in {stats["batches"]} batches, {stats["coalesced"]} coalesced')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
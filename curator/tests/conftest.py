@@ -0,0 +1,190 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import pytest
+import curator.helpers as helpers
+import curator.models as models
+from curator.database import context, index, StateStore
+from curator.balancer import LoadBalancer
+from curator.quotas import PlatformQuotas
+from curator.instances import InstancePool
+from curator.timers import DeadlineService, INSTANTIATION, CANCELLATION
+from curator.interfaces.resilience import RateLimitError
+from curator.interfaces.docker_interface import DockerClientPool
+
+NSD = {'vendor': 'eu.5gtango', 'name': 'ns-test', 'version': '0.1'}
+TD = {'name': 'test'}
+
+
+class FakePlatformAdapter:
+    """
+    Instantiates on the platforms in ready right away, rejects those in
+    throttled as the curator's rate limits would, and never answers for the
+    others. Every instance it runs is ready
+    """
+    def __init__(self):
+        self.ready = set()
+        self.throttled = set()
+        self.calls = []
+
+    def automated_instantiation_sonata(self, service_platform, service_name, service_vendor, service_version,
+                                       instance_name, test_plan_uuid, policy_id=None):
+        self.calls.append(('instantiate', service_platform, instance_name))
+        if service_platform in self.throttled:
+            raise RateLimitError(f'{service_platform} is rate limited')
+        if service_platform in self.ready:
+            index.add_descriptor(test_plan_uuid, models.AugmentedDescriptor(
+                instance_name, nsi_uuid=f'nsi-{instance_name}', functions=[], platform_type='sonata'))
+            context['events'][test_plan_uuid][instance_name].set()
+        return {'package_id': 'package'}
+
+    def available_platforms_by_type(self, platform_type):
+        return [{'name': 'sp1'}, {'name': 'sp2'}]
+
+    def get_service_instantiation(self, service_platform, instance_uuid):
+        self.calls.append(('check', service_platform, instance_uuid))
+        return {'status': 'READY'}
+
+    def shutdown_package(self, service_platform, instance_uuid, package_uploaded):
+        self.calls.append(('shutdown', service_platform, instance_uuid))
+        return {}
+
+
+class FakePlanner:
+    """
+    Records the callbacks sent to the planner as (test plan, status), and
+    the exception of the last one
+    """
+    def __init__(self):
+        self.callbacks = []
+        self.exception = None
+
+    def send_callback(self, suffix, test_plan_uuid, result_list, status='UNKNOWN', event_actor='Curator',
+                      exception=None):
+        self.callbacks.append((test_plan_uuid, status))
+        self.exception = exception
+
+
+class FakeExecutor:
+    """
+    Confirms right away the cancellation of the tests in confirming, as its
+    callback would, and fails to cancel those in failing
+    """
+    def __init__(self):
+        self.confirming = set()
+        self.failing = set()
+
+    def execution_cancel(self, test_plan_uuid, test_uuid):
+        if test_uuid in self.failing:
+            raise ConnectionError('executor unreachable')
+        if test_uuid in self.confirming:
+            context['events'][test_plan_uuid][test_uuid].set()
+        return {}
+
+
+class FakeAdmission:
+    def __init__(self):
+        self.released = []
+
+    def release(self, test_plan_uuid):
+        self.released.append(test_plan_uuid)
+
+
+class FakeCleanup:
+    """
+    Runs terminations right away on the calling thread
+    """
+    def terminate(self, owner, fn, *args):
+        fn(*args)
+
+    def drain(self, owner, timeout=None):
+        return True
+
+    def prune(self, execution_host):
+        pass
+
+
+class FakeStore(StateStore):
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, test_plan_uuid):
+        self.deleted.append(test_plan_uuid)
+
+
+@pytest.fixture
+def curator(monkeypatch):
+    """
+    Curator context with a fake platform adapter and short instantiation
+    timeouts, the plans created with new_test_plan() are removed afterwards
+    """
+    timers = DeadlineService(timeouts={INSTANTIATION: ('CURATOR_TEST_INSTANTIATION_TIMEOUT', 0.05),
+                                       CANCELLATION: ('CURATOR_TEST_CANCELLATION_TIMEOUT', 0.1)}, tick=0.01)
+    platform_adapter = FakePlatformAdapter()
+    monkeypatch.setitem(context, 'test_preparations', {})
+    monkeypatch.setitem(context, 'events', {})
+    monkeypatch.setitem(context, 'plugins', {'platform_adapter': platform_adapter, 'planner': FakePlanner(),
+                                             'executor': FakeExecutor()})
+    monkeypatch.setitem(context, 'admission', FakeAdmission())
+    monkeypatch.setitem(context, 'timers', timers)
+    monkeypatch.setitem(context, 'balancer', LoadBalancer(cooldown=0))
+    monkeypatch.setitem(context, 'quotas', PlatformQuotas(capacity={}, default_capacity=0, adaptive=False,
+                                                          max_wait=1))
+    monkeypatch.setitem(context, 'instances', InstancePool(lambda warm: None, enabled=False))
+    monkeypatch.setitem(context, 'dockers', DockerClientPool(None))
+    monkeypatch.setitem(context, 'cleanup', FakeCleanup())
+    monkeypatch.setitem(context, 'store', None)
+    yield platform_adapter
+    timers.stop()
+    for test_plan_uuid in list(context['test_preparations']):
+        index.remove_plan(test_plan_uuid)
+
+
+def new_test_plan(test_plan_uuid='plan'):
+    test_plan = models.TestPlan(test_plan_uuid)
+    test_plan.augmented_descriptors = []
+    context['test_preparations'][test_plan_uuid] = test_plan
+    context['events'][test_plan_uuid] = {}
+    return test_plan
+
+
+def reserve(test_plan, sp_name):
+    """
+    Reserves sp_name and registers the instance as select_platform() would
+    :return: (service platform, instance name)
+    """
+    service_platform = context['quotas'].reserve(test_plan.uuid, 'sonata', [{'name': sp_name}],
+                                                 context['balancer'].select)
+    return service_platform, helpers.register_instance(test_plan, TD, NSD, service_platform)
+
+
+def in_use(sp_name):
+    """
+    :return: (quota slots in use, instances in flight in the balancer) on sp_name
+    """
+    return context['quotas'].stats()['platforms'].get(sp_name, {}).get('in_use', 0), \
+        context['balancer'].in_flight.get(sp_name, 0)
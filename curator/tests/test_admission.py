@@ -0,0 +1,144 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+import threading
+from queue import Full
+import pytest
+from curator.admission import AdmissionController, parse_limits, platform_type_hint
+
+
+def _wait(predicate, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def dispatched():
+    return []
+
+
+@pytest.fixture
+def admission(dispatched):
+    lock = threading.Lock()
+
+    def dispatch(test_plan_uuid):
+        with lock:
+            dispatched.append(test_plan_uuid)
+
+    controller = AdmissionController(dispatch, max_in_flight=1, type_limits={}, max_queued=3, retry_after=5)
+    yield controller
+    controller.stop()
+
+
+def test_parse_limits():
+    assert parse_limits('sonata=10, OSM=4') == {'sonata': 10, 'osm': 4}
+    assert parse_limits('') == {}
+    assert parse_limits('bogus') == {}
+
+
+def test_platform_type_hint():
+    assert platform_type_hint({'sp_type': 'OSM'}) == 'osm'
+    assert platform_type_hint({'nsd': {'platform': '5gtango'}}) == 'sonata'
+    assert platform_type_hint({'testd': {'service_platforms': ['SONATA']}}) == 'sonata'
+    assert platform_type_hint({'testd': {'service_platforms': ['SONATA', 'OSM']}}) is None
+
+
+def test_dispatches_right_away_with_capacity(admission, dispatched):
+    assert admission.submit('a') == 0
+    assert _wait(lambda: dispatched == ['a'])
+    assert admission.stats()['in_flight'] == 1
+
+
+def test_higher_priority_first_fifo_among_equals(admission, dispatched):
+    admission.submit('running')
+    assert _wait(lambda: dispatched == ['running'])
+    admission.submit('low-1')
+    admission.submit('low-2')
+    admission.submit('high', priority=5)
+    assert admission.position('high') == 1
+    assert admission.position('low-2') == 3
+    for expected in ('high', 'low-1', 'low-2'):
+        admission.release(dispatched[-1])
+        assert _wait(lambda: dispatched[-1] == expected)
+
+
+def test_rejects_when_queue_is_full(admission, dispatched):
+    admission.submit('running')
+    assert _wait(lambda: dispatched == ['running'])
+    for i in range(3):
+        admission.submit(f'queued-{i}')
+    with pytest.raises(Full):
+        admission.submit('one-too-many')
+    assert admission.stats()['rejected'] == 1
+
+
+def test_removed_plan_is_never_dispatched(admission, dispatched):
+    admission.submit('running')
+    assert _wait(lambda: dispatched == ['running'])
+    admission.submit('cancelled')
+    admission.submit('next')
+    assert admission.remove('cancelled')
+    assert not admission.remove('cancelled')
+    admission.release('running')
+    assert _wait(lambda: dispatched == ['running', 'next'])
+
+
+def test_saturated_type_does_not_block_others(dispatched):
+    admission = AdmissionController(dispatched.append, max_in_flight=0, type_limits={'osm': 1}, max_queued=10)
+    try:
+        admission.submit('osm-1', platform_type='osm')
+        assert _wait(lambda: dispatched == ['osm-1'])
+        admission.submit('osm-2', platform_type='osm')
+        admission.submit('sonata-1', platform_type='sonata')
+        assert _wait(lambda: dispatched == ['osm-1', 'sonata-1'])
+        assert admission.is_queued('osm-2')
+        admission.release('osm-1')
+        assert _wait(lambda: dispatched[-1] == 'osm-2')
+    finally:
+        admission.stop()
+
+
+def test_requeues_when_worker_pool_is_full():
+    attempts = []
+
+    def dispatch(test_plan_uuid):
+        attempts.append(test_plan_uuid)
+        if len(attempts) == 1:
+            raise Full()
+
+    admission = AdmissionController(dispatch, max_in_flight=0, type_limits={}, max_queued=10)
+    try:
+        admission.submit('a')
+        assert _wait(lambda: attempts == ['a', 'a'], timeout=3)
+        assert admission.stats()['admitted'] == 1
+    finally:
+        admission.stop()
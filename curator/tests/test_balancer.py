@@ -0,0 +1,136 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+from collections import Counter
+import pytest
+from curator.balancer import EWMABalancer, LeastInFlightBalancer, LoadBalancer, WeightedRoundRobinBalancer, \
+    get_balancer
+
+SP = [{'name': name} for name in ('sp1', 'sp2', 'sp3')]
+
+
+def _picks(balancer, sp_list, count):
+    return Counter(balancer.select('sonata', sp_list)['name'] for _ in range(count))
+
+
+def test_first_available():
+    assert LoadBalancer(cooldown=0).select('sonata', SP)['name'] == 'sp1'
+
+
+def test_unknown_algorithm_falls_back_to_first():
+    assert isinstance(get_balancer('bogus'), LoadBalancer)
+    assert get_balancer('least_in_flight').name == 'least_in_flight'
+
+
+def test_failed_platform_cools_down():
+    balancer = LoadBalancer(cooldown=60)
+    balancer.failed('sp1')
+    assert balancer.select('sonata', SP)['name'] == 'sp2'
+    # Still used if it is the only one
+    assert balancer.select('sonata', SP[:1])['name'] == 'sp1'
+    balancer.observe('sp1', 1.0)
+    assert balancer.select('sonata', SP)['name'] == 'sp1'
+
+
+def test_cooldown_doubles_with_consecutive_failures():
+    balancer = LoadBalancer(cooldown=10)
+    balancer.failed('sp1')
+    balancer.failed('sp1')
+    assert 19 < balancer.stats()['platforms']['sp1']['avoided_for'] <= 20
+
+
+def test_least_in_flight_spreads_instances():
+    balancer = LeastInFlightBalancer(cooldown=0)
+    for _ in range(6):
+        balancer.acquire(balancer.select('sonata', SP)['name'])
+    assert balancer.in_flight == {'sp1': 2, 'sp2': 2, 'sp3': 2}
+    balancer.release('sp2')
+    assert balancer.select('sonata', SP)['name'] == 'sp2'
+
+
+def test_least_in_flight_skips_excluded_platforms():
+    balancer = LeastInFlightBalancer(cooldown=0)
+    balancer.acquire('sp2')
+    balancer.acquire('sp3')
+    assert balancer.select('sonata', SP)['name'] == 'sp1'
+    # sp1 ranks first but is left out, it stays in the heap for the next pick
+    assert balancer.select('sonata', SP[1:])['name'] in ('sp2', 'sp3')
+    assert balancer.select('sonata', SP)['name'] == 'sp1'
+
+
+def test_heap_is_kept_across_candidate_changes():
+    balancer = LeastInFlightBalancer(cooldown=0)
+    for i in range(200):
+        sp_name = balancer.select('sonata', [SP[i % 3], SP[(i + 1) % 3]])['name']
+        balancer.acquire(sp_name)
+        balancer.release(sp_name)
+    heap = balancer._heaps['sonata']
+    assert len(heap) <= 4 * len(balancer._members['sonata']) + 16
+    assert balancer._members['sonata'] == {'sp1', 'sp2', 'sp3'}
+
+
+def test_platforms_are_balanced_per_type():
+    balancer = LeastInFlightBalancer(cooldown=0)
+    balancer.acquire('sp1')
+    assert balancer.select('osm', [{'name': 'osm1'}, {'name': 'osm2'}])['name'] == 'osm1'
+    assert balancer.select('sonata', SP)['name'] == 'sp2'
+
+
+def test_weighted_round_robin_follows_weights():
+    balancer = WeightedRoundRobinBalancer(weights={'sp1': 3, 'sp2': 1}, cooldown=0)
+    assert _picks(balancer, SP[:2], 400) == {'sp1': 300, 'sp2': 100}
+
+
+def test_weighted_round_robin_uses_platform_weight():
+    balancer = WeightedRoundRobinBalancer(weights={}, cooldown=0)
+    assert _picks(balancer, [{'name': 'sp1', 'weight': 2}, {'name': 'sp2'}], 300) == {'sp1': 200, 'sp2': 100}
+
+
+def test_late_platform_starts_from_the_current_time():
+    balancer = WeightedRoundRobinBalancer(weights={}, cooldown=0)
+    _picks(balancer, SP[:2], 100)
+    # sp3 does not get the 100 picks it missed
+    assert _picks(balancer, SP, 300) == {'sp1': 100, 'sp2': 100, 'sp3': 100}
+
+
+def test_ewma_prefers_fast_platforms():
+    balancer = EWMABalancer(cooldown=0)
+    balancer.observe('sp1', 10.0)
+    balancer.observe('sp2', 1.0)
+    balancer.observe('sp3', 4.0)
+    assert balancer.select('sonata', SP)['name'] == 'sp2'
+    for _ in range(4):
+        balancer.acquire('sp2')
+    assert balancer.select('sonata', SP)['name'] == 'sp3'
+
+
+@pytest.mark.parametrize('algorithm', ['least_in_flight', 'weighted_round_robin', 'ewma'])
+def test_selection_only_returns_candidates(algorithm):
+    balancer = get_balancer(algorithm)
+    for i in range(50):
+        candidates = SP[i % 3:] or SP
+        assert balancer.select('sonata', candidates) in candidates
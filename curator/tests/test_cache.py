@@ -0,0 +1,210 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+import pytest
+from curator.cache import DescriptorCache, PackageIndex
+from curator.interfaces.common_databases_interface import CatalogueInterface
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=None, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def json(self):
+        return self.content
+
+
+class FakeHttp:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def get(self, url, headers=None):
+        self.calls.append((url, dict(headers or {})))
+        return self.responses.pop(0)
+
+
+def test_fresh_entries_are_copies():
+    cache = DescriptorCache(max_entries=4, ttl=60)
+    cache.put('/nsd', {'name': 'ns'})
+    value, stale = cache.get('/nsd')
+    assert (value, stale) == ({'name': 'ns'}, None)
+    value['name'] = 'changed'
+    assert cache.get('/nsd')[0] == {'name': 'ns'}
+    assert cache.get('/other') == (None, None)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_expired_entries_are_returned_for_revalidation():
+    cache = DescriptorCache(max_entries=4, ttl=0.02)
+    cache.put('/nsd', {'name': 'ns'}, etag='"v1"', last_modified='Wed, 01 May 2019 12:00:00 GMT')
+    time.sleep(0.03)
+    value, stale = cache.get('/nsd')
+    assert value is None
+    assert (stale.etag, stale.last_modified) == ('"v1"', 'Wed, 01 May 2019 12:00:00 GMT')
+    assert cache.refresh('/nsd') == {'name': 'ns'}
+    assert cache.get('/nsd') == ({'name': 'ns'}, None)
+    assert cache.refresh('/evicted') is None
+    assert cache.revalidated == 1
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = DescriptorCache(max_entries=2, ttl=60)
+    cache.put('/a', 1)
+    cache.put('/b', 2)
+    cache.get('/a')
+    cache.put('/c', 3)
+    assert cache.get('/b') == (None, None)
+    assert cache.get('/a')[0] == 1 and cache.get('/c')[0] == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = DescriptorCache(max_entries=0, ttl=60)
+    cache.put('/a', 1)
+    assert cache.get('/a') == (None, None)
+
+
+def test_invalidate_by_match():
+    cache = DescriptorCache(max_entries=4, ttl=60)
+    cache.put('/network-services/1234', 1)
+    cache.put('/tests/1234', 2)
+    cache.put('/tests/5678', 3)
+    assert cache.invalidate('1234') == 2
+    assert cache.get('/tests/5678')[0] == 3
+    assert cache.invalidate() == 1
+    assert cache.stats()['entries'] == 0
+
+
+def test_catalogue_revalidates_stale_descriptors(monkeypatch):
+    monkeypatch.setenv('CAT_BASE', 'http://catalogue')
+    catalogue = CatalogueInterface()
+    catalogue.cache = DescriptorCache(max_entries=4, ttl=0)
+    catalogue.http = FakeHttp(
+        FakeResponse(200, {'nsd': {'name': 'ns'}}, {'ETag': '"v1"'}),
+        FakeResponse(304)
+    )
+    assert catalogue.get_network_descriptor('1234') == {'nsd': {'name': 'ns'}}
+    assert catalogue.get_network_descriptor('1234') == {'nsd': {'name': 'ns'}}
+    (url, headers), (_, conditional) = catalogue.http.calls
+    assert url == 'http://catalogue/api/v2/network-services/1234'
+    assert 'If-None-Match' not in headers
+    assert conditional['If-None-Match'] == '"v1"'
+    assert catalogue.cache.revalidated == 1
+
+
+def test_catalogue_serves_fresh_descriptors_from_cache(monkeypatch):
+    monkeypatch.setenv('CAT_BASE', 'http://catalogue')
+    catalogue = CatalogueInterface()
+    catalogue.cache = DescriptorCache(max_entries=4, ttl=60)
+    catalogue.http = FakeHttp(FakeResponse(200, {'td': {'name': 'test'}}))
+    for _ in range(3):
+        assert catalogue.get_test_descriptor('5678') == {'td': {'name': 'test'}}
+    assert len(catalogue.http.calls) == 1
+
+
+def _package(package_uuid, *nsds, updated_at='2019-05-01'):
+    nsd_type = PackageIndex.NSD_CONTENT_TYPE
+    return {
+        'uuid': package_uuid,
+        'updated_at': updated_at,
+        'pd': {'package_content': [
+            {'content-type': nsd_type, 'id': {'vendor': 'eu.5gtango', 'name': nsd, 'version': '0.1'}}
+            for nsd in nsds
+        ] + [{'content-type': 'application/vnd.5gtango.vnfd', 'id': {'vendor': 'eu.5gtango', 'name': 'vnf'}}]}
+    }
+
+
+class FakeInventory:
+    def __init__(self, *packages):
+        self.packages = list(packages)
+        self.etag = '"1"'
+        self.etags = []
+
+    def __call__(self, etag):
+        self.etags.append(etag)
+        if etag == self.etag:
+            return None, etag
+        return iter(self.packages), self.etag
+
+
+def test_package_index_lookup():
+    inventory = FakeInventory(_package('p1', 'ns-a'), _package('p2', 'ns-b', 'ns-c'), _package('p3'))
+    packages = PackageIndex(inventory, ttl=60, min_refresh=60)
+    assert [p['uuid'] for p in packages.lookup('eu.5gtango', 'ns-c', '0.1')] == ['p2']
+    assert packages.lookup('eu.5gtango', 'ns-a', '0.1') == [{'uuid': 'p1', 'pd': _package('p1', 'ns-a')['pd']}]
+    assert packages.lookup('eu.5gtango', 'ns-x', '0.1') == []
+    assert inventory.etags == [None]
+    stats = packages.stats()
+    assert (stats['packages'], stats['nsds'], stats['parsed']) == (2, 3, 3)
+
+
+def test_package_index_refresh_reindexes_only_changes():
+    inventory = FakeInventory(_package('p1', 'ns-a'), _package('p2', 'ns-b'))
+    packages = PackageIndex(inventory, ttl=0, min_refresh=0)
+    packages.refresh()
+    packages.refresh()
+    assert packages.not_modified == 1
+    inventory.etag = '"2"'
+    inventory.packages = [_package('p1', 'ns-a'), _package('p2', 'ns-c', updated_at='2019-05-02')]
+    packages.refresh()
+    assert inventory.etags == [None, '"1"', '"1"']
+    assert packages.reindexed == 3
+    assert packages.lookup('eu.5gtango', 'ns-b', '0.1') == []
+    assert [p['uuid'] for p in packages.lookup('eu.5gtango', 'ns-c', '0.1')] == ['p2']
+    inventory.etag = '"3"'
+    inventory.packages = [_package('p2', 'ns-c', updated_at='2019-05-02')]
+    packages.refresh()
+    assert packages.lookup('eu.5gtango', 'ns-a', '0.1') == []
+    assert packages.stats()['packages'] == 1
+
+
+def test_package_index_miss_forces_refresh():
+    inventory = FakeInventory(_package('p1', 'ns-a'))
+    packages = PackageIndex(inventory, ttl=60, min_refresh=0)
+    packages.lookup('eu.5gtango', 'ns-a', '0.1')
+    inventory.etag = '"2"'
+    inventory.packages.append(_package('p2', 'ns-new'))
+    assert [p['uuid'] for p in packages.lookup('eu.5gtango', 'ns-new', '0.1')] == ['p2']
+    assert packages.misses == 1 and packages.refreshes == 2
+
+
+def test_catalogue_finds_the_package_of_an_nsd(monkeypatch):
+    monkeypatch.setenv('CAT_BASE', 'http://catalogue')
+    package = _package('p1', 'ns-a')
+    package['pd'].update(vendor='eu.5gtango', name='ns-a-package', version='1.0', package_file_uuid='f1',
+                         package_file_name='ns-a.tgo')
+    catalogue = CatalogueInterface()
+    catalogue.packages = PackageIndex(FakeInventory(package, _package('p2', 'ns-b')), ttl=60, min_refresh=60)
+    assert catalogue.get_package_id_from_nsd_tuple('eu.5gtango', 'ns-a', '0.1') == {
+        'uuid': 'p1', 'vendor': 'eu.5gtango', 'name': 'ns-a-package', 'version': '1.0', 'package_file_uuid': 'f1',
+        'package_file_name': 'ns-a.tgo'}
+    with pytest.raises(FileNotFoundError):
+        catalogue.get_package_id_from_nsd_tuple('eu.5gtango', 'ns-x', '0.1')
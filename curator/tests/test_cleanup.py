@@ -0,0 +1,160 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from curator.cleanup import CleanupQueue
+
+
+class FakeDocker:
+    def __init__(self, execution_host, pruned):
+        self.execution_host = execution_host
+        self.pruned = pruned
+
+    def network_prune(self):
+        if self.execution_host == 'tcp://broken:2375':
+            raise ConnectionError('unreachable')
+        self.pruned.append(self.execution_host)
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown(wait=False)
+
+
+@pytest.fixture
+def pruned():
+    return []
+
+
+@pytest.fixture
+def leased():
+    return []
+
+
+def _queue(executor, pruned, leased, debounce):
+    def connect(execution_host):
+        leased.append(execution_host)
+        return FakeDocker(execution_host, pruned)
+    return CleanupQueue(executor.submit, connect, lambda dockeri: leased.remove(dockeri.execution_host),
+                        debounce=debounce)
+
+
+def _wait(predicate, timeout=2):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_terminations_are_drained_per_plan(executor, pruned, leased):
+    cleanup = _queue(executor, pruned, leased, debounce=0)
+    release = threading.Event()
+    cleanup.terminate('plan-1', release.wait, 2)
+    cleanup.terminate('plan-2', lambda: None)
+    assert cleanup.drain('plan-2', timeout=2)
+    assert not cleanup.drain('plan-1', timeout=0.05)
+    assert cleanup.backlog() == 1
+    release.set()
+    assert cleanup.drain('plan-1', timeout=2)
+    assert _wait(lambda: cleanup.backlog() == 0)
+    assert cleanup.stats()['terminated'] == 2
+    # Nothing queued for an unknown plan
+    assert cleanup.drain('plan-3', timeout=0)
+
+
+def test_failed_terminations_are_counted(executor, pruned, leased):
+    cleanup = _queue(executor, pruned, leased, debounce=0)
+
+    def fail():
+        raise RuntimeError('boom')
+    future = cleanup.terminate('plan-1', fail)
+    assert cleanup.drain('plan-1', timeout=2)
+    assert isinstance(future.exception(), RuntimeError)
+    assert _wait(lambda: cleanup.stats()['termination_failures'] == 1)
+    assert cleanup.stats()['terminated'] == 0
+
+
+def test_prunes_of_one_host_are_coalesced(executor, pruned, leased):
+    cleanup = _queue(executor, pruned, leased, debounce=0.2)
+    for _ in range(3):
+        cleanup.prune(None)
+    cleanup.prune('tcp://host-1:2375')
+    assert cleanup.stats()['prunes_pending'] == 2
+    # Nothing runs before the debounce is over
+    time.sleep(0.05)
+    assert pruned == []
+    assert _wait(lambda: cleanup.stats()['pruned'] == 2)
+    assert sorted(pruned, key=str) == [None, 'tcp://host-1:2375']
+    stats = cleanup.stats()
+    assert (stats['prunes_requested'], stats['prunes_coalesced']) == (4, 2)
+    assert leased == []
+
+
+def test_prunes_of_one_host_never_overlap(executor, pruned):
+    running = threading.Event()
+    release = threading.Event()
+    active = []
+    overlaps = []
+
+    class SlowDocker(FakeDocker):
+        def network_prune(self):
+            active.append(self.execution_host)
+            overlaps.append(len(active))
+            running.set()
+            release.wait(2)
+            active.remove(self.execution_host)
+            super().network_prune()
+    cleanup = CleanupQueue(executor.submit, lambda host: SlowDocker(host, pruned), lambda dockeri: None, debounce=0)
+    cleanup.prune(None)
+    assert running.wait(2)
+    # Asked for while the first prune runs, it waits for it
+    cleanup.prune(None)
+    time.sleep(0.1)
+    assert overlaps == [1]
+    assert cleanup.stats()['pruning'] == 1
+    release.set()
+    assert _wait(lambda: cleanup.stats()['pruned'] == 2)
+    assert overlaps == [1, 1]
+
+
+def test_failed_prunes_are_counted(executor, pruned, leased):
+    cleanup = _queue(executor, pruned, leased, debounce=0)
+    cleanup.prune('tcp://broken:2375')
+    assert _wait(lambda: cleanup.stats()['prune_failures'] == 1)
+    assert cleanup.stats()['pruning'] == 0
+    # The client is given back even if the prune fails
+    assert leased == []
+    # The host can be pruned again
+    cleanup.prune('tcp://broken:2375')
+    assert _wait(lambda: cleanup.stats()['prune_failures'] == 2)
@@ -0,0 +1,283 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+from datetime import datetime
+import pytest
+import curator.helpers as helpers
+import curator.models as models
+import curator.database as database
+from curator.timers import DeadlineService, EXECUTION
+from curator.database import PlanIndex, SQLiteStateStore, StateStore, context, drop_test_plan, index, persist
+
+
+def _test_plan(test_plan_uuid, **payload):
+    test_plan = models.TestPlan.from_payload(test_plan_uuid, dict({
+        'nsd': {'vendor': 'eu.5gtango', 'name': 'ns-test', 'version': '0.1'},
+        'testd': {'name': 'test-immersive-media'},
+        'test_plan_callbacks': [{'url': '/cb', 'status': 'COMPLETED'}],
+        'priority': 2,
+        'paths': {'kept': 'as is'}
+    }, **payload))
+    test_plan.created_at = datetime(2019, 5, 1, 12, 0, 0)
+    return test_plan
+
+
+def _started(test_plan_uuid, *descriptors, **payload):
+    test_plan = _test_plan(test_plan_uuid, **payload)
+    test_plan.augmented_descriptors = list(descriptors)
+    return test_plan
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteStateStore(str(tmp_path / 'state.db'), flush_interval=60)
+    yield store
+    store.close()
+
+
+def test_round_trip(store, tmp_path):
+    test_plan = _started('plan', models.AugmentedDescriptor('instance', nsi_uuid='nsi', platform_name='sp1',
+                                                            test_status=models.TestStatus.RUNNING, test_uuid='test'))
+    test_plan.instances = {'instance': 'sp1'}
+    test_plan.abandoned = {'timed-out': 'sp2'}
+    test_plan.docker_interface = object()
+    store.save('plan', test_plan)
+    store.close()
+    reopened = SQLiteStateStore(str(tmp_path / 'state.db'), flush_interval=60)
+    try:
+        test_plan = reopened.load_all()['plan']
+    finally:
+        reopened.close()
+    assert test_plan.priority == 2
+    assert test_plan.created_at == datetime(2019, 5, 1, 12, 0, 0)
+    assert test_plan.extra == {'paths': {'kept': 'as is'}}
+    assert test_plan.instances == {'instance': 'sp1'}
+    assert test_plan.abandoned == {'timed-out': 'sp2'}
+    assert test_plan.active_tests()[0].test_uuid == 'test'
+    # Live objects are not persisted
+    assert test_plan.docker_interface is None
+
+
+def test_transitions_coalesce_into_one_write(store):
+    test_plan = _started('plan', models.AugmentedDescriptor('instance'))
+    for status in (models.TestStatus.STARTING, models.TestStatus.RUNNING, models.TestStatus.COMPLETED):
+        test_plan.augmented_descriptors[0].test_status = status
+        store.save('plan', test_plan)
+    store.flush()
+    assert store.stats()['writes'] == 1
+    assert store.stats()['coalesced'] == 2
+    assert store.load_all()['plan'].augmented_descriptors[0].test_status is models.TestStatus.COMPLETED
+
+
+def test_plans_are_serialized_by_the_writer(store, monkeypatch):
+    serialized = []
+    serialize = database.serialize_test_plan
+    monkeypatch.setattr(database, 'serialize_test_plan', lambda test_plan: serialized.append(test_plan) or
+                        serialize(test_plan))
+    test_plan = _started('plan', models.AugmentedDescriptor('instance'))
+    for status in (models.TestStatus.STARTING, models.TestStatus.RUNNING):
+        test_plan.augmented_descriptors[0].test_status = status
+        store.save('plan', test_plan)
+    assert serialized == []
+    store.flush()
+    assert serialized == [test_plan]
+    assert store.load_all()['plan'].augmented_descriptors[0].test_status is models.TestStatus.RUNNING
+
+
+def test_plans_changed_while_serialized_are_written_with_the_next_batch(store, monkeypatch):
+    serialize = database.serialize_test_plan
+    changed = [RuntimeError('dictionary changed size during iteration')]
+
+    def serialize_test_plan(test_plan):
+        if changed:
+            raise changed.pop()
+        return serialize(test_plan)
+
+    monkeypatch.setattr(database, 'serialize_test_plan', serialize_test_plan)
+    store.save('plan', _test_plan('plan'))
+    store.flush()
+    assert store.stats()['pending'] == 1
+    assert list(store.load_all()) == ['plan']
+
+
+def test_delete_wins_over_pending_save(store):
+    store.save('plan', _test_plan('plan'))
+    store.flush()
+    store.save('plan', _test_plan('plan'))
+    store.delete('plan')
+    assert store.load_all() == {}
+
+
+def test_unreadable_state_is_discarded(store):
+    store.save('plan', _test_plan('plan'))
+    store.flush()
+    with store._conn:
+        store._conn.execute("INSERT INTO test_plans (uuid, state, updated) VALUES ('broken', '{}', 0)")
+    assert list(store.load_all()) == ['plan']
+
+
+def test_writer_thread_flushes_in_background(tmp_path):
+    store = SQLiteStateStore(str(tmp_path / 'state.db'), flush_interval=0.01)
+    try:
+        store.save('plan', _test_plan('plan'))
+        end = time.monotonic() + 2
+        while store.stats()['pending'] and time.monotonic() < end:
+            time.sleep(0.01)
+        assert store.stats()['pending'] == 0
+        assert store.stats()['batches'] >= 1
+    finally:
+        store.close()
+
+
+def test_persist_records_removal_of_dropped_plans(store, monkeypatch):
+    monkeypatch.setitem(context, 'store', store)
+    monkeypatch.setitem(context, 'test_preparations', {'plan': _test_plan('plan')})
+    persist('plan')
+    assert list(store.load_all()) == ['plan']
+    del context['test_preparations']['plan']
+    persist('plan')
+    assert store.load_all() == {}
+
+
+def test_memory_store_keeps_nothing():
+    store = StateStore()
+    store.save('plan', _test_plan('plan'))
+    assert store.load_all() == {}
+
+
+class FakeAdmission:
+    def __init__(self):
+        self.submitted = []
+        self.adopted = []
+
+    def submit(self, test_plan_uuid, platform_type=None, priority=0):
+        self.submitted.append((test_plan_uuid, platform_type, priority))
+
+    def adopt(self, test_plan_uuid):
+        self.adopted.append(test_plan_uuid)
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, pool, fn, *args):
+        self.submitted.append((fn, args))
+
+
+def test_recovery_resumes_plans_by_their_state(store, monkeypatch):
+    store.save('queued', _test_plan('queued', sp_type='OSM'))
+    store.save('running', _started('running', models.AugmentedDescriptor(
+        'instance', test_status=models.TestStatus.RUNNING, test_uuid='test-1')))
+    store.save('setup', _started('setup', models.AugmentedDescriptor('instance', test_status=models.TestStatus.ERROR)))
+    admission = FakeAdmission()
+    scheduler = FakeScheduler()
+    timers = DeadlineService()
+    timers.stop()
+    monkeypatch.setitem(context, 'timers', timers)
+    monkeypatch.setitem(context, 'store', store)
+    monkeypatch.setitem(context, 'test_preparations', {})
+    monkeypatch.setitem(context, 'events', {})
+    monkeypatch.setitem(context, 'admission', admission)
+    monkeypatch.setitem(context, 'scheduler', scheduler)
+    helpers.recover_test_plans()
+    assert set(context['test_preparations']) == {'queued', 'running', 'setup'}
+    assert admission.submitted == [('queued', 'osm', 2)]
+    assert admission.adopted == ['running']
+    # The tests left running are aborted if the executor never reports their end
+    assert timers.pending(EXECUTION, ('running', 'test-1'))
+    # Plans interrupted during their setup are aborted
+    assert scheduler.submitted == [(helpers.abort_recovered_test_plan, ('setup',))]
+    assert context['test_preparations']['setup'].recovered
+    # Callbacks of the recovered plans find their target
+    test_plan_uuid, augd = index.by_test('test-1')
+    assert augd is context['test_preparations']['running'].augmented_descriptors[0]
+    for test_plan_uuid in ('queued', 'running', 'setup'):
+        index.remove_plan(test_plan_uuid)
+
+
+@pytest.fixture
+def plans(monkeypatch):
+    plans = {}
+    monkeypatch.setitem(context, 'test_preparations', plans)
+    monkeypatch.setitem(context, 'store', None)
+    return plans
+
+
+def test_index_follows_descriptors_and_tests(plans):
+    plan_index = PlanIndex()
+    plans['plan'] = _started('plan')
+    plan_index.add_instance('plan', 'instance')
+    # Known before its sp-ready callback, but not reported yet
+    assert plan_index.by_instance('plan', 'instance') is None
+    augd = models.AugmentedDescriptor('instance', nsi_uuid='nsi')
+    plan_index.add_descriptor('plan', augd)
+    assert plans['plan'].augmented_descriptors == [augd]
+    assert plan_index.by_instance('plan', 'instance') is augd
+    assert plan_index.by_nsi('nsi') is augd
+    plan_index.set_test_uuid('plan', augd, 'test')
+    assert plan_index.by_test('test') == ('plan', augd)
+    # Instance names are only unique inside a plan
+    plans['other'] = _started('other')
+    plan_index.add_descriptor('other', models.AugmentedDescriptor('instance'))
+    assert plan_index.by_instance('plan', 'instance') is augd
+
+
+def test_index_replaces_results_of_the_same_test(plans):
+    plan_index = PlanIndex()
+    plans['plan'] = _started('plan')
+    plan_index.add_result('plan', models.TestResult('test', status=models.TestStatus.RUNNING))
+    plan_index.add_result('plan', models.TestResult('test', status=models.TestStatus.COMPLETED))
+    plan_index.add_result('plan', models.TestResult('other', status=models.TestStatus.COMPLETED))
+    assert [(result.test_uuid, result.status.value) for result in plans['plan'].test_results] == \
+        [('test', 'COMPLETED'), ('other', 'COMPLETED')]
+    assert plan_index.has_result('plan', 'test')
+    assert not plan_index.has_result('another-plan', 'test')
+
+
+def test_index_rebuild_and_removal(plans):
+    plan_index = PlanIndex()
+    plans['plan'] = _started('plan', models.AugmentedDescriptor('instance', nsi_uuid='nsi', test_uuid='test'))
+    plans['plan'].instances = {'pending': 'sp1'}
+    plans['plan'].test_results = [models.TestResult('test')]
+    plan_index.rebuild('plan')
+    assert plan_index.stats() == {'plans': 1, 'tests': 1, 'instances': 2, 'service_instances': 1, 'results': 1}
+    assert plan_index.by_nsi('nsi').test_uuid == 'test'
+    plan_index.remove_plan('plan')
+    assert plan_index.stats() == {'plans': 0, 'tests': 0, 'instances': 0, 'service_instances': 0, 'results': 0}
+
+
+def test_dropped_plans_leave_no_trace(plans, store, monkeypatch):
+    monkeypatch.setitem(context, 'store', store)
+    plans['plan'] = _started('plan')
+    index.add_descriptor('plan', models.AugmentedDescriptor('instance', nsi_uuid='nsi-dropped'))
+    persist('plan')
+    drop_test_plan('plan')
+    assert 'plan' not in plans
+    assert index.by_nsi('nsi-dropped') is None
+    assert store.load_all() == {}
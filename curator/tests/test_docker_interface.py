@@ -0,0 +1,163 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import threading
+import pytest
+from curator.interfaces.docker_interface import DockerClientPool
+
+
+class FakeDocker:
+    """
+    Stand-in for a DockerInterface connected to one execution host
+    """
+    def __init__(self, execution_host):
+        self.execution_host = execution_host
+        self.healthy = True
+        self.closed = False
+
+    def ping(self):
+        if self.healthy is None:
+            raise ConnectionError('unreachable')
+        return self.healthy
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connected():
+    return []
+
+
+@pytest.fixture
+def pool(connected):
+    def factory(execution_host):
+        dockeri = FakeDocker(execution_host)
+        connected.append(dockeri)
+        return dockeri
+    return DockerClientPool(FakeDocker(None), ping_interval=0, idle_timeout=300, factory=factory)
+
+
+def test_default_host_is_not_pooled(pool, connected):
+    assert pool.acquire(None) is pool.default
+    pool.release(pool.default)
+    assert connected == []
+    assert pool.stats()['hosts'] == {}
+
+
+def test_plans_share_one_client_per_host(pool, connected):
+    first = pool.acquire('tcp://host-1:2375')
+    second = pool.acquire('tcp://host-1:2375')
+    other = pool.acquire('tcp://host-2:2375')
+    assert first is second
+    assert other is not first
+    assert len(connected) == 2
+    stats = pool.stats()
+    assert stats['hosts']['tcp://host-1:2375']['leases'] == 2
+    assert (stats['created'], stats['reused']) == (2, 1)
+    pool.release(first)
+    pool.release(second)
+    assert pool.stats()['hosts']['tcp://host-1:2375']['leases'] == 0
+    # Released clients stay open for the next plan
+    assert not first.closed
+    assert pool.acquire('tcp://host-1:2375') is first
+
+
+def test_concurrent_connections_keep_one_client(connected):
+    barrier = threading.Barrier(2)
+
+    def factory(execution_host):
+        dockeri = FakeDocker(execution_host)
+        connected.append(dockeri)
+        barrier.wait(timeout=2)
+        return dockeri
+    pool = DockerClientPool(FakeDocker(None), ping_interval=0, factory=factory)
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(pool.acquire('tcp://host-1:2375'))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=2)
+    assert len(connected) == 2
+    assert clients[0] is clients[1]
+    # The redundant connection is closed
+    assert [dockeri.closed for dockeri in connected].count(True) == 1
+    assert pool.stats()['hosts']['tcp://host-1:2375']['leases'] == 2
+
+
+def test_connection_errors_are_raised():
+    def factory(execution_host):
+        raise ConnectionError('unreachable')
+    pool = DockerClientPool(FakeDocker(None), ping_interval=0, factory=factory)
+    with pytest.raises(ConnectionError):
+        pool.acquire('tcp://host-1:2375')
+    assert pool.stats()['hosts'] == {}
+
+
+def test_idle_clients_are_closed(pool):
+    dockeri = pool.acquire('tcp://host-1:2375')
+    pool.idle_timeout = 0
+    pool.check()
+    # Still leased
+    assert not dockeri.closed
+    pool.release(dockeri)
+    pool.check()
+    assert dockeri.closed
+    assert pool.stats()['expired'] == 1
+    assert pool.acquire('tcp://host-1:2375') is not dockeri
+
+
+@pytest.mark.parametrize('healthy', [False, None])
+def test_unhealthy_idle_clients_are_closed(pool, healthy):
+    dockeri = pool.acquire('tcp://host-1:2375')
+    pool.release(dockeri)
+    dockeri.healthy = healthy
+    pool.check()
+    assert dockeri.closed
+    assert pool.stats()['unhealthy'] == 1
+    assert pool.stats()['hosts'] == {}
+
+
+def test_unhealthy_leased_clients_are_closed_once_released(pool):
+    first = pool.acquire('tcp://host-1:2375')
+    first.healthy = False
+    pool.check()
+    # The plan holding it keeps it until it is done, new plans reconnect
+    assert not first.closed
+    assert pool.stats()['retired'] == 1
+    second = pool.acquire('tcp://host-1:2375')
+    assert second is not first
+    pool.release(first)
+    assert first.closed
+    assert pool.stats()['retired'] == 0
+    assert not second.closed
+
+
+def test_unknown_clients_are_ignored(pool):
+    pool.release(None)
+    pool.release(FakeDocker('tcp://host-1:2375'))
+    assert pool.stats()['hosts'] == {}
@@ -0,0 +1,383 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import threading
+import time
+from concurrent.futures import Future
+import pytest
+import curator.helpers as helpers
+import curator.models as models
+from curator.database import context, index
+from curator.instances import InstancePool
+from curator.pipeline import PlanPipeline, StageError
+from curator.scheduler import Scheduler, STAGES, ENVIRONMENTS, TEARDOWN
+from curator.timers import DeadlineService, INSTANTIATION, CANCELLATION
+import curator.pipeline as stages
+from curator.interfaces.resilience import RateLimitError
+from conftest import NSD, TD, FakeStore, new_test_plan, reserve, in_use
+
+
+def test_instantiation(curator):
+    curator.ready.add('sp1')
+    test_plan = new_test_plan()
+    service_platform, instance_name = reserve(test_plan, 'sp1')
+    augd, inst_result, _ = helpers.instantiate_service(test_plan, 'SONATA', service_platform, NSD, instance_name)
+    assert augd.nsi_uuid == f'nsi-{instance_name}'
+    assert inst_result == {'package_id': 'package'}
+    assert in_use('sp1') == (1, 1)
+    assert test_plan.instances == {instance_name: 'sp1'}
+
+
+def test_instantiation_timeout_frees_the_platform(curator):
+    test_plan = new_test_plan()
+    service_platform, instance_name = reserve(test_plan, 'sp1')
+    assert in_use('sp1') == (1, 1)
+    with pytest.raises(StageError, match='timed out'):
+        helpers.instantiate_service(test_plan, 'SONATA', service_platform, NSD, instance_name)
+    assert in_use('sp1') == (0, 0)
+    assert instance_name not in test_plan.instances
+    assert instance_name not in context['events']['plan']
+    assert test_plan.abandoned == {instance_name: 'sp1'}
+    assert context['quotas'].stats()['platforms']['sp1']['failures'] == 1
+
+
+def test_late_instance_of_a_timed_out_setup_is_terminated(curator):
+    test_plan = new_test_plan()
+    service_platform, instance_name = reserve(test_plan, 'sp1')
+    with pytest.raises(StageError):
+        helpers.instantiate_service(test_plan, 'SONATA', service_platform, NSD, instance_name)
+    helpers.terminate_orphan_instance(test_plan.uuid, instance_name, 'late-nsi')
+    assert curator.calls[-1] == ('shutdown', 'sp1', 'late-nsi')
+    assert not test_plan.abandoned
+    assert 'plan' not in context['test_preparations']
+    assert in_use('sp1') == (0, 0)
+
+
+def test_errored_plan_is_dropped_once_reported(curator, monkeypatch):
+    def setup_test_plan(test_plan, pipeline):
+        raise StageError('no execution host')
+
+    monkeypatch.setattr(helpers, 'setup_test_plan', setup_test_plan)
+    new_test_plan()
+    helpers.run_test_plan('plan')
+    assert context['plugins']['planner'].callbacks == [('plan', 'ERROR')]
+    assert context['admission'].released == ['plan']
+    assert 'plan' not in context['test_preparations']
+
+
+def test_errored_plan_waits_for_its_late_instances(curator, monkeypatch):
+    def setup_test_plan(test_plan, pipeline):
+        service_platform, instance_name = reserve(test_plan, 'sp1')
+        helpers.instantiate_service(test_plan, 'SONATA', service_platform, NSD, instance_name)
+
+    monkeypatch.setattr(helpers, 'setup_test_plan', setup_test_plan)
+    monkeypatch.setitem(context, 'store', FakeStore())
+    test_plan = new_test_plan()
+    helpers.run_test_plan('plan')
+    assert context['plugins']['planner'].callbacks == [('plan', 'ERROR')]
+    assert context['store'].deleted == ['plan']
+    instance_name, = test_plan.abandoned
+    helpers.terminate_orphan_instance('plan', instance_name, 'late-nsi')
+    assert 'plan' not in context['test_preparations']
+
+
+@pytest.fixture
+def teardown(monkeypatch):
+    scheduler = Scheduler(pools={TEARDOWN: ('CURATOR_TEST_TEARDOWN_WORKERS', 2, 'CURATOR_TEST_TEARDOWN_QUEUE')})
+    monkeypatch.setitem(context, 'scheduler', scheduler)
+    yield scheduler
+    scheduler.shutdown(wait=False)
+
+
+def _running_test(curator, test_plan, sp_name, test_uuid):
+    curator.ready.add(sp_name)
+    service_platform, instance_name = reserve(test_plan, sp_name)
+    augd, _, _ = helpers.instantiate_service(test_plan, 'SONATA', service_platform, NSD, instance_name)
+    augd.platform_name = sp_name
+    augd.test_status = models.TestStatus.RUNNING
+    index.set_test_uuid(test_plan.uuid, augd, test_uuid)
+    return augd
+
+
+def test_executor_error_ends_the_test(curator):
+    augd = _running_test(curator, new_test_plan(), 'sp1', 'test')
+    helpers.clean_environment('plan', 'test', {'test_uuid': 'test', 'status': 'ERROR'}, 'probe crashed')
+    assert augd.test_status is models.TestStatus.ERROR
+    assert augd.error == 'probe crashed'
+    assert curator.calls[-1] == ('shutdown', 'sp1', augd.nsi_uuid)
+    assert in_use('sp1') == (0, 0)
+    assert context['plugins']['planner'].callbacks == [('plan', 'ERROR')]
+    assert context['admission'].released == ['plan']
+    assert 'plan' not in context['test_preparations']
+
+
+def test_cancel_reports_the_tests_not_confirmed(curator, teardown):
+    test_plan = new_test_plan()
+    confirmed = _running_test(curator, test_plan, 'sp1', 'test1')
+    unconfirmed = _running_test(curator, test_plan, 'sp2', 'test2')
+    context['plugins']['executor'].confirming.add('test1')
+    helpers.cancel_test_plan('plan')
+    assert confirmed.test_status is models.TestStatus.CANCELLED
+    assert unconfirmed.test_status is models.TestStatus.ERROR
+    assert context['plugins']['planner'].callbacks == [('plan', 'CANCELLED')]
+    assert context['plugins']['planner'].exception == "Cancellation not confirmed for tests ['test2']"
+    assert {call for call in curator.calls if call[0] == 'shutdown'} == {
+        ('shutdown', 'sp1', confirmed.nsi_uuid), ('shutdown', 'sp2', unconfirmed.nsi_uuid)}
+    assert in_use('sp1') == in_use('sp2') == (0, 0)
+    assert 'plan' not in context['test_preparations']
+    assert context['admission'].released == ['plan']
+
+
+def test_failed_executor_cancellation_is_only_reported_as_cancelled(curator, teardown):
+    test_plan = new_test_plan()
+    augd = _running_test(curator, test_plan, 'sp1', 'test')
+    context['plugins']['executor'].failing.add('test')
+    helpers.cancel_test_plan('plan')
+    assert augd.test_status is models.TestStatus.ERROR
+    assert 'executor unreachable' in augd.error
+    assert context['plugins']['planner'].callbacks == [('plan', 'CANCELLED')]
+    assert in_use('sp1') == (0, 0)
+
+
+def test_cancel_during_setup_terminates_its_instances(curator, monkeypatch):
+    def setup_test_plan(test_plan, pipeline):
+        for sp_name in ('sp1', 'sp2'):
+            service_platform, instance_name = reserve(test_plan, sp_name)
+            pipeline.run(stages.INSTANTIATION, helpers.instantiate_service, test_plan, 'SONATA', service_platform,
+                         NSD, instance_name)
+        setup_done.set()
+
+    # Long enough for the cancellation to find the setup waiting for sp2
+    timers = DeadlineService(timeouts={INSTANTIATION: ('CURATOR_TEST_INSTANTIATION_TIMEOUT', 5),
+                                       CANCELLATION: ('CURATOR_TEST_CANCELLATION_TIMEOUT', 0.1)}, tick=0.01)
+    monkeypatch.setitem(context, 'timers', timers)
+    monkeypatch.setitem(context, 'store', FakeStore())
+    monkeypatch.setattr(helpers, 'setup_test_plan', setup_test_plan)
+    curator.ready.add('sp1')
+    setup_done = threading.Event()
+    test_plan = new_test_plan()
+    setup = threading.Thread(target=helpers.run_test_plan, args=('plan',))
+    setup.start()
+    try:
+        while not any(call[:2] == ('instantiate', 'sp2') for call in curator.calls):
+            time.sleep(0.01)
+        helpers.cancel_test_plan('plan')
+        setup.join(timeout=1)
+    finally:
+        timers.stop()
+    assert not setup.is_alive() and not setup_done.is_set()
+    ready, = test_plan.augmented_descriptors
+    assert ('shutdown', 'sp1', ready.nsi_uuid) in curator.calls
+    assert context['plugins']['planner'].callbacks == [('plan', 'CANCELLED')]
+    # Kept for the late sp-ready callback of the instance requested on sp2
+    instance_name, = test_plan.abandoned
+    helpers.terminate_orphan_instance('plan', instance_name, 'late-nsi')
+    assert 'plan' not in context['test_preparations']
+    assert in_use('sp1') == in_use('sp2') == (0, 0)
+
+
+def test_tdi_package_is_found_in_the_catalogue_if_the_pa_has_none(curator, monkeypatch):
+    class Catalogue:
+        def get_package_id_from_nsd_tuple(self, vendor, name, version):
+            assert (vendor, name, version) == (NSD['vendor'], NSD['name'], NSD['version'])
+            return {'uuid': 'catalogue-package'}
+
+    def generate_test_descriptor_instance(td, functions, **uuids):
+        return uuids
+
+    monkeypatch.setitem(context['plugins'], 'catalogue', Catalogue())
+    monkeypatch.setattr(helpers, 'generate_test_descriptor_instance', generate_test_descriptor_instance)
+    augd = models.AugmentedDescriptor('instance', nsi_uuid='nsi', functions=[])
+    test_plan = new_test_plan()
+    assert helpers.generate_tdi(test_plan, TD, NSD, augd, {'package_id': 'pa-package'})['package_uuid'] == \
+        'pa-package'
+    assert helpers.generate_tdi(test_plan, TD, NSD, augd, {})['package_uuid'] == 'catalogue-package'
+
+
+def test_failed_dispatch_terminates_the_instance(curator, monkeypatch):
+    def generate_tdi(test_plan, td, nsd, augd, inst_result):
+        raise KeyError('package_id')
+
+    monkeypatch.setattr(helpers, 'generate_tdi', generate_tdi)
+    curator.ready.add('sp1')
+    test_plan = new_test_plan()
+    service_platform, instance_name = reserve(test_plan, 'sp1')
+    done = Future()
+    done.set_result(None)
+    helpers.setup_environment(test_plan, PlanPipeline(test_plan, None), TD, NSD, 'SONATA', service_platform,
+                              instance_name, done, done)
+    augd, = test_plan.augmented_descriptors
+    assert augd.test_status is models.TestStatus.ERROR
+    assert curator.calls[-1] == ('shutdown', 'sp1', augd.nsi_uuid)
+    assert in_use('sp1') == (0, 0)
+    assert not test_plan.instances
+
+
+def test_throttled_instantiation_does_not_penalize_the_platform(curator):
+    curator.throttled.add('sp1')
+    test_plan = new_test_plan()
+    service_platform, instance_name = reserve(test_plan, 'sp1')
+    with pytest.raises(StageError, match='throttled') as raised:
+        helpers.instantiate_service(test_plan, 'SONATA', service_platform, NSD, instance_name)
+    assert isinstance(raised.value.__cause__, RateLimitError)
+    assert in_use('sp1') == (0, 0)
+    assert instance_name not in context['events']['plan']
+    assert context['quotas'].stats()['platforms']['sp1']['failures'] == 0
+    assert context['balancer'].stats()['platforms']['sp1']['failures'] == 0
+
+
+@pytest.mark.parametrize('td', [
+    {},
+    {'phases': [{'id': 'exercise', 'steps': []}]},
+    {'phases': [{'id': 'setup', 'steps': [{'action': 'deploy'}]}]},
+    {'phases': [{'id': 'setup', 'steps': [{'action': 'configure'}]}]},
+])
+def test_malformed_probe_setup_is_a_stage_error(curator, td):
+    with pytest.raises(StageError, match='No probes found'):
+        helpers.pull_probes(new_test_plan(), td, None)
+
+
+def test_parked_instance_keeps_its_capacity_until_reused(curator, monkeypatch):
+    monkeypatch.setitem(context, 'instances', InstancePool(lambda warm: None, enabled=True, max_idle=1, idle_ttl=0))
+    curator.ready.add('sp1')
+    first = new_test_plan('plan-1')
+    service_platform, instance_name = reserve(first, 'sp1')
+    augd, _, _ = helpers.instantiate_service(first, 'SONATA', service_platform, NSD, instance_name)
+    # Parked as clean_environment does once its test is over
+    assert context['instances'].park(augd.nsi_uuid)
+    first.instances.pop(instance_name)
+    assert in_use('sp1') == (1, 1)
+    second = new_test_plan('plan-2')
+    service_platform, instance_name = reserve(second, 'sp1')
+    assert in_use('sp1') == (2, 2)
+    reused, inst_result, instantiation_time = helpers.instantiate_service(second, 'SONATA', service_platform, NSD,
+                                                                          instance_name)
+    assert reused.nsi_uuid == augd.nsi_uuid
+    assert (inst_result, instantiation_time) == ({'package_id': 'package'}, 0.0)
+    assert [call[0] for call in curator.calls] == ['instantiate', 'check']
+    # Only the reservation of the plan reusing it is left
+    assert in_use('sp1') == (1, 1)
+
+
+def test_terminated_parked_instance_frees_its_capacity(curator, monkeypatch):
+    monkeypatch.setitem(context, 'instances', InstancePool(helpers.terminate_warm_instance, enabled=True,
+                                                           max_idle=1, idle_ttl=0))
+    curator.ready.add('sp1')
+    test_plan = new_test_plan()
+    service_platform, instance_name = reserve(test_plan, 'sp1')
+    augd, _, _ = helpers.instantiate_service(test_plan, 'SONATA', service_platform, NSD, instance_name)
+    assert context['instances'].park(augd.nsi_uuid)
+    test_plan.instances.pop(instance_name)
+    assert context['instances'].reclaim({'sp1'})
+    assert curator.calls[-1] == ('shutdown', 'sp1', augd.nsi_uuid)
+    assert in_use('sp1') == (0, 0)
+
+
+def _instantiate_with_failover(test_plan, sp_name):
+    service_platform, instance_name = reserve(test_plan, sp_name)
+    pipeline = PlanPipeline(test_plan, None)
+    return helpers.instantiate_with_failover(test_plan, pipeline, TD, NSD, 'SONATA', service_platform, instance_name)
+
+
+def test_failed_instantiation_fails_over_to_another_platform(curator):
+    curator.ready.add('sp2')
+    test_plan = new_test_plan()
+    augd, _, _, service_platform, instance_name = _instantiate_with_failover(test_plan, 'sp1')
+    assert service_platform == {'name': 'sp2'}
+    assert augd.nsi_uuid == f'nsi-{instance_name}'
+    assert [call[1] for call in curator.calls] == ['sp1', 'sp2']
+    assert test_plan.instances == {instance_name: 'sp2'}
+    assert in_use('sp1') == (0, 0)
+    assert in_use('sp2') == (1, 1)
+    # Both attempts are recorded as instantiation stages
+    assert [stage['state'] for stage in test_plan.stages] == ['RUNNING', 'FAILED', 'RUNNING', 'DONE']
+
+
+def test_no_failover_when_every_platform_fails(curator):
+    test_plan = new_test_plan()
+    with pytest.raises(StageError, match='timed out') as raised:
+        _instantiate_with_failover(test_plan, 'sp1')
+    assert raised.value.instance_name.endswith('sp2')
+    assert [call[1] for call in curator.calls] == ['sp1', 'sp2']
+    assert in_use('sp1') == (0, 0)
+    assert in_use('sp2') == (0, 0)
+
+
+def test_no_failover_for_throttled_instantiations(curator):
+    curator.throttled.add('sp1')
+    curator.ready.add('sp2')
+    with pytest.raises(StageError, match='throttled'):
+        _instantiate_with_failover(new_test_plan(), 'sp1')
+    assert [call[1] for call in curator.calls] == ['sp1']
+
+
+def test_no_failover_for_plans_naming_their_platform(curator):
+    curator.ready.add('sp2')
+    test_plan = new_test_plan()
+    test_plan.sp_name = 'sp1'
+    with pytest.raises(StageError, match='timed out'):
+        _instantiate_with_failover(test_plan, 'sp1')
+    assert [call[1] for call in curator.calls] == ['sp1']
+
+
+def test_fanned_out_environments_do_not_hold_the_stage_workers(curator, monkeypatch):
+    # A single stage worker: the probes stage only finishes once both environments instantiated,
+    # which they could not do queued behind it on the same pool
+    scheduler = Scheduler(pools={STAGES: ('CURATOR_TEST_STAGE_WORKERS', 1, 'CURATOR_TEST_STAGE_QUEUE'),
+                                 ENVIRONMENTS: ('CURATOR_TEST_ENVIRONMENT_WORKERS', 2,
+                                                'CURATOR_TEST_ENVIRONMENT_QUEUE')})
+    monkeypatch.setitem(context, 'scheduler', scheduler)
+    instantiated = threading.Barrier(3, timeout=2)
+    dispatched = []
+
+    def instantiate_with_failover(test_plan, pipeline, td, nsd, platform_type, service_platform, instance_name):
+        instantiated.wait()
+        augd = models.AugmentedDescriptor(instance_name, nsi_uuid=f'nsi-{instance_name}')
+        return augd, {}, 0.0, service_platform, instance_name
+
+    def pull_probes(test_plan, td, dockeri):
+        instantiated.wait()
+        return []
+
+    monkeypatch.setattr(helpers, 'connect_execution_host', lambda test_plan: None)
+    monkeypatch.setattr(helpers, 'resolve_test_descriptor', lambda test_plan: dict(TD, service_platforms=['SONATA']))
+    monkeypatch.setattr(helpers, 'resolve_network_descriptor', lambda test_plan: ('5gtango', NSD))
+    monkeypatch.setattr(helpers, 'select_platforms', lambda test_plan, platforms, nsd_target, nsd:
+                        ('SONATA', [{'name': 'sp1'}, {'name': 'sp2'}]))
+    monkeypatch.setattr(helpers, 'pull_probes', pull_probes)
+    monkeypatch.setattr(helpers, 'resolve_references', lambda test_plan, td, nsd: None)
+    monkeypatch.setattr(helpers, 'instantiate_with_failover', instantiate_with_failover)
+    monkeypatch.setattr(helpers, 'generate_tdi', lambda test_plan, td, nsd, augd, inst_result: {})
+    monkeypatch.setattr(helpers, 'dispatch_test', lambda test_plan, augd, *args: dispatched.append(augd.nsi_name))
+    test_plan = new_test_plan()
+    try:
+        helpers.setup_test_plan(test_plan, PlanPipeline(test_plan, lambda fn, *args: scheduler.submit(STAGES, fn,
+                                                                                                      *args)))
+    finally:
+        scheduler.shutdown(wait=False)
+    assert sorted(dispatched) == sorted(test_plan.instances)
+    assert len(dispatched) == 2
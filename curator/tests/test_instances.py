@@ -0,0 +1,160 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import pytest
+from curator.instances import InstancePool, WarmInstance, instance_key
+
+
+NSD = {'vendor': 'eu.5gtango', 'name': 'ns-test', 'version': '0.1'}
+
+
+def _warm(nsi_uuid, platform_name='sp1', nsd=NSD, policy_id=None):
+    return WarmInstance(instance_key(nsd, policy_id, platform_name), nsi_uuid, [], 'sonata', True, 'package')
+
+
+@pytest.fixture
+def terminated():
+    return []
+
+
+@pytest.fixture
+def pool(terminated):
+    return InstancePool(lambda warm: terminated.append(warm.nsi_uuid), enabled=True, max_idle=2, idle_ttl=0)
+
+
+def _park(pool, *warms):
+    for warm in warms:
+        pool.lend(warm)
+        assert pool.park(warm.nsi_uuid)
+
+
+def test_disabled_pool_keeps_nothing(terminated):
+    pool = InstancePool(lambda warm: terminated.append(warm.nsi_uuid), enabled=False)
+    warm = _warm('nsi-1')
+    pool.lend(warm)
+    assert not pool.park('nsi-1')
+    assert pool.take(warm.key, lambda warm: True) is None
+
+
+def test_only_lent_instances_are_parked(pool):
+    assert not pool.park('nsi-unknown')
+    warm = _warm('nsi-1')
+    pool.lend(warm)
+    pool.discard('nsi-1')
+    assert not pool.park('nsi-1')
+    assert pool.stats()['lent'] == 0
+
+
+def test_parked_instances_are_reused(pool):
+    old, new = _warm('nsi-1'), _warm('nsi-2')
+    _park(pool, old, new)
+    checked = []
+
+    def ready(warm):
+        checked.append(warm.nsi_uuid)
+        return True
+    # Most recently parked first
+    assert pool.take(instance_key(NSD, None, 'sp1'), ready) is new
+    assert checked == ['nsi-2']
+    assert new.uses == 2
+    # Another platform or service does not match
+    assert pool.take(instance_key(NSD, None, 'sp2'), ready) is None
+    assert pool.take(instance_key(dict(NSD, version='0.2'), None, 'sp1'), ready) is None
+    stats = pool.stats()
+    assert (stats['parked'], stats['reused'], stats['lent']) == (2, 1, 1)
+    # Once its test is over, a reused instance can be parked again
+    assert pool.park('nsi-2')
+
+
+@pytest.mark.parametrize('ready', [lambda warm: False, lambda warm: 1 / 0])
+def test_instances_not_ready_are_terminated(pool, terminated, ready):
+    _park(pool, _warm('nsi-1'))
+    assert pool.take(instance_key(NSD, None, 'sp1'), ready) is None
+    assert terminated == ['nsi-1']
+    assert pool.stats()['unhealthy'] == 1
+    assert pool.stats()['idle'] == {}
+
+
+def test_next_instance_is_tried_when_one_is_not_ready(pool, terminated):
+    _park(pool, _warm('nsi-1'), _warm('nsi-2'))
+    warm = pool.take(instance_key(NSD, None, 'sp1'), lambda warm: warm.nsi_uuid == 'nsi-1')
+    assert warm.nsi_uuid == 'nsi-1'
+    assert terminated == ['nsi-2']
+
+
+def test_least_recently_parked_is_evicted_when_full(pool, terminated):
+    _park(pool, _warm('nsi-1'), _warm('nsi-2'), _warm('nsi-3'))
+    assert terminated == ['nsi-1']
+    assert pool.stats()['evicted'] == 1
+    assert pool.stats()['idle']['eu.5gtango:ns-test:0.1:sp1']['instances'] == 2
+
+
+def test_idle_instances_expire(pool, terminated):
+    _park(pool, _warm('nsi-1'))
+    pool.expire()
+    # idle_ttl = 0 disables the expiry
+    assert terminated == []
+    pool.idle_ttl = 0.001
+    for warm in pool._idle.values():
+        warm.parked_at -= 1
+    pool.expire()
+    assert terminated == ['nsi-1']
+    assert pool.stats()['expired'] == 1
+
+
+def test_platforms_holding_parked_instances(pool):
+    _park(pool, _warm('nsi-1', 'sp1'), _warm('nsi-2', 'sp2'))
+    assert pool.platforms(instance_key(NSD, None, None)) == {'sp1', 'sp2'}
+    assert pool.platforms(instance_key(dict(NSD, name='other'), None, None)) == set()
+
+
+def test_plans_with_different_policies_do_not_share_instances(pool):
+    _park(pool, _warm('nsi-1', policy_id='scaling'))
+    assert pool.platforms(instance_key(NSD, None, None)) == set()
+    assert pool.take(instance_key(NSD, None, 'sp1'), lambda warm: True) is None
+    assert pool.take(instance_key(NSD, 'other', 'sp1'), lambda warm: True) is None
+    assert pool.platforms(instance_key(NSD, 'scaling', None)) == {'sp1'}
+    assert pool.take(instance_key(NSD, 'scaling', 'sp1'), lambda warm: True).nsi_uuid == 'nsi-1'
+
+
+def test_reclaim_frees_a_platform_for_waiting_plans(pool, terminated):
+    _park(pool, _warm('nsi-1', 'sp1'), _warm('nsi-2', 'sp2'))
+    assert not pool.reclaim({'sp3'})
+    assert pool.reclaim({'sp2', 'sp3'})
+    assert terminated == ['nsi-2']
+    assert pool.reclaim({'sp1', 'sp2'})
+    assert terminated == ['nsi-2', 'nsi-1']
+    assert not pool.reclaim({'sp1', 'sp2'})
+    assert pool.stats()['reclaimed'] == 2
+
+
+def test_termination_errors_are_contained():
+    def terminate(warm):
+        raise ConnectionError('unreachable')
+    pool = InstancePool(terminate, enabled=True, max_idle=1, idle_ttl=0)
+    _park(pool, _warm('nsi-1'), _warm('nsi-2'))
+    assert pool.stats()['evicted'] == 1
@@ -0,0 +1,172 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from curator.interfaces.interface import HttpTransport, close_transports, get_transport
+from curator.interfaces.resilience import CircuitOpenError
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        self.server.calls.append((self.command, self.path))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = b'{}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.calls = []
+    server.statuses = []
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _url(server, path='/api'):
+    return f'http://127.0.0.1:{server.server_address[1]}{path}'
+
+
+@pytest.fixture
+def transport():
+    transport = HttpTransport('test', pool_size=2, connect_timeout=1, read_timeout=2, retries=2, backoff=0)
+    yield transport
+    transport.close()
+
+
+def test_connections_are_reused(server, transport):
+    for _ in range(3):
+        assert transport.get(_url(server)).status_code == 200
+    host = transport.stats()['hosts'][f'127.0.0.1:{server.server_address[1]}']
+    assert host['requests'] == 3
+    assert (host['connections_opened'], host['connections_reused']) == (1, 2)
+
+
+def test_idempotent_requests_are_retried_on_gateway_errors(server, transport):
+    server.statuses = [503, 502]
+    assert transport.get(_url(server)).status_code == 200
+    assert len(server.calls) == 3
+
+
+def test_instantiations_are_never_sent_twice(server, transport):
+    server.statuses = [503]
+    assert transport.post(_url(server), json={}).status_code == 503
+    assert server.calls == [('POST', '/api')]
+
+
+def test_connection_errors_are_counted(transport):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    with pytest.raises(requests.ConnectionError):
+        transport.get(f'http://127.0.0.1:{port}/api')
+    assert transport.stats()['hosts'][f'127.0.0.1:{port}']['errors'] == 1
+
+
+def test_failing_downstream_trips_the_circuit(server, monkeypatch):
+    monkeypatch.setenv('CURATOR_TEST_HTTP_FAILURE_THRESHOLD', '2')
+    transport = HttpTransport('test', retries=0)
+    try:
+        server.statuses = [500, 500]
+        for _ in range(2):
+            assert transport.post(_url(server), json={}).status_code == 500
+        with pytest.raises(CircuitOpenError):
+            transport.get(_url(server))
+        assert len(server.calls) == 2
+        stats = transport.stats()
+        assert stats['circuit']['state'] == 'OPEN'
+        assert stats['endpoints']['POST /api']['in_flight'] == 0
+        assert stats['endpoints']['GET /api']['in_flight'] == 0
+    finally:
+        transport.close()
+
+
+def test_failing_target_only_trips_its_own_circuit(server, monkeypatch):
+    monkeypatch.setenv('CURATOR_TEST_HTTP_FAILURE_THRESHOLD', '2')
+    transport = HttpTransport('test', retries=0)
+    try:
+        server.statuses = [500, 500]
+        for _ in range(2):
+            assert transport.post(_url(server), json={}, target='sp1').status_code == 500
+        with pytest.raises(CircuitOpenError):
+            transport.post(_url(server), json={}, target='sp1')
+        assert transport.post(_url(server), json={}, target='sp2').status_code == 200
+        assert transport.get(_url(server)).status_code == 200
+        stats = transport.stats()
+        assert stats['circuit']['state'] == 'CLOSED'
+        assert stats['targets']['sp1']['state'] == 'OPEN'
+        assert stats['targets']['sp2']['state'] == 'CLOSED'
+    finally:
+        transport.close()
+
+
+def test_endpoints_are_limited_without_ids(server, transport):
+    transport.get(_url(server, '/api/packages/6f7e2a3c-2b1d-4c5e-9f8a-0b1c2d3e4f50'))
+    transport.get(_url(server, '/api/packages/42'))
+    assert list(transport.stats()['endpoints']) == ['GET /api/packages/*']
+
+
+def test_settings_can_be_set_per_downstream(monkeypatch):
+    monkeypatch.setenv('CURATOR_HTTP_READ_TIMEOUT', '30')
+    monkeypatch.setenv('CURATOR_CATALOGUE_HTTP_READ_TIMEOUT', '90')
+    monkeypatch.setenv('CURATOR_HTTP_POOL_SIZE', '4')
+    catalogue = HttpTransport('catalogue')
+    planner = HttpTransport('planner')
+    assert catalogue.timeout == (5.0, 90.0)
+    assert planner.timeout == (5.0, 30.0)
+    assert catalogue.pool_size == planner.pool_size == 4
+
+
+def test_downstream_interfaces_share_one_transport():
+    try:
+        assert get_transport('planner') is get_transport('planner')
+        assert get_transport('planner') is not get_transport('executor')
+    finally:
+        close_transports()
+    assert get_transport('planner') is not None
+    close_transports()
@@ -0,0 +1,111 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+from datetime import datetime
+import curator.models as models
+
+
+def test_unknown_statuses_do_not_raise():
+    assert models.TestStatus('PAUSED') is models.TestStatus.UNKNOWN
+    assert models.TestStatus('RUNNING').is_active
+    assert models.TestStatus('CANCELLED').is_final
+    assert not models.TestStatus.FINISHED.is_final
+    assert not models.TestStatus.UNKNOWN.is_active
+
+
+def test_augmented_descriptor_round_trip():
+    augd = models.AugmentedDescriptor('instance', nsi_uuid='nsi', functions=[{'id': 'vnf'}], platform_type='sonata',
+                                      platform_name='sp1', package_uploaded=True, tdi={'name': 'tdi'},
+                                      test_uuid='test', test_status=models.TestStatus.RUNNING)
+    d = augd.to_dict()
+    assert d['platform'] == {'platform_type': 'sonata', 'name': 'sp1'}
+    assert d['test_status'] == 'RUNNING'
+    copy = models.AugmentedDescriptor.from_dict(d)
+    assert {slot: getattr(copy, slot) for slot in copy.__slots__} == \
+        {slot: getattr(augd, slot) for slot in augd.__slots__}
+
+
+def test_augmented_descriptor_without_test():
+    d = models.AugmentedDescriptor('instance').to_dict()
+    assert d['test_status'] is None
+    assert 'tdi' not in d and 'name' not in d['platform']
+    assert models.AugmentedDescriptor.from_dict(d).test_status is None
+
+
+def test_test_result_as_reported_to_the_planner():
+    result = models.TestResult.from_dict({'results_uuid': 'results', 'status': 'COMPLETED'}, test_uuid='test')
+    assert result.test_uuid == 'test'
+    assert result.to_planner() == {'test_uuid': 'test', 'test_result_uuid': 'results', 'test_status': 'COMPLETED'}
+    assert models.TestResult.from_dict({'test_uuid': 'test'}).status is models.TestStatus.UNKNOWN
+
+
+def test_payload_fields_are_kept_as_received():
+    payload = {
+        'nsd_uuid': 'nsd', 'testd_uuid': 'td', 'priority': '3', 'policy_id': 'policy',
+        'test_plan_callbacks': [{'url': '/cb/completed', 'status': 'COMPLETED'}],
+        'paths': {'kept': 'as is'}, 'test_plan_uuid': 'ignored'
+    }
+    test_plan = models.TestPlan.from_payload('plan', payload)
+    assert test_plan.priority == 3
+    assert test_plan.extra == {'paths': {'kept': 'as is'}}
+    assert test_plan.callback_path == '/cb/completed'
+    assert not test_plan.started
+    d = test_plan.to_dict()
+    assert d['test_plan_uuid'] == 'plan'
+    assert d['paths'] == {'kept': 'as is'}
+    assert 'augmented_descriptors' not in d
+
+
+def test_callback_path_falls_back_to_the_default():
+    assert models.TestPlan('plan').callback_path == models.DEFAULT_CALLBACK_PATH
+    test_plan = models.TestPlan('plan', test_plan_callbacks=[{'url': '/cb/running', 'status': 'RUNNING'}])
+    assert test_plan.callback_path == models.DEFAULT_CALLBACK_PATH
+
+
+def test_test_plan_round_trip():
+    test_plan = models.TestPlan.from_payload('plan', {'nsd_uuid': 'nsd', 'sp_name': 'sp1', 'other': 1})
+    test_plan.created_at = datetime(2019, 5, 1, 12, 0, 0)
+    test_plan.augmented_descriptors = [
+        models.AugmentedDescriptor('running', test_uuid='t1', test_status=models.TestStatus.RUNNING),
+        models.AugmentedDescriptor('done', test_uuid='t2', test_status=models.TestStatus.COMPLETED)
+    ]
+    test_plan.test_results = [models.TestResult('t2', results_uuid='r2', status=models.TestStatus.COMPLETED)]
+    test_plan.probes = [models.ProbeRef('probe', 'name', 'image:1', pull_time=1.5)]
+    test_plan.instances = {'running': 'sp1'}
+    test_plan.recovered = True
+    d = test_plan.to_dict()
+    # Serialized as it is stored, datetimes as strings
+    d['created_at'] = '2019-05-01 12:00:00'
+    copy = models.TestPlan.from_dict(d)
+    assert copy.uuid == 'plan'
+    assert (copy.nsd_uuid, copy.sp_name, copy.extra) == ('nsd', 'sp1', {'other': 1})
+    assert copy.created_at == datetime(2019, 5, 1, 12, 0, 0)
+    assert [augd.nsi_name for augd in copy.active_tests()] == ['running']
+    assert copy.planner_results() == [{'test_uuid': 't2', 'test_result_uuid': 'r2', 'test_status': 'COMPLETED'}]
+    assert copy.probes[0].to_dict() == {'id': 'probe', 'name': 'name', 'image': 'image:1', 'pull_time': 1.5}
+    assert copy.instances == {'running': 'sp1'}
+    assert copy.recovered
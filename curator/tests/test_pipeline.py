@@ -0,0 +1,106 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import threading
+from queue import Full
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import curator.models as models
+from curator.pipeline import PlanPipeline, StageError, DONE, FAILED, RUNNING
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown()
+
+
+def _transitions(test_plan, branch=None):
+    return [(t['stage'], t['state']) for t in test_plan.stages if t.get('branch') == branch]
+
+
+def test_run_records_the_stage(executor):
+    test_plan = models.TestPlan('plan')
+    pipeline = PlanPipeline(test_plan, executor.submit)
+    assert pipeline.run('stage', lambda a, b: a + b, 1, 2) == 3
+    assert _transitions(test_plan) == [('stage', RUNNING), ('stage', DONE)]
+    assert 'elapsed' in test_plan.stages[-1]
+
+
+def test_failed_stage_is_recorded_and_raised(executor):
+    test_plan = models.TestPlan('plan')
+    pipeline = PlanPipeline(test_plan, executor.submit)
+    with pytest.raises(StageError):
+        pipeline.run('stage', _fail)
+    assert _transitions(test_plan) == [('stage', RUNNING), ('stage', FAILED)]
+    assert test_plan.stages[-1]['error'] == 'boom'
+
+
+def test_started_stages_overlap(executor):
+    test_plan = models.TestPlan('plan')
+    pipeline = PlanPipeline(test_plan, executor.submit)
+    both_running = threading.Barrier(2, timeout=2)
+    first = pipeline.start('first', both_running.wait)
+    second = pipeline.start('second', both_running.wait)
+    first.result(2)
+    second.result(2)
+    assert sorted(_transitions(test_plan)[-2:]) == [('first', DONE), ('second', DONE)]
+
+
+def test_stage_runs_inline_when_the_pool_is_full():
+    def saturated(fn, *args):
+        raise Full()
+
+    test_plan = models.TestPlan('plan')
+    pipeline = PlanPipeline(test_plan, saturated)
+    caller = threading.current_thread()
+    assert pipeline.start('stage', lambda: threading.current_thread() is caller).result() is True
+    failed = pipeline.start('failing', _fail)
+    assert isinstance(failed.exception(), StageError)
+
+
+def test_branches_record_their_name_and_submit(executor):
+    test_plan = models.TestPlan('plan')
+    pipeline = PlanPipeline(test_plan, executor.submit)
+    submitted = []
+
+    def submit(fn, *args):
+        submitted.append(fn)
+        return executor.submit(fn, *args)
+
+    default = pipeline.branch('sp1')
+    own_pool = pipeline.branch('sp2', submit)
+    default.run('instantiation', lambda: None)
+    own_pool.start('environment', lambda: None).result(2)
+    assert _transitions(test_plan, 'sp1') == [('instantiation', RUNNING), ('instantiation', DONE)]
+    assert _transitions(test_plan, 'sp2') == [('environment', RUNNING), ('environment', DONE)]
+    assert len(submitted) == 1
+
+
+def _fail():
+    raise StageError('boom')
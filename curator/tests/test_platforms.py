@@ -0,0 +1,106 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+import threading
+import pytest
+from curator.platforms import PlatformRegistry
+
+
+PLATFORMS = [
+    {'name': 'sp-1', 'type': 'sonata', 'service_platform_url': 'http://sp-1'},
+    {'name': 'sp-2', 'type': 'sonata', 'service_platform_url': 'http://sp-2'},
+    {'name': 'osm-1', 'type': 'osm', 'service_platform_url': 'http://osm-1'}
+]
+
+
+class FakeLoader:
+    def __init__(self, platforms):
+        self.platforms = platforms
+        self.calls = 0
+        self.error = None
+        self.called = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.called.set()
+        if self.error:
+            raise self.error
+        return [dict(platform) for platform in self.platforms]
+
+
+def _wait(condition, timeout=2):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, 'timed out'
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def loader():
+    return FakeLoader(PLATFORMS)
+
+
+def test_lookups_by_type_and_name(loader):
+    registry = PlatformRegistry(loader, refresh_interval=60, retry_interval=60)
+    assert [p['name'] for p in registry.by_type('sonata')] == ['sp-1', 'sp-2']
+    assert registry.by_type('k8s') == []
+    assert registry.by_name('osm-1')['service_platform_url'] == 'http://osm-1'
+    assert registry.by_name('missing') is None
+    assert len(registry.all()) == 3
+    registry.by_name('sp-1')['name'] = 'changed'
+    assert registry.by_name('sp-1')['name'] == 'sp-1'
+    assert registry.stats()['by_type'] == {'sonata': 2, 'osm': 1}
+
+
+def test_failed_refresh_keeps_the_last_platforms(loader):
+    registry = PlatformRegistry(loader, refresh_interval=60, retry_interval=60)
+    registry.refresh()
+    loader.error = ConnectionError('pa down')
+    with pytest.raises(ConnectionError):
+        registry.refresh()
+    stats = registry.stats()
+    assert (stats['platforms'], stats['failures'], stats['last_error']) == (3, 1, 'pa down')
+
+
+def test_background_thread_refreshes_on_request(loader):
+    registry = PlatformRegistry(loader, refresh_interval=60, retry_interval=60)
+    assert registry.by_name('sp-3') is None
+    loader.platforms = PLATFORMS + [{'name': 'sp-3', 'type': 'sonata'}]
+    calls = loader.calls
+    registry.request_refresh()
+    _wait(lambda: loader.calls > calls and registry.by_name('sp-3') is not None)
+    assert registry.stats()['forced'] == 1
+
+
+def test_background_thread_retries_after_a_failure(loader):
+    loader.error = ConnectionError('pa down')
+    registry = PlatformRegistry(loader, refresh_interval=60, retry_interval=0.01)
+    registry.request_refresh()
+    _wait(lambda: loader.calls >= 2)
+    loader.error = None
+    _wait(lambda: registry.stats()['platforms'] == 3)
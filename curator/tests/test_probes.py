@@ -0,0 +1,331 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from curator.probes import ProbeImageCache, ProbePrewarmer, ProbePuller, registry_of
+
+
+class FakeImage:
+    def __init__(self, name, size=1):
+        self.short_id = f'sha256:{abs(hash(name)) % 10 ** 10}'
+        self.attrs = {'Size': size}
+
+
+class FakeDocker:
+    """
+    Docker host whose pulls block until released, recording how many run at once
+    """
+    def __init__(self, execution_host=None, missing=()):
+        self.execution_host = execution_host
+        self.missing = set(missing)
+        self.release = threading.Event()
+        self.release.set()
+        self.removing = threading.Event()
+        self.removing.set()
+        self.pulls = []
+        self.removed = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def pull(self, image_name):
+        with self._lock:
+            self.pulls.append(image_name)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            self.release.wait(2)
+            return None if image_name in self.missing else FakeImage(image_name)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def rm_image(self, image_name):
+        self.removed.append(image_name)
+        self.removing.wait(2)
+
+
+def _wait(predicate, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=8)
+    yield executor
+    executor.shutdown()
+
+
+@pytest.fixture
+def puller(executor):
+    return ProbePuller(executor.submit, per_registry=2, registry_limits={'registry.local:5000': 1}, budget=5)
+
+
+def test_registry_of():
+    assert registry_of('sonatanfv/probe:1.0') == 'docker.io'
+    assert registry_of('probe') == 'docker.io'
+    assert registry_of('registry.local:5000/probe:1.0') == 'registry.local:5000'
+    assert registry_of('localhost/probe') == 'localhost'
+
+
+def test_pulls_of_the_same_image_are_joined(puller):
+    docker = FakeDocker()
+    docker.release.clear()
+    first = puller.pull(docker, 'probe:1.0')
+    second = puller.pull(docker, 'probe:1.0')
+    assert first is second
+    docker.release.set()
+    image, elapsed = first.result(2)
+    assert image is not None and elapsed >= 0
+    assert docker.pulls == ['probe:1.0']
+    assert puller.stats()['collapsed'] == 1
+
+
+def test_same_image_on_another_host_is_pulled_again(puller):
+    first, second = FakeDocker('host-1'), FakeDocker('host-2')
+    puller.pull(first, 'probe:1.0').result(2)
+    puller.pull(second, 'probe:1.0').result(2)
+    assert first.pulls == second.pulls == ['probe:1.0']
+
+
+def test_finished_pull_is_forgotten(puller):
+    docker = FakeDocker()
+    puller.pull(docker, 'probe:1.0').result(2)
+    puller.pull(docker, 'probe:1.0').result(2)
+    assert docker.pulls == ['probe:1.0', 'probe:1.0']
+    assert _wait(lambda: puller.stats()['in_flight'] == 0)
+
+
+def test_pulls_per_registry_are_bounded(puller):
+    docker = FakeDocker()
+    docker.release.clear()
+    pulls = [puller.pull(docker, f'probe-{i}:1.0') for i in range(5)]
+    assert _wait(lambda: docker.active == 2)
+    time.sleep(0.05)
+    assert docker.active == 2
+    docker.release.set()
+    for pull in pulls:
+        pull.result(2)
+    assert docker.max_active == 2
+
+
+def test_registries_have_their_own_limits(puller):
+    docker = FakeDocker()
+    docker.release.clear()
+    local = [puller.pull(docker, f'registry.local:5000/probe-{i}') for i in range(3)]
+    hub = [puller.pull(docker, f'probe-{i}') for i in range(2)]
+    assert _wait(lambda: docker.active == 3)
+    assert puller.stats()['registries']['registry.local:5000'] == {'limit': 1, 'active': 1}
+    docker.release.set()
+    for pull in local + hub:
+        pull.result(2)
+
+
+def test_missing_images_are_counted_as_failed(puller):
+    docker = FakeDocker(missing={'missing:1.0'})
+    assert puller.pull(docker, 'missing:1.0').result(2)[0] is None
+    assert _wait(lambda: puller.stats()['failed'] == 1)
+
+
+def _cache(puller, max_images=2, max_bytes=0):
+    return ProbeImageCache(puller, max_images=max_images, max_bytes=max_bytes)
+
+
+def test_cached_image_is_not_pulled_again(puller):
+    cache = _cache(puller)
+    docker = FakeDocker()
+    cache.acquire('plan-1', docker, 'probe:1.0').result(2)
+    image, elapsed = cache.acquire('plan-2', docker, 'probe:1.0').result(2)
+    assert image is not None and elapsed == 0.0
+    assert docker.pulls == ['probe:1.0']
+    assert cache.stats()['hits'] == 1
+
+
+def test_images_in_use_are_never_evicted(puller):
+    cache = _cache(puller, max_images=0)
+    docker = FakeDocker()
+    cache.acquire('plan-1', docker, 'probe:1.0').result(2)
+    cache.acquire('plan-2', docker, 'probe:1.0').result(2)
+    cache.release('plan-1', docker)
+    assert not docker.removed
+    cache.release('plan-2', docker)
+    assert docker.removed == ['probe:1.0']
+
+
+def test_least_recently_used_images_are_evicted_first(puller):
+    cache = _cache(puller, max_images=2)
+    docker = FakeDocker()
+    for image_name in ('a:1', 'b:1', 'c:1'):
+        cache.acquire('plan-1', docker, image_name).result(2)
+        _wait(lambda: image_name in cache.cached(None))
+    cache.acquire('plan-2', docker, 'a:1').result(2)
+    cache.release('plan-1', docker)
+    assert docker.removed == ['b:1']
+    assert set(cache.cached(None)) == {'a:1', 'c:1'}
+
+
+def test_size_limit_evicts_images(puller):
+    cache = _cache(puller, max_images=10, max_bytes=1)
+    docker = FakeDocker()
+    for image_name in ('a:1', 'b:1'):
+        cache.acquire('plan', docker, image_name).result(2)
+    assert _wait(lambda: len(cache.cached(None)) == 2)
+    cache.release('plan', docker)
+    assert docker.removed == ['a:1']
+
+
+def test_failed_pulls_are_not_cached(puller):
+    cache = _cache(puller)
+    docker = FakeDocker(missing={'missing:1'})
+    assert cache.acquire('plan', docker, 'missing:1').result(2)[0] is None
+
+    def pulled_again():
+        # Joins the failed pull until it is forgotten, then pulls again
+        cache.acquire('plan', docker, 'missing:1').result(2)
+        return len(docker.pulls) == 2
+    assert _wait(pulled_again)
+
+
+def test_acquire_waits_for_the_removal_of_an_evicted_image(puller):
+    cache = _cache(puller, max_images=0)
+    docker = FakeDocker()
+    cache.acquire('plan-1', docker, 'probe:1.0').result(2)
+    docker.removing.clear()
+    release = threading.Thread(target=cache.release, args=('plan-1', docker))
+    release.start()
+    assert _wait(lambda: docker.removed == ['probe:1.0'])
+    acquired = []
+    acquire = threading.Thread(target=lambda: acquired.append(cache.acquire('plan-2', docker, 'probe:1.0')))
+    acquire.start()
+    time.sleep(0.05)
+    # Not pulled again while the eviction is still removing it
+    assert docker.pulls == ['probe:1.0'] and not acquired
+    assert cache.warm(docker, 'probe:1.0') is None
+    docker.removing.set()
+    release.join(2)
+    acquire.join(2)
+    assert acquired[0].result(2)[0] is not None
+    assert docker.pulls == ['probe:1.0', 'probe:1.0']
+    assert _wait(lambda: 'probe:1.0' in cache.cached(None))
+
+
+def test_warmed_image_is_shared_without_reference(puller):
+    cache = _cache(puller)
+    docker = FakeDocker()
+    cache.warm(docker, 'probe:1.0').result(2)
+    assert cache.warm(docker, 'probe:1.0') is None
+    assert _wait(lambda: 'probe:1.0' in cache.cached(None))
+    assert cache.acquire('plan', docker, 'probe:1.0').result(2)[1] == 0.0
+
+
+class Hosts:
+    """
+    Docker clients of the execution hosts, as handed out by the docker client pool
+    """
+    def __init__(self):
+        self.clients = {}
+        self.leased = []
+
+    def connect(self, execution_host):
+        self.leased.append(execution_host)
+        return self.clients.setdefault(execution_host, FakeDocker(execution_host))
+
+    def release(self, dockeri):
+        self.leased.remove(dockeri.execution_host)
+
+
+def _prewarmer(puller, hosts, idle=True, **kwargs):
+    options = dict(interval=0, top=2, min_uses=2, budget=1, images=[])
+    options.update(kwargs)
+    return ProbePrewarmer(_cache(puller, max_images=10), hosts.connect, hosts.release, lambda: idle, **options)
+
+
+def test_candidates_are_the_most_used_images(puller):
+    prewarmer = _prewarmer(puller, Hosts(), images=['pinned:1'])
+    for image, uses in (('a:1', 3), ('b:1', 5), ('c:1', 2), ('rare:1', 1)):
+        for _ in range(uses):
+            prewarmer.record(None, image)
+    assert prewarmer.candidates() == ['pinned:1', 'b:1', 'a:1']
+
+
+def test_warm_up_pulls_missing_images_on_recent_hosts(puller):
+    hosts = Hosts()
+    prewarmer = _prewarmer(puller, hosts)
+    for _ in range(2):
+        prewarmer.record('host-1', 'a:1')
+    prewarmer.cache.acquire('plan', hosts.connect(None), 'a:1').result(2)
+    hosts.release(hosts.clients[None])
+    assert _wait(lambda: 'a:1' in prewarmer.cache.cached(None))
+    prewarmer.warm_up()
+    assert hosts.clients['host-1'].pulls == ['a:1']
+    assert hosts.clients[None].pulls == ['a:1']
+    assert prewarmer.stats()['warmed'] == 1
+    # Every client connected to is given back
+    assert hosts.leased == []
+
+
+def test_nothing_is_warmed_while_plans_are_being_set_up(puller):
+    hosts = Hosts()
+    prewarmer = _prewarmer(puller, hosts, idle=False)
+    for _ in range(2):
+        prewarmer.record(None, 'a:1')
+    prewarmer.warm_up()
+    assert hosts.clients[None].pulls == []
+    assert hosts.leased == []
+
+
+def test_hosts_over_budget_are_skipped(puller):
+    hosts = Hosts()
+    prewarmer = _prewarmer(puller, hosts, budget=0)
+    for _ in range(2):
+        prewarmer.record(None, 'a:1')
+    prewarmer.warm_up()
+    assert None not in hosts.clients
+
+
+def test_uses_decay_and_old_hosts_are_forgotten(puller):
+    prewarmer = _prewarmer(puller, Hosts(), decay=0.5, host_ttl=0)
+    for _ in range(2):
+        prewarmer.record('host-1', 'a:1')
+    assert prewarmer.stats()['hosts'] == 2
+    prewarmer.warm_up()
+    assert prewarmer.stats()['uses'] == {'a:1': 1.0}
+    # The default docker host is always kept
+    assert prewarmer.stats()['hosts'] == 1
+    # Below min_uses the image is no longer a candidate, below half a use it is dropped
+    prewarmer.warm_up()
+    assert prewarmer.candidates() == []
+    prewarmer.warm_up()
+    assert prewarmer.stats()['uses'] == {}
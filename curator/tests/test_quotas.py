@@ -0,0 +1,208 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+import threading
+from concurrent.futures import CancelledError
+import pytest
+from curator.quotas import PlatformQuotas
+
+SP1 = {'name': 'sp1'}
+SP2 = {'name': 'sp2'}
+
+
+def _first(platform_type, sp_list):
+    return sp_list[0]
+
+
+def _wait(predicate, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+@pytest.fixture
+def quotas():
+    return PlatformQuotas(capacity={'sp1': 1, 'sp2': 1}, default_capacity=0, adaptive=False, max_wait=2)
+
+
+def _waiting(quotas, owner, sp_list, results, max_wait=None):
+    def reserve():
+        try:
+            results.append((owner, quotas.reserve(owner, 'sonata', sp_list, _first, max_wait=max_wait)))
+        except CancelledError:
+            results.append((owner, 'cancelled'))
+    thread = threading.Thread(target=reserve)
+    thread.start()
+    return thread
+
+
+def test_reserves_while_there_is_capacity(quotas):
+    assert quotas.reserve('a', 'sonata', [SP1, SP2], _first) is SP1
+    assert quotas.reserve('b', 'sonata', [SP1, SP2], _first) is SP2
+    assert quotas.stats()['platforms']['sp1']['in_use'] == 1
+
+
+def test_unlimited_platforms_never_wait():
+    quotas = PlatformQuotas(capacity={}, default_capacity=0, adaptive=False, max_wait=0)
+    for _ in range(10):
+        assert quotas.reserve('a', 'sonata', [SP1], _first) is SP1
+
+
+def test_times_out_without_capacity(quotas):
+    quotas.reserve('a', 'sonata', [SP1], _first)
+    assert quotas.reserve('b', 'sonata', [SP1], _first, max_wait=0.05) is None
+    assert quotas.stats()['platforms']['sp1']['timeouts'] == 1
+
+
+def test_waiters_are_served_in_fifo_order(quotas):
+    quotas.reserve('holder', 'sonata', [SP1], _first)
+    results = []
+    threads = []
+    for owner in ('first', 'second', 'third'):
+        threads.append(_waiting(quotas, owner, [SP1], results))
+        assert _wait(lambda: quotas.stats()['waiting'] == len(threads))
+    for _ in threads:
+        count = len(results)
+        quotas.release('sp1')
+        assert _wait(lambda: len(results) == count + 1)
+    for thread in threads:
+        thread.join(2)
+    assert [owner for owner, _ in results] == ['first', 'second', 'third']
+
+
+def test_queued_plans_are_not_overtaken(quotas):
+    quotas.reserve('holder', 'sonata', [SP1], _first)
+    results = []
+    thread = _waiting(quotas, 'waiting', [SP1], results)
+    assert _wait(lambda: quotas.stats()['waiting'] == 1)
+    # Freed capacity goes to the queue, not to a newcomer
+    quotas.release('sp1')
+    assert quotas.reserve('newcomer', 'sonata', [SP1], _first, max_wait=0) is None
+    thread.join(2)
+    assert results == [('waiting', SP1)]
+
+
+def test_waiter_takes_the_first_slot_freed_on_any_candidate(quotas):
+    quotas.reserve('a', 'sonata', [SP1], _first)
+    quotas.reserve('b', 'sonata', [SP2], _first)
+    results = []
+    thread = _waiting(quotas, 'waiting', [SP1, SP2], results)
+    assert _wait(lambda: quotas.stats()['platforms']['sp2']['queued'] == 1)
+    quotas.release('sp2')
+    thread.join(2)
+    assert results == [('waiting', SP2)]
+    assert quotas.stats()['platforms']['sp1']['queued'] == 0
+
+
+def test_withdraw_cancels_the_wait(quotas):
+    quotas.reserve('holder', 'sonata', [SP1], _first)
+    results = []
+    thread = _waiting(quotas, 'cancelled', [SP1], results)
+    assert _wait(lambda: quotas.stats()['waiting'] == 1)
+    assert quotas.withdraw('cancelled')
+    thread.join(2)
+    assert results == [('cancelled', 'cancelled')]
+    assert not quotas.withdraw('cancelled')
+    assert quotas.stats()['waiting'] == 0
+
+
+def test_one_plan_can_wait_for_several_slots(quotas):
+    quotas.reserve('holder', 'sonata', [SP1], _first)
+    quotas.reserve('holder', 'sonata', [SP2], _first)
+    results = []
+    threads = [_waiting(quotas, 'fanned-out', [SP1, SP2], results) for _ in range(2)]
+    assert _wait(lambda: quotas.stats()['waiting'] == 2)
+    # Serving one of the waits of the plan leaves the other queued
+    quotas.release('sp1')
+    assert _wait(lambda: len(results) == 1)
+    assert results == [('fanned-out', SP1)]
+    assert quotas.stats()['waiting'] == 1
+    quotas.release('sp2')
+    for thread in threads:
+        thread.join(2)
+    assert results == [('fanned-out', SP1), ('fanned-out', SP2)]
+    assert not quotas._waiters
+
+
+def test_withdraw_cancels_every_wait_of_the_plan(quotas):
+    quotas.reserve('holder', 'sonata', [SP1], _first)
+    results = []
+    threads = [_waiting(quotas, 'cancelled', [SP1], results) for _ in range(2)]
+    other = _waiting(quotas, 'other', [SP1], results, max_wait=0.2)
+    assert _wait(lambda: quotas.stats()['waiting'] == 3)
+    assert quotas.withdraw('cancelled')
+    for thread in threads:
+        thread.join(2)
+    assert results == [('cancelled', 'cancelled')] * 2
+    # Other plans keep waiting
+    assert quotas.stats()['waiting'] == 1
+    other.join(2)
+    assert results[-1] == ('other', None)
+    assert not quotas._waiters
+    assert quotas.stats()['platforms']['sp1']['queued'] == 0
+
+
+def test_adaptive_limit_backs_off_and_recovers():
+    quotas = PlatformQuotas(capacity={'sp1': 8}, default_capacity=0, adaptive=True, max_wait=0)
+    quotas.record_failure('sp1')
+    assert quotas.limit('sp1') == 4
+    quotas.record_failure('sp1')
+    assert quotas.limit('sp1') == 2
+    for _ in range(40):
+        quotas.record_success('sp1')
+    assert quotas.limit('sp1') == 8
+
+
+def test_failures_do_not_change_limits_unless_adaptive(quotas):
+    quotas.record_failure('sp1')
+    assert quotas.limit('sp1') == 1
+    assert quotas.stats()['platforms']['sp1']['failures'] == 1
+
+
+def test_adopted_instances_take_capacity(quotas):
+    quotas.adopt('sp1')
+    assert quotas.reserve('a', 'sonata', [SP1], _first, max_wait=0) is None
+
+
+def test_waiting_plans_reclaim_parked_capacity():
+    reclaimed = []
+
+    def reclaim(sp_names):
+        reclaimed.append(sorted(sp_names))
+        quotas.release('sp1')
+        return True
+    quotas = PlatformQuotas(capacity={'sp1': 1}, default_capacity=0, adaptive=False, max_wait=2, reclaim=reclaim)
+    quotas.reserve('parked', 'sonata', [SP1], _first)
+    assert quotas.reserve('waiting', 'sonata', [SP1], _first) is SP1
+    assert reclaimed == [['sp1']]
+    # Nothing is reclaimed for a plan that would not wait
+    quotas.reserve('newcomer', 'sonata', [SP1], _first, max_wait=0)
+    assert reclaimed == [['sp1']]
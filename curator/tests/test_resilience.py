@@ -0,0 +1,155 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+import threading
+import pytest
+from curator.interfaces.resilience import CircuitBreaker, AIMDLimiter, CircuitOpenError, ConcurrencyLimitError, \
+    RateLimitError, RateLimits, TokenBucket, CLOSED, OPEN, HALF_OPEN
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.allow()
+        breaker.record_failure()
+    breaker.allow()
+    breaker.record_success()
+    for _ in range(3):
+        breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    assert breaker.stats() == {'state': OPEN, 'consecutive_failures': 3, 'opened': 1, 'rejected': 1}
+
+
+def test_breaker_probes_after_reset_timeout():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    breaker.allow()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and breaker.opened == 2
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    breaker.allow()
+
+
+def test_limiter_grows_additively_and_backs_off_on_failure():
+    limiter = AIMDLimiter('test', initial_limit=2, max_limit=4, latency_floor=10)
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(0.01, True)
+    assert limiter.limit == 3
+    limiter.acquire()
+    limiter.release(0.01, False)
+    assert limiter.limit == 1 and limiter.decreases == 1
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.01, True)
+    assert limiter.limit == 4
+
+
+def test_limiter_backs_off_on_slow_responses_once_per_latency():
+    limiter = AIMDLimiter('test', initial_limit=16, latency_tolerance=2.0, latency_floor=0)
+    limiter.acquire()
+    limiter.release(0.1, True)
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release(1.0, True)
+    # The burst of slow responses arrived within one smoothed latency
+    assert limiter.limit == 8 and limiter.decreases == 1
+
+
+def test_limiter_waits_for_a_slot_and_rejects_after_max_wait():
+    limiter = AIMDLimiter('test', initial_limit=1, max_wait=0.05)
+    limiter.acquire()
+    with pytest.raises(ConcurrencyLimitError):
+        limiter.acquire()
+    assert limiter.stats()['rejected'] == 1
+
+    limiter.max_wait = 5
+    acquired = threading.Event()
+
+    def waiter():
+        limiter.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    assert not acquired.wait(0.05)
+    limiter.cancel()
+    assert acquired.wait(1)
+    thread.join()
+    assert limiter.in_flight == 1
+
+
+def test_bucket_lets_bursts_through_then_spaces_callers():
+    bucket = TokenBucket('test', rate=50, burst=2, max_wait=1)
+    start = time.monotonic()
+    assert bucket.acquire() == 0 and bucket.acquire() == 0
+    waits = [bucket.acquire() for _ in range(3)]
+    elapsed = time.monotonic() - start
+    assert all(0 < wait <= 0.021 for wait in waits)
+    assert 0.05 <= elapsed < 0.5
+    stats = bucket.stats()
+    assert (stats['per_minute'], stats['granted'], stats['throttled']) == (3000, 5, 3)
+
+
+def test_bucket_rejects_callers_that_would_wait_too_long():
+    bucket = TokenBucket('test', rate=1, burst=1, max_wait=0.1)
+    bucket.acquire()
+    with pytest.raises(RateLimitError):
+        bucket.acquire()
+    assert bucket.stats()['rejected'] == 1
+
+
+def test_zero_rate_is_unlimited():
+    bucket = TokenBucket('test', rate=0, burst=1, max_wait=0)
+    assert [bucket.acquire() for _ in range(100)] == [0] * 100
+
+
+def test_rate_limits_per_operation_and_target():
+    limits = RateLimits('pa', {'instantiate': (60, 1), 'terminate': (0, 1)},
+                        overrides={'instantiate': {'sp2': 0}}, max_wait=0.01)
+    limits.acquire('instantiate', 'sp1')
+    with pytest.raises(RateLimitError):
+        limits.acquire('instantiate', 'sp1')
+    # Other platforms and operations have their own buckets
+    for _ in range(5):
+        limits.acquire('instantiate', 'SP2')
+        limits.acquire('terminate', 'sp1')
+    stats = limits.stats()
+    assert stats['instantiate']['sp1']['rejected'] == 1
+    assert stats['instantiate']['SP2']['per_minute'] == 0
+    assert stats['terminate']['sp1']['granted'] == 5
@@ -0,0 +1,110 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import threading
+from queue import Full
+import pytest
+from curator.scheduler import Scheduler, WorkerPool, ADMISSION, CLEANUP, CANCELLATION
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool('test', 1, max_queued=1)
+    yield pool
+    pool.shutdown(wait=False)
+
+
+def test_submit_runs_and_accounts_the_task(pool):
+    assert pool.submit(lambda a, b: a + b, 1, 2).result(2) == 3
+    stats = pool.stats()
+    assert (stats['completed'], stats['failed'], stats['running'], stats['queued']) == (1, 0, 0, 0)
+
+
+def test_failed_tasks_are_counted(pool):
+    def fail():
+        raise RuntimeError('boom')
+    future = pool.submit(fail)
+    with pytest.raises(RuntimeError):
+        future.result(2)
+    assert pool.stats()['failed'] == 1
+
+
+def test_finished_futures_are_reaped(pool):
+    for _ in range(5):
+        pool.submit(lambda: None).result(2)
+    pool.shutdown()
+    assert pool.stats()['active'] == 0
+    assert pool.stats()['completed'] == 5
+
+
+def test_full_queue_rejects_new_tasks(pool):
+    running = threading.Event()
+    release = threading.Event()
+
+    def block():
+        running.set()
+        release.wait(2)
+    first = pool.submit(block)
+    assert running.wait(2)
+    queued = pool.submit(lambda: None)
+    assert pool.stats()['queued'] == 1
+    with pytest.raises(Full):
+        pool.submit(lambda: None)
+    assert pool.stats()['rejected'] == 1
+    release.set()
+    first.result(2)
+    queued.result(2)
+    # Room again once the queue drains
+    pool.submit(lambda: None).result(2)
+
+
+def test_scheduler_reads_pool_sizes_from_the_environment(monkeypatch):
+    monkeypatch.setenv('CURATOR_ADMISSION_WORKERS', '3')
+    monkeypatch.setenv('CURATOR_ADMISSION_QUEUE', '7')
+    scheduler = Scheduler()
+    try:
+        stats = scheduler.stats()
+        assert {ADMISSION, CLEANUP, CANCELLATION} <= set(stats)
+        assert (stats[ADMISSION]['workers'], stats[ADMISSION]['max_queued']) == (3, 7)
+        assert stats[CLEANUP]['max_queued'] == 0
+    finally:
+        scheduler.shutdown(wait=False)
+
+
+def test_pools_do_not_starve_each_other():
+    scheduler = Scheduler(pools={ADMISSION: ('CURATOR_TEST_ADMISSION_WORKERS', 1, 'CURATOR_TEST_ADMISSION_QUEUE'),
+                                 CLEANUP: ('CURATOR_TEST_CLEANUP_WORKERS', 1, 'CURATOR_TEST_CLEANUP_QUEUE')})
+    release = threading.Event()
+    try:
+        scheduler.submit(ADMISSION, release.wait, 2)
+        scheduler.submit(ADMISSION, lambda: None)
+        # Admission is saturated, cleanup still runs
+        assert scheduler.submit(CLEANUP, lambda: 'done').result(2) == 'done'
+        assert scheduler.queue_depth(ADMISSION) == 1
+    finally:
+        release.set()
+        scheduler.shutdown()
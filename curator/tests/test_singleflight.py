@@ -0,0 +1,115 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+import threading
+import pytest
+from curator.interfaces.singleflight import SingleFlight
+
+
+def _concurrent(flight, key, fn, callers):
+    """
+    Calls flight.do(key, fn) from callers threads at once
+    """
+    results = [None] * callers
+    errors = [None] * callers
+
+    def call(i):
+        try:
+            results[i] = flight.do(key, fn)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def _gate(flight, callers):
+    # Called by fn, blocks until every caller has joined the call in flight
+    def wait_for_callers():
+        while flight.stats()['calls'] < callers:
+            time.sleep(0.005)
+    return wait_for_callers
+
+
+def test_concurrent_calls_collapse_into_one():
+    flight = SingleFlight('test')
+    executions = []
+    ready = _gate(flight, 5)
+
+    def fn():
+        ready()
+        executions.append(1)
+        return {'value': [1, 2]}
+
+    threads, results, errors = _concurrent(flight, 'key', fn, 5)
+    for thread in threads:
+        thread.join(2)
+    assert executions == [1]
+    assert errors == [None] * 5
+    assert all(result == {'value': [1, 2]} for result in results)
+    # Every caller gets its own copy
+    assert len({id(result) for result in results}) == 5
+    assert flight.stats() == {'in_flight': 0, 'calls': 5, 'executed': 1, 'collapsed': 4}
+
+
+def test_waiters_get_the_same_exception():
+    flight = SingleFlight('test')
+    ready = _gate(flight, 3)
+
+    def fn():
+        ready()
+        raise ValueError('boom')
+
+    threads, results, errors = _concurrent(flight, 'key', fn, 3)
+    for thread in threads:
+        thread.join(2)
+    assert all(isinstance(error, ValueError) for error in errors)
+
+
+def test_nothing_is_kept_once_the_call_returns():
+    flight = SingleFlight('test')
+    calls = []
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 1
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 2
+    assert flight.stats()['executed'] == 2
+
+
+def test_different_keys_do_not_collapse():
+    flight = SingleFlight('test')
+    assert flight.do('a', lambda: 'a') == 'a'
+    assert flight.do('b', lambda: 'b') == 'b'
+    assert flight.stats()['collapsed'] == 0
+
+
+def test_failed_call_is_retried_by_the_next_caller():
+    flight = SingleFlight('test')
+    with pytest.raises(ValueError):
+        flight.do('key', lambda: int('x'))
+    assert flight.do('key', lambda: 1) == 1
@@ -0,0 +1,136 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import time
+import pytest
+from curator.timers import DeadlineService
+
+
+TIMEOUTS = {'phase': ('CURATOR_TEST_PHASE_TIMEOUT', 0.05), 'off': ('CURATOR_TEST_OFF_TIMEOUT', 0)}
+
+
+@pytest.fixture
+def wheel():
+    # The wheel thread is stopped, tests advance it tick by tick
+    service = DeadlineService(timeouts=TIMEOUTS, tick=0.01, slots=4)
+    service.stop()
+    service._thread.join()
+    return service
+
+
+def _advance(service, ticks):
+    for _ in range(ticks):
+        service._advance()
+
+
+def test_expires_after_its_timeout(wheel):
+    fired = []
+    deadline = wheel.schedule('phase', 'key', fired.append, 'expired')
+    _advance(wheel, 4)
+    assert not fired and wheel.pending('phase', 'key')
+    _advance(wheel, 1)
+    assert fired == ['expired']
+    assert deadline.expired and not wheel.pending('phase', 'key')
+    assert wheel.stats()['expired']['phase'] == 1
+
+
+def test_deadlines_beyond_a_wheel_turn_wait_for_their_round(wheel):
+    fired = []
+    wheel.schedule('phase', 'key', fired.append, 'expired', timeout=0.1)
+    _advance(wheel, 9)
+    assert not fired
+    _advance(wheel, 1)
+    assert fired == ['expired']
+
+
+def test_cancelled_deadline_does_not_fire(wheel):
+    fired = []
+    deadline = wheel.schedule('phase', 'key', fired.append, 'expired')
+    assert deadline.cancel()
+    assert not deadline.cancel()
+    _advance(wheel, 10)
+    assert not fired and deadline.cancelled
+    assert wheel.stats()['cancelled'] == 1
+
+
+def test_rescheduling_replaces_the_deadline(wheel):
+    fired = []
+    wheel.schedule('phase', 'key', fired.append, 'first')
+    _advance(wheel, 3)
+    wheel.schedule('phase', 'key', fired.append, 'second')
+    _advance(wheel, 4)
+    assert not fired
+    _advance(wheel, 1)
+    assert fired == ['second']
+
+
+def test_cancel_by_key(wheel):
+    fired = []
+    wheel.schedule('phase', 'key', fired.append, 'expired')
+    assert wheel.cancel('phase', 'key')
+    assert not wheel.cancel('phase', 'key')
+    _advance(wheel, 10)
+    assert not fired
+
+
+def test_zero_timeout_disables_the_deadline(wheel):
+    fired = []
+    deadline = wheel.schedule('off', 'key', fired.append, 'expired')
+    _advance(wheel, 10)
+    assert not fired and not wheel.pending('off', 'key')
+    assert not deadline.cancel()
+
+
+def test_failing_action_does_not_stop_the_wheel(wheel):
+    fired = []
+    wheel.schedule('phase', 'bad', lambda: 1 / 0)
+    wheel.schedule('phase', 'good', fired.append, 'expired')
+    _advance(wheel, 5)
+    assert fired == ['expired']
+
+
+def test_wheel_thread_runs_expiry_actions():
+    service = DeadlineService(timeouts=TIMEOUTS, tick=0.01)
+    try:
+        fired = []
+        service.schedule('phase', 'key', fired.append, 'expired')
+        end = time.monotonic() + 2
+        while not fired and time.monotonic() < end:
+            time.sleep(0.01)
+        assert fired == ['expired']
+    finally:
+        service.stop()
+
+
+def test_stale_handle_does_not_cancel_the_rescheduled_deadline(wheel):
+    fired = []
+    stale = wheel.schedule('phase', 'key', fired.append, 'first')
+    wheel.schedule('phase', 'key', fired.append, 'second')
+    assert not stale.cancel()
+    assert wheel.pending('phase', 'key')
+    _advance(wheel, 5)
+    assert fired == ['second']
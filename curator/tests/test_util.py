@@ -0,0 +1,81 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+import json
+import pytest
+import curator.util as util
+from curator.util import iter_json_array
+
+
+PACKAGES = [
+    {'uuid': 'a', 'pd': {'name': 'ns-été', 'package_content': []}},
+    {'uuid': 'b', 'pd': {'name': 'ns-b', 'tags': ['x', 'y']}},
+    12345,
+    'text with ] and , inside',
+    {'quoted': 'say "hi" \\ [not] {nested}'},
+    None
+]
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 4096])
+def test_elements_split_across_chunks(size):
+    data = json.dumps(PACKAGES, ensure_ascii=False, indent=2).encode('utf-8')
+    assert list(iter_json_array(_chunks(data, size))) == PACKAGES
+
+
+def test_str_chunks_and_empty_array():
+    assert list(iter_json_array(['[1', '2, 3', '4]'])) == [12, 34]
+    assert list(iter_json_array([' [ ', ' ]'])) == []
+
+
+def test_elements_are_yielded_before_the_array_ends():
+    def chunks():
+        yield b'[{"uuid": "a"}, '
+        raise AssertionError('read too far')
+
+    assert next(iter_json_array(chunks())) == {'uuid': 'a'}
+
+
+def test_large_elements_are_decoded_once(monkeypatch):
+    decoded = []
+    loads = json.loads
+    monkeypatch.setattr(util.json, 'loads', lambda text: decoded.append(len(text)) or loads(text))
+    element = {'uuid': 'a', 'pd': {'package_content': [{'source': f'file-{i}'} for i in range(2000)]}}
+    data = json.dumps([element, element]).encode('utf-8')
+    assert list(iter_json_array(_chunks(data, 100))) == [element, element]
+    assert len(decoded) == 2
+
+
+def test_invalid_input():
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'{"uuid": "a"}']))
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'[{"uuid": "a"}, {"uu']))
@@ -0,0 +1,197 @@
+# Copyright (c) 2019 5GTANGO
+# ALL RIGHTS RESERVED.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Neither the name of the SONATA-NFV, 5GTANGO
+# nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written
+# permission.
+#
+#
+# This work has been performed in the framework of the 5GTANGO project,
+# funded by the European Commission under Grant number 761493 through
+# the Horizon 2020 and 5G-PPP programmes. The authors would like to
+# acknowledge the contributions of their colleagues of the 5GTANGO
+# partner consortium (www.5gtango.eu).
+
+
+import os
+import math
+import time
+import logging
+import threading
+from curator.logger import TangoLogger
+
+
+_LOG = TangoLogger.getLogger('curator:timers', log_level=logging.DEBUG, log_json=True)
+
+INSTANTIATION = 'instantiation'
+EXECUTION = 'execution'
+CANCELLATION = 'cancellation'
+
+# phase: (env var for timeout in seconds, default timeout), 0 disables the deadline
+DEFAULT_TIMEOUTS = {
+    INSTANTIATION: ('CURATOR_INSTANTIATION_TIMEOUT', 1800),
+    EXECUTION: ('CURATOR_EXECUTION_TIMEOUT', 14400),
+    CANCELLATION: ('CURATOR_CANCELLATION_TIMEOUT', 600),
+}
+
+
+class Deadline:
+    """
+    Handle of a scheduled expiry, returned by DeadlineService.schedule
+    """
+    __slots__ = ('key', 'phase', 'timeout', 'expires_tick', 'action', 'args', 'expired', 'cancelled', '_service')
+
+    def __init__(self, service, key, phase, timeout, expires_tick, action, args):
+        self._service = service
+        self.key = key
+        self.phase = phase
+        self.timeout = timeout
+        self.expires_tick = expires_tick
+        self.action = action
+        self.args = args
+        self.expired = False
+        self.cancelled = False
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.phase}, {self.key}, timeout={self.timeout})'
+
+    def cancel(self):
+        """
+        :return: True if the deadline was pending, False if it already expired
+        """
+        return self._service.cancel(self.phase, self.key, handle=self) if self.expires_tick is not None else False
+
+
+class DeadlineService:
+    """
+    Hashed timer wheel for the deadlines of the curator waits (instantiation,
+    test execution and cancellation). Deadlines are placed in the slot of the
+    tick they expire on, a single thread advances the wheel once per tick and
+    runs the actions of the expired ones, so pending deadlines cost no thread.
+    Actions run on the wheel thread and must not block, anything slow should
+    be handed over to the scheduler pools.
+    Configuration:
+        CURATOR_INSTANTIATION_TIMEOUT, CURATOR_EXECUTION_TIMEOUT,
+        CURATOR_CANCELLATION_TIMEOUT: seconds, 0 disables the deadline
+        CURATOR_TIMER_TICK: wheel resolution in seconds
+    """
+    def __init__(self, timeouts=None, tick=None, slots=512):
+        self.timeouts = {}
+        for phase, (timeout_var, default_timeout) in (timeouts or DEFAULT_TIMEOUTS).items():
+            self.timeouts[phase] = float(os.getenv(timeout_var, default_timeout))
+        self.tick = tick if tick is not None else float(os.getenv('CURATOR_TIMER_TICK', 1.0))
+        self._wheel = [dict() for _ in range(slots)]
+        self._deadlines = {}
+        self._ticks = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.scheduled = 0
+        self.expired = {phase: 0 for phase in self.timeouts}
+        self.cancelled = 0
+        self._thread = threading.Thread(target=self._run, name='curator-timer-wheel', daemon=True)
+        self._thread.start()
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(tick={self.tick}, pending={len(self._deadlines)})'
+
+    def schedule(self, phase, key, action, *args, timeout=None):
+        """
+        Runs action(*args) if the deadline is not cancelled before the phase
+        timeout. Scheduling an existing key of the same phase replaces its deadline
+        :param phase: one of INSTANTIATION, EXECUTION, CANCELLATION
+        :param key: hashable identifier of the wait, e.g. (test_plan_uuid, test_uuid)
+        :param action:
+        :param timeout: overrides the phase timeout, in seconds
+        :return: Deadline
+        """
+        timeout = self.timeouts[phase] if timeout is None else timeout
+        if not timeout or timeout <= 0:
+            return Deadline(self, key, phase, timeout, None, action, args)
+        with self._lock:
+            self._discard((phase, key))
+            expires_tick = self._ticks + max(1, math.ceil(timeout / self.tick))
+            deadline = Deadline(self, key, phase, timeout, expires_tick, action, args)
+            self._wheel[expires_tick % len(self._wheel)][(phase, key)] = deadline
+            self._deadlines[(phase, key)] = deadline
+            self.scheduled += 1
+        return deadline
+
+    def cancel(self, phase, key, handle=None):
+        """
+        :param handle: only cancel this Deadline, a stale handle must not
+            cancel the deadline the key was rescheduled with
+        :return: True if a pending deadline was cancelled
+        """
+        with self._lock:
+            if handle is not None and self._deadlines.get((phase, key)) is not handle:
+                return False
+            deadline = self._discard((phase, key))
+            if deadline:
+                deadline.cancelled = True
+                self.cancelled += 1
+            return deadline is not None
+
+    def pending(self, phase, key):
+        return (phase, key) in self._deadlines
+
+    def stats(self):
+        with self._lock:
+            by_phase = {phase: 0 for phase in self.timeouts}
+            for deadline in self._deadlines.values():
+                by_phase[deadline.phase] = by_phase.get(deadline.phase, 0) + 1
+            return {
+                'tick': self.tick,
+                'timeouts': self.timeouts,
+                'pending': len(self._deadlines),
+                'pending_by_phase': by_phase,
+                'scheduled': self.scheduled,
+                'cancelled': self.cancelled,
+                'expired': dict(self.expired)
+            }
+
+    def stop(self):
+        self._stop.set()
+
+    def _discard(self, wheel_key):
+        deadline = self._deadlines.pop(wheel_key, None)
+        if deadline:
+            del self._wheel[deadline.expires_tick % len(self._wheel)][wheel_key]
+        return deadline
+
+    def _advance(self):
+        with self._lock:
+            self._ticks += 1
+            bucket = self._wheel[self._ticks % len(self._wheel)]
+            # Deadlines further than a full turn share the slot, they stay for a later round
+            due = [deadline for deadline in bucket.values() if deadline.expires_tick <= self._ticks]
+            for deadline in due:
+                self._discard((deadline.phase, deadline.key))
+                deadline.expired = True
+                self.expired[deadline.phase] = self.expired.get(deadline.phase, 0) + 1
+        for deadline in due:
+            _LOG.warning(f'Deadline expired: {deadline}')
+            try:
+                deadline.action(*deadline.args)
+            except Exception as e:
+                _LOG.exception(f'Error running expiry action of {deadline}: {e}')
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stop.wait(max(0.0, next_tick - time.monotonic())):
+            # Catch up if the thread was delayed, e.g. by a slow expiry action
+            while next_tick <= time.monotonic():
+                self._advance()
+                next_tick += self.tick
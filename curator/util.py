@@ -27,11 +27,18 @@
 
 import logging
 from curator.logger import TangoLogger
+import re
 import json
+import codecs
 import datetime
 
 _LOG = TangoLogger.getLogger('curator:util', log_level=logging.DEBUG, log_json=True)
 
+_SEPARATORS = ' \t\r\n,'
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[\s,\]]')
+
 
 def convert_to_dict(o):
     """
@@ -61,3 +68,84 @@ class CustomEncoder(json.JSONEncoder):
         else:
             return json.JSONEncoder.default(self, obj)
 
+
+def iter_json_array(chunks):
+    """
+    Parses a JSON array incrementally, yielding its elements as soon as they
+    are complete, so a large response never has to be held in memory at once.
+    Every character is scanned once to find where an element ends, and the
+    element is only decoded then, however many chunks it spans
+    :param chunks: iterable of bytes (or str), e.g. response.iter_content()
+    :return: generator of the array elements
+    """
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    started = False
+    pending = []  # text of the element in progress from the previous chunks
+    depth = 0
+    in_string = False
+    escaped = False
+    scalar = False
+    for chunk in chunks:
+        buf = utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        pos = 0
+        start = 0
+        while True:
+            if not pending and not depth and not in_string and not scalar:
+                while pos < len(buf) and buf[pos] in _SEPARATORS:
+                    pos += 1
+                if pos >= len(buf):
+                    break
+                if not started:
+                    if buf[pos] != '[':
+                        raise ValueError(f'Expected a JSON array, found {buf[pos:pos + 20]}')
+                    started = True
+                    pos += 1
+                    continue
+                if buf[pos] == ']':
+                    return
+                start = pos
+                if buf[pos] in '{[':
+                    depth = 1
+                elif buf[pos] == '"':
+                    in_string = True
+                else:
+                    scalar = True
+                pos += 1
+            end = None
+            if escaped:
+                escaped = False
+                pos += 1
+            while pos < len(buf):
+                if scalar:
+                    match = _SCALAR_END.search(buf, pos)
+                    if match:
+                        scalar = False
+                        end = match.start()
+                    break
+                match = (_STRING_SPECIAL if in_string else _STRUCTURE).search(buf, pos)
+                if not match:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '\\':
+                    if pos == len(buf):
+                        escaped = True
+                    pos += 1
+                elif char == '"':
+                    in_string = not in_string
+                elif char in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                if not depth and not in_string:
+                    end = pos
+                    break
+            if end is None:
+                # Element not complete yet, wait for the next chunk
+                pending.append(buf[start:])
+                break
+            element = json.loads(''.join(pending) + buf[start:end])
+            pending = []
+            pos = end
+            yield element
+    raise ValueError('Truncated JSON array')